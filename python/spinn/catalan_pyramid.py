@@ -1,6 +1,10 @@
 # Source: https://github.com/nyu-mll/unsupervised-treelstm/commit/bbe1946e123e396362ecd071d1673766013463f2
 # Original author of core encoder: Jihun Choi, Seoul National Univ.
 
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import numpy as np
 
 # PyTorch
@@ -9,11 +13,11 @@ import torch.nn as nn
 from torch.nn import init
 from torch.autograd import Variable
 import torch.nn.functional as F
-import torch.multiprocessing as mp
 
-from spinn.util.blocks import Embed, to_gpu, MLP, Linear, LayerNormalization
+from spinn.util.blocks import Embed, to_gpu, MLP, Linear, LayerNormalization, layer_norm_positions
 from spinn.util.misc import Args, Vocab, Example
 from spinn.util.catalan import Catalan
+from spinn.util.chart import Chart, backtrace, chart_memory
 
 from spinn.spinn_core_model import SPINN
 
@@ -46,6 +50,8 @@ def build_model(data_manager, initial_embeddings, vocab_size,
                      topk=FLAGS.topk,
                      cp_num=FLAGS.cp_num,
                      multiproc=FLAGS.mp,
+                     num_workers=FLAGS.mp_workers,
+                     chart_checkpoint=FLAGS.chart_checkpoint,
                      )
 
 
@@ -75,6 +81,8 @@ class CatalanPyramid(nn.Module):
                  topk=None,
                  cp_num=None,
                  multiproc=None,
+                 num_workers=0,
+                 chart_checkpoint=False,
                  **kwargs
                  ):
         super(CatalanPyramid, self).__init__()
@@ -111,7 +119,9 @@ class CatalanPyramid(nn.Module):
             composition_ln=composition_ln,
             trainable_temperature=trainable_temperature,
             parent_selection=parent_selection,
-            use_sentence_pair=use_sentence_pair)
+            use_sentence_pair=use_sentence_pair,
+            checkpoint_rows=chart_checkpoint,
+            num_workers=num_workers)
 
         # assert FLAGS.lateral_tracking == False
         # TODO: move assertion flag to base.
@@ -135,6 +145,7 @@ class CatalanPyramid(nn.Module):
 
         # For sample printing and logging
         self.parse_memory = None
+        self.chart_memory = None
         self.inverted_vocabulary = None
         self.temperature_to_display = 0.0
     
@@ -207,6 +218,7 @@ class CatalanPyramid(nn.Module):
         else:
             sr_transitions, weights, temperature = self.chart_parser(
             emb, example_lengths_var, topk, cp_num, temperature_multiplier=pyramid_temperature_multiplier)
+            self.chart_memory = self.chart_parser.chart_memory
 
         # Use SPINN with CP parses
         embeds = self.run_embed_spinn(x)
@@ -419,13 +431,21 @@ class CatalanPyramid(nn.Module):
 class ChartParser(nn.Module):
 
     def __init__(self, word_dim, hidden_dim, low_dim, multiproc,
-                 composition_ln=False, trainable_temperature=False, parent_selection=False, use_sentence_pair=False):
+                 composition_ln=False, trainable_temperature=False, parent_selection=False, use_sentence_pair=False,
+                 checkpoint_rows=False, num_workers=0):
         super(ChartParser, self).__init__()
         self.word_dim = word_dim
         self.hidden_dim = hidden_dim
         self.low_dim = low_dim
         self.multiproc = multiproc
         self.use_sentence_pair = use_sentence_pair
+        self.checkpoint_rows = checkpoint_rows
+        self.chart_memory = None
+
+        # The pool is built on first use and kept until `shutdown_pool` or
+        # until the parser is collected. It is never copied or pickled.
+        self.num_workers = num_workers or torch.get_num_threads()
+        self.pool = None
 
         self.treelstm_layer = BinaryTreeLSTMLayer(
             low_dim, composition_ln=composition_ln) #CAT: low_dim from hidden_dim
@@ -453,21 +473,94 @@ class ChartParser(nn.Module):
         c = done_mask * new_c + (1 - done_mask) * old_c[:, :-1, :]
         return h, c
 
+    def compose(self, l, r, copies=1):
+        """Compose the children of a group of splits, and score each
+        version."""
+        hiddens, cells = self.treelstm_layer(l=l, r=r, copies=copies)
+        scores = dot_nd(
+            query=self.comp_query.weight.squeeze(),
+            candidates=hiddens) # batch, num_versions
+        return hiddens, cells, scores
+
+    def worker_pool(self):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.num_workers)
+            weakref.finalize(self, self.pool.shutdown, wait=False)
+        return self.pool
+
+    def shutdown_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __getstate__(self):
+        state = super(ChartParser, self).__getstate__().copy()
+        state['pool'] = None
+        return state
+
+    def compose_parallel(self, l, r, copies=1):
+        """
+        Run `compose` on the worker pool, one group of splits per worker.
+        Each worker only gets the children of its own splits, and the
+        results are put back together in order.
+
+        """
+        n_splits = l[0].size(1)
+        n_groups = min(self.num_workers, n_splits)
+        bounds = np.linspace(0, n_splits, n_groups + 1).astype(int)
+
+        pool = self.worker_pool()
+        jobs = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            l_group = tuple(x[:, start:end] for x in l)
+            r_group = tuple(x[:, start:end] for x in r)
+            jobs.append(pool.submit(self.compose, l_group, r_group, copies))
+
+        results = [job.result() for job in jobs]
+        return [torch.cat(parts, 1) for parts in zip(*results)]
+
+    def select_row(self, hiddens, cells, scores, row, temperature):
+        """
+        Combine the versions of each cell in a chart row, from the
+        candidates of all of its splits. Returns the states of the row, the
+        weights of the versions and the largest weight of each cell.
+        """
+        batch_size = hiddens.size(0)
+        n_cols = hiddens.size(1) // row
+        hiddens = hiddens.view(batch_size, n_cols, row, -1)
+        cells = cells.view(batch_size, n_cols, row, -1)
+        scores = scores.view(-1, row) # batch * n_cols, num_versions
+
+        if self.parent_selection == "st_gumbel":
+            weights, w_max, _ = st_gumbel_softmax(scores, temperature)
+        elif self.parent_selection == "softmax":
+            weights = masked_softmax(scores / temperature, None)
+            w_max = weights.max(1)[0]
+        else:
+            weights = gumbel_softmax(scores, temperature)
+            w_max = weights.max(1)[0]
+
+        version_weights = weights.view(batch_size, n_cols, row, 1)
+        h_new = torch.sum(torch.mul(version_weights, hiddens), dim=2)
+        c_new = torch.sum(torch.mul(version_weights, cells), dim=2) # batch, n_cols, dim
+        return h_new, c_new, weights, w_max
+
     def compute_compositions(
         self,
         state,
         mask,
         alpha,
         multiproc,
+        copies=1,
         temperature_multiplier=1.0):
         """
-        (In a parallelized manner) Compute all compositions we will need 
-        for the current step.
-        Input to || computation: (h,c) l and r.
-        Input to serial computation: list of (h,c) l and r.
-        don't pass full chart around. only values that'll be needed for computation
+        Compute the states of all the spans of the sentence, one chart row
+        at a time. The children of every split of every cell in a row are
+        composed in a single call to the TreeLSTM layer, and each cell then
+        selects among its splits.
 
-        currently: passing full sentence at each laye. FIX!!
+        The chart runs over `copies` of the batch, which sample their own
+        parses. The words are shared by the copies instead of being tiled.
 
         Example:
         [['A', 'B', 'C', 'D', 'E', 'F', 'G', '.'],
@@ -481,160 +574,29 @@ class ChartParser(nn.Module):
 
         TODO: do masking to prevent composing with padding.
         """
-        # make sure are embeddigns
         h, c = state # batch, length, dim
-        mask = mask # batch, length
-
-        length = h.size(1)
-        word_hiddens = h.chunk(length, dim=1)
-        word_cells = c.chunk(length, dim=1)
-        length_masks = mask.chunk(length, dim=1) # (batch,1), ...
+        batch_size, length, _ = h.size()
         temperature = temperature_multiplier
 
-        chart = [[]]
-        all_weights = [[]]
-        mask = [[]]
-        memory = [[]]
+        chart = Chart(h, c, copies=copies,
+                      checkpoint_rows=self.checkpoint_rows)
+        self.chart_memory = chart_memory(
+            batch_size, length, h.size(2), self.checkpoint_rows, copies)
+        compose = self.compose_parallel if multiproc else self.compose
 
-        for i in range(length):
-            chart[0].append((word_hiddens[i], word_cells[i]))
-            all_weights[0].append(None)
-            mask[0].append(None)
-            memory[0].append(None)
         for row in range(1, length):
-            chart.append([])
-            all_weights.append([])
-            mask.append([])
-            memory.append([])
-            for col in range(length - row):
-                chart[row].append(None)
-                all_weights[row].append(None)
-                mask[row].append(None)
-                memory[row].append(None)
-
-        def fill_in(queue, num, chart, comp_query, treelstm_layer, parent_selection, alpha, row, col):
-            states = []
-            hiddens = []
-            tr_versions = []
-            cells = []
-            scores = []
-            for i in range(row):
-                l = chart[row-i-1][col]
-                r = chart[i][row+col-i]
-                states.append(treelstm_layer(l=l, r=r))
-                hiddens.append(states[-1][0])
-                cells.append(states[-1][1])
-
-                comp_weights = dot_nd(
-                    query=comp_query.weight.squeeze(),
-                    candidates=hiddens[-1]) # batch, 1
-                scores.append(comp_weights) # [(batch, 1), ...]
-
-            if parent_selection == "st_gumbel":
-                weights, w_max, w_argmax = st_gumbel_softmax(torch.cat(scores, dim=1), temperature)
-                alpha *= w_max
-            elif parent_selection == "softmax":
-                weights = masked_softmax(torch.cat(scores, dim=1) / temperature, None)  
-            else:
-                weights = gumbel_softmax(torch.cat(scores, dim=1), temperature) # cat: batch, num_versions, out: batch, num_states
-
-            h_new = torch.sum(torch.mul(weights.unsqueeze(2), torch.cat(hiddens, dim=1)), dim=1)
-            c_new = torch.sum(torch.mul(weights.unsqueeze(2), torch.cat(cells, dim=1)), dim=1) # batch, num_states, dim
-
-            chart[row][col] = (h_new.unsqueeze(1), c_new.unsqueeze(1))
-            all_weights[row][col] = weights
-            mask[row][col] = create_max_mask(all_weights[row][col])
-            memory[row][col] = w_argmax
-
-            queue.put({num: [chart[row][col], mask[row][col], memory[row][col]]})
-            #return {num: [chart[row][col], all_weights[row][col], mask[row][col], memory[row][col]]}
+            n_cols = length - row
+            weights, w_max = chart.fill(row, compose, partial(
+                self.select_row, row=row, temperature=temperature))
+            if self.parent_selection == "st_gumbel":
+                alpha = alpha * chart.expand(w_max.view(-1, n_cols)).prod(1)
+            chart.select(weights)
 
-        for row in range(1, length):
-            if multiproc:
-                queue = mp.Queue()
-                processes = []
-                collect = []
-                
-                for col in range(length - row):
-                    p = mp.Process(target=fill_in, args=(queue, col, chart, self.comp_query, self.treelstm_layer, self.parent_selection, alpha, row, col))
-                    p.start()
-                    processes.append(p)
-
-                for p in processes:
-                    p.join()
-
-                collect = [queue.get() for p in processes]
-                results = {}
-                for i in range(len(collect)):
-                    results[list(collect[i])[0]] = list(collect[0].values())[0]
-                
-                for col in range(length - row):
-                    chart[row][col] = results[col][0]
-                    mask[row][col] = results[col][1]
-                    memory[row][col] = results[col][2]
-            
-            else:        
-                for col in range(length - row): 
-                    states = []
-                    hiddens = []
-                    tr_versions = []
-                    cells = []
-                    scores = []
-                    for i in range(row): # can parallelize here
-                        l = chart[row-i-1][col]
-                        r = chart[i][row+col-i]
-                        states.append(self.treelstm_layer(l=l, r=r))
-                        hiddens.append(states[-1][0])
-                        cells.append(states[-1][1])
-
-                        comp_weights = dot_nd(
-                            query=self.comp_query.weight.squeeze(),
-                            candidates=hiddens[-1]) # batch, 1
-                        scores.append(comp_weights) # [(batch, 1), ...]
-
-                    if self.parent_selection == "st_gumbel":
-                        weights, w_max, w_argmax = st_gumbel_softmax(torch.cat(scores, dim=1), temperature)
-                        alpha *= w_max
-                    elif self.parent_selection == "softmax":
-                        weights = masked_softmax(torch.cat(scores, dim=1) / temperature, None)  
-                    else:
-                        weights = gumbel_softmax(torch.cat(scores, dim=1), temperature) # cat: batch, num_versions, out: batch, num_states
-
-                    h_new = torch.sum(torch.mul(weights.unsqueeze(2), torch.cat(hiddens, dim=1)), dim=1)
-                    c_new = torch.sum(torch.mul(weights.unsqueeze(2), torch.cat(cells, dim=1)), dim=1) # batch, num_states, dim
-
-                    chart[row][col] = (h_new.unsqueeze(1), c_new.unsqueeze(1))
-                    all_weights[row][col] = weights
-                    mask[row][col] = create_max_mask(all_weights[row][col])
-                    memory[row][col] = w_argmax
-            
+        # Follow the choices back from the root to get the binary parses.
+        transitions = backtrace(chart.splits().cpu().numpy(), length)
 
-        # Use memory of choices to construct binary parse
-        transitions = [[]]
-        compose_vec = np.ones((h.size(0),1))
-        for i in range(length):
-            transitions[0].append(np.zeros((h.size(0),1)))
-        for row in range(1, length):
-            transitions.append([])
-            for col in range(length - row):
-                transitions[row].append(None)
-
-        for row in range(1, length):
-            for col in range(length - row):
-                tr_versions = []
-                for i in range(row):
-                    tr_versions.append(np.concatenate([transitions[row-i-1][col], transitions[i][row+col-i], compose_vec], axis=1))
-
-                index = memory[row][col].cpu().data.numpy()
-                # Following loops through batch! 
-                # But it's a simple lookup
-                tr_new = []
-                for i in range(h.size(0)):
-                    tr_select = tr_versions[index[i]]
-                    tr_new.append(tr_select[i])
-                transitions[row][col] = np.asarray(tr_new)
-
-        return chart[length-1][0][0], chart[length-1][0][1], mask, alpha.unsqueeze(1), transitions[length-1][0]
+        h, c = chart.root()
+        return h, c, alpha.unsqueeze(1), transitions
 
     def forward(self, input, length, topk, cp_num, temperature_multiplier=None):
         max_depth = input.size(1)
@@ -660,15 +622,8 @@ class ChartParser(nn.Module):
         if cp_num is not None:
             num  = cp_num
 
-        h_long = [h_low] * (num)
-        h_long = torch.cat(h_long, 0)
-        c_long = [c_low] * (num)
-        c_long = torch.cat(c_long, 0)
-        length_mask_long = [length_mask] * (num)
-        length_mask_long = torch.cat(length_mask_long, 0)
-
-        alpha = to_gpu(Variable(torch.ones(h_long.size(0))))
-        h, c, masks, alpha_w, transitions = self.compute_compositions((h_long, c_long), length_mask_long, alpha, self.multiproc, temperature_multiplier=1.0)
+        alpha = to_gpu(Variable(torch.ones(num * batch_size)))
+        h, c, alpha_w, transitions = self.compute_compositions((h_low, c_low), length_mask, alpha, self.multiproc, copies=num, temperature_multiplier=1.0)
 
         alphas = alpha_w.chunk(num, dim=0)
         parses = torch.from_numpy(transitions)
@@ -882,6 +837,7 @@ def sequence_mask(sequence_length, max_length=None):
     seq_length_expand = sequence_length.unsqueeze(1)
     return seq_range_expand < seq_length_expand
 
+
 class BinaryTreeLSTMLayer(nn.Module):
     def __init__(self, hidden_dim, composition_ln=False):
         super(BinaryTreeLSTMLayer, self).__init__()
@@ -896,13 +852,15 @@ class BinaryTreeLSTMLayer(nn.Module):
             self.left_c_ln = LayerNormalization(hidden_dim)
             self.right_c_ln = LayerNormalization(hidden_dim)
 
-    def forward(self, l=None, r=None):
+    def forward(self, l=None, r=None, copies=1):
         """
         Args:
             l: A (h_l, c_l) tuple, where each value has the size
                 (batch_size, max_length, hidden_dim).
             r: A (h_r, c_r) tuple, where each value has the size
                 (batch_size, max_length, hidden_dim).
+            copies: The batch stands for this many copies of itself, for
+                the layer normalization.
         Returns:
             h, c: The hidden and cell state of the composed parent,
                 each of which has the size
@@ -913,10 +871,10 @@ class BinaryTreeLSTMLayer(nn.Module):
         hr, cr = r
 
         if self.composition_ln:
-            hl = self.left_h_ln(hl)
-            hr = self.right_h_ln(hr)
-            cl = self.left_c_ln(cl)
-            cr = self.right_c_ln(cr)
+            hl = layer_norm_positions(self.left_h_ln, hl, copies)
+            hr = layer_norm_positions(self.right_h_ln, hr, copies)
+            cl = layer_norm_positions(self.left_c_ln, cl, copies)
+            cr = layer_norm_positions(self.right_c_ln, cr, copies)
 
         hlr_cat = torch.cat([hl, hr], dim=2)
         treelstm_vector = apply_nd(fn=self.comp_linear, input=hlr_cat)
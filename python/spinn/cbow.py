@@ -7,6 +7,7 @@ import torch.nn as nn
 from torch.autograd import Variable
 
 from spinn.util.blocks import Embed, to_gpu, MLP
+from spinn.util.blocks import expand_rows, unique_rows
 from spinn.util.misc import Args, Vocab
 
 
@@ -31,6 +32,7 @@ def build_model(data_manager, initial_embeddings, vocab_size,
         num_mlp_layers=FLAGS.num_mlp_layers,
         mlp_ln=FLAGS.mlp_ln,
         context_args=context_args,
+        dedup_premises=FLAGS.dedup_premises,
     )
 
 
@@ -52,6 +54,7 @@ class BaseModel(nn.Module):
                  mlp_ln=None,
                  use_sentence_pair=False,
                  context_args=None,
+                 dedup_premises=False,
                  **kwargs
                  ):
         super(BaseModel, self).__init__()
@@ -60,6 +63,10 @@ class BaseModel(nn.Module):
         self.use_difference_feature = use_difference_feature
         self.use_product_feature = use_product_feature
 
+        # Encode each distinct premise in a batch once.
+        self.dedup_premises = dedup_premises
+        self.premise_inverse = None
+
         self.model_dim = model_dim
 
         classifier_dropout_rate = 1. - classifier_keep_rate
@@ -146,10 +153,15 @@ class BaseModel(nn.Module):
     # --- Sentence Specific ---
 
     def unwrap_sentence_pair(self, sentences, transitions):
-        sentences.shape[0]
-
         x_prem = sentences[:, :, 0]
         x_hyp = sentences[:, :, 1]
+
+        # Optionally keep one copy of each premise.
+        self.premise_inverse = None
+        if self.dedup_premises:
+            index, self.premise_inverse = unique_rows(x_prem)
+            x_prem = x_prem[index]
+
         x = np.concatenate([x_prem, x_hyp], axis=0)
 
         return to_gpu(
@@ -158,8 +170,13 @@ class BaseModel(nn.Module):
                 volatile=not self.training))
 
     def wrap_sentence_pair(self, hh):
-        batch_size = hh.size(0) // 2
-        h = ([hh[:batch_size], hh[batch_size:]])
+        if self.premise_inverse is None:
+            num_premises = hh.size(0) // 2
+        else:
+            num_premises = hh.size(0) - len(self.premise_inverse)
+        h = ([hh[:num_premises], hh[num_premises:]])
+        if self.premise_inverse is not None:
+            h[0] = expand_rows(h[0], self.premise_inverse)
         return h
 
     # --- Sentence Pair Specific ---
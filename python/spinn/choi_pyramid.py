@@ -10,6 +10,7 @@ from torch.autograd import Variable
 import torch.nn.functional as F
 
 from spinn.util.blocks import Embed, to_gpu, MLP, Linear, LayerNormalization
+from spinn.util.blocks import expand_rows, unique_rows
 from spinn.util.misc import Vocab
 
 
@@ -35,6 +36,7 @@ def build_model(data_manager, initial_embeddings, vocab_size,
         mlp_ln=FLAGS.mlp_ln,
         composition_ln=FLAGS.composition_ln,
         context_args=context_args,
+        dedup_premises=FLAGS.dedup_premises,
         trainable_temperature=FLAGS.pyramid_trainable_temperature,
     )
 
@@ -57,6 +59,7 @@ class ChoiPyramid(nn.Module):
                  mlp_ln=None,
                  composition_ln=None,
                  context_args=None,
+                 dedup_premises=False,
                  trainable_temperature=None,
                  **kwargs
                  ):
@@ -65,6 +68,12 @@ class ChoiPyramid(nn.Module):
         self.use_sentence_pair = use_sentence_pair
         self.use_difference_feature = use_difference_feature
         self.use_product_feature = use_product_feature
+
+        # Encode each distinct premise in a batch once.
+        self.dedup_premises = dedup_premises
+        self.premise_index = None
+        self.premise_inverse = None
+
         self.model_dim = model_dim
         self.trainable_temperature = trainable_temperature
 
@@ -231,19 +240,38 @@ class ChoiPyramid(nn.Module):
     def unwrap_sentence_pair(self, sentences, lengths=None):
         x_prem = sentences[:, :, 0]
         x_hyp = sentences[:, :, 1]
+
+        # Optionally keep one copy of each premise.
+        self.premise_index = None
+        self.premise_inverse = None
+        if self.dedup_premises:
+            key = x_prem if lengths is None else np.concatenate(
+                [x_prem, lengths[:, :1]], axis=1)
+            self.premise_index, self.premise_inverse = unique_rows(key)
+            x_prem = x_prem[self.premise_index]
+
         x = np.concatenate([x_prem, x_hyp], axis=0)
 
         if lengths is not None:
             len_prem = lengths[:, 0]
             len_hyp = lengths[:, 1]
+            if self.premise_index is not None:
+                len_prem = len_prem[self.premise_index]
             lengths = np.concatenate([len_prem, len_hyp], axis=0)
 
         return to_gpu(Variable(torch.from_numpy(
             x), volatile=not self.training)), lengths
 
+    def num_premises(self, num_rows):
+        if self.premise_inverse is None:
+            return num_rows // 2
+        return num_rows - len(self.premise_inverse)
+
     def wrap_sentence_pair(self, hh):
-        batch_size = hh.size(0) // 2
-        h = ([hh[:batch_size], hh[batch_size:]])
+        num_premises = self.num_premises(hh.size(0))
+        h = ([hh[:num_premises], hh[num_premises:]])
+        if self.premise_inverse is not None:
+            h[0] = expand_rows(h[0], self.premise_inverse)
         return h
 
     # --- Sentence Pair Specific ---
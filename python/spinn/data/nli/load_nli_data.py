@@ -1,11 +1,19 @@
 #!/usr/bin/env python
 
+import collections
 import json
-import codecs
+import multiprocessing
+import os
 
 SENTENCE_PAIR_DATA = True
 FIXED_VOCABULARY = None
 
+# Size of the byte ranges that the data file is split into for parsing.
+CHUNK_BYTES = 1 << 23
+
+# Ranges per worker that may be parsed ahead of the consumer.
+RANGES_AHEAD = 2
+
 LABEL_MAP = {
     "entailment": 0,
     "neutral": 1,
@@ -33,13 +41,29 @@ def convert_binary_bracketing(parse, lowercase=False):
     return tokens, transitions
 
 
-def load_data(path, lowercase=False, choose=lambda x: True, eval_mode=False):
-    print("Loading", path)
+def load_range(path, start, end, lowercase=False, choose=lambda x: True):
+    """Parse the examples whose lines start within bytes [start, end) of a
+    jsonl file, keeping only the fields used in training.
+
+    Returns the examples and the number of examples without a binary parse.
+    """
     examples = []
     failed_parse = 0
-    with codecs.open(path, encoding='utf-8') as f:
-        for line in f:
-            loaded_example = json.loads(line)
+    with open(path, 'rb') as f:
+        if start > 0:
+            # Skip the rest of a line owned by the previous range.
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            if not line.strip():
+                continue
+
+            loaded_example = json.loads(line.decode('utf-8'))
             if loaded_example["gold_label"] not in LABEL_MAP:
                 continue
 
@@ -48,8 +72,6 @@ def load_data(path, lowercase=False, choose=lambda x: True, eval_mode=False):
 
             example = {}
             example["label"] = loaded_example["gold_label"]
-            example["premise"] = loaded_example["sentence1"]
-            example["hypothesis"] = loaded_example["sentence2"]
             example["example_id"] = loaded_example.get('pairID', 'NoID')
             if loaded_example["sentence1_binary_parse"] and loaded_example["sentence2_binary_parse"]:
                 (example["premise_tokens"], example["premise_transitions"]) = convert_binary_bracketing(
@@ -59,10 +81,79 @@ def load_data(path, lowercase=False, choose=lambda x: True, eval_mode=False):
                 examples.append(example)
             else:
                 failed_parse += 1
+    return examples, failed_parse
+
+
+# Set in each worker process by init_worker.
+worker_args = None
+
+
+def init_worker(path, lowercase, choose):
+    global worker_args
+    worker_args = (path, lowercase, choose)
+
+
+def load_range_in_worker(byte_range):
+    path, lowercase, choose = worker_args
+    return load_range(path, byte_range[0], byte_range[1], lowercase, choose)
+
+
+def imap_bounded(pool, fn, items, max_pending):
+    """Like `pool.imap`, but with at most max_pending items submitted and not
+    yet consumed, so that a slow consumer does not let results pile up."""
+    pending = collections.deque()
+    for item in items:
+        if len(pending) == max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(fn, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def iter_data(path, lowercase=False, choose=lambda x: True, num_workers=1):
+    """Yield the examples of a jsonl file in file order.
+
+    The file is split into byte ranges of about CHUNK_BYTES. With num_workers
+    greater than 1, the ranges are parsed in a pool of forked processes.
+    Forking lets `choose` be any function, since it is inherited instead of
+    pickled. At most RANGES_AHEAD ranges per worker are parsed ahead of the
+    consumer.
+    """
+    print("Loading", path)
+    size = os.path.getsize(path)
+    num_ranges = max(num_workers, -(-size // CHUNK_BYTES), 1)
+    bounds = [size * i // num_ranges for i in range(num_ranges + 1)]
+    byte_ranges = list(zip(bounds[:-1], bounds[1:]))
+
+    if num_workers > 1:
+        pool = multiprocessing.get_context("fork").Pool(
+            num_workers, initializer=init_worker,
+            initargs=(path, lowercase, choose))
+        results = imap_bounded(pool, load_range_in_worker, byte_ranges,
+                               RANGES_AHEAD * num_workers)
+    else:
+        pool = None
+        results = (load_range(path, start, end, lowercase, choose)
+                   for start, end in byte_ranges)
+
+    failed_parse = 0
+    try:
+        for examples, failed in results:
+            failed_parse += failed
+            for example in examples:
+                yield example
+    finally:
+        if pool is not None:
+            pool.terminate()
+
     if failed_parse > 0:
         print((
             "Warning: Failed to convert binary parse for {} examples.".format(failed_parse)))
-    return examples
+
+
+def load_data(path, lowercase=False, choose=lambda x: True, eval_mode=False,
+              num_workers=1):
+    return list(iter_data(path, lowercase, choose, num_workers))
 
 
 if __name__ == "__main__":
@@ -11,6 +11,8 @@ import torch.nn.functional as F
 from spinn.util.blocks import Embed, Lift, MLP
 from spinn.util.blocks import to_gpu
 from spinn.util.misc import Example, Vocab
+from spinn.spinn_core_model import compose_levels, level_schedule, stack_buffers
+from spinn.spinn_core_model import validate_actions
 
 from spinn.data import T_SHIFT, T_REDUCE, T_SKIP
 
@@ -62,6 +64,10 @@ class LMS(nn.Module):
 
         # Reduce function for semantic composition.
         self.reduce = args.composition
+
+        # Compose all nodes of the same tree depth together.
+        self.level_batching = args.level_batching
+
         self.choices = np.array([T_SHIFT, T_REDUCE], dtype=np.int32)
 
     def reset_state(self):
@@ -82,6 +88,14 @@ class LMS(nn.Module):
             assert all(buf_n <= (seq_length + 1) // 2 for buf_n in self.buffers_n), \
                 "All sentences (including cropped) must be the appropriate length."
 
+        if not hasattr(example, 'transitions'):
+            # TODO: Support no transitions. In the meantime, must at least pass
+            # dummy transitions.
+            raise ValueError('Transitions must be included.')
+
+        if self.level_batching:
+            return self.run_levels(example.bufs, example.transitions)
+
         self.bufs = example.bufs
 
         # Notes on adding zeros to bufs/stacks.
@@ -104,10 +118,6 @@ class LMS(nn.Module):
         self.n_reduces = np.zeros(len(self.bufs), dtype=np.int32)
         self.n_steps = np.zeros(len(self.bufs), dtype=np.int32)
 
-        if not hasattr(example, 'transitions'):
-            # TODO: Support no transitions. In the meantime, must at least pass
-            # dummy transitions.
-            raise ValueError('Transitions must be included.')
         return self.run(example.transitions,
                         run_internal_parser=True,
                         use_internal_parser=use_internal_parser,
@@ -119,14 +129,6 @@ class LMS(nn.Module):
         buf_adjust = 1 if zero_padded else 0
         stack_adjust = 2 if zero_padded else 0
 
-        _transitions = np.array(transitions)
-        _preds = preds.copy()
-        _invalid = np.zeros(preds.shape, dtype=np.bool)
-
-        cant_skip = _transitions != T_SKIP
-        must_skip = _transitions == T_SKIP
-
-        # Fixup predicted skips.
         if len(self.choices) > 2:
             raise NotImplementedError(
                 "Can only validate actions for 2 choices right now.")
@@ -134,26 +136,15 @@ class LMS(nn.Module):
         buf_lens = [len(buf) - buf_adjust for buf in bufs]
         stack_lens = [len(stack) - stack_adjust for stack in stacks]
 
-        # Cannot reduce on too small a stack
-        must_shift = np.array([length < 2 for length in stack_lens])
-        check_mask = np.logical_and(cant_skip, must_shift)
-        _invalid += np.logical_and(_preds != T_SHIFT, check_mask)
-        _preds[must_shift] = T_SHIFT
-
-        # Cannot shift on too small buf
-        must_reduce = np.array([length < 1 for length in buf_lens])
-        check_mask = np.logical_and(cant_skip, must_reduce)
-        _invalid += np.logical_and(_preds != T_REDUCE, check_mask)
-        _preds[must_reduce] = T_REDUCE
-
-        # If the given action is skip, then must skip.
-        _preds[must_skip] = T_SKIP
-
-        return _preds, _invalid
+        _preds, _invalid = validate_actions(
+            torch.LongTensor(np.asarray(transitions, dtype=np.int64)),
+            torch.from_numpy(np.asarray(preds, dtype=np.int64)),
+            torch.LongTensor(stack_lens), torch.LongTensor(buf_lens))
+        return _preds.numpy(), _invalid.numpy().astype(bool)
 
     def predict_actions(self, transition_output):
-        transition_logdist = F.log_softmax(transition_output)
-        transition_preds = transition_logdist.data.cpu().numpy().argmax(axis=1)
+        transition_logdist = F.log_softmax(transition_output, dim=1)
+        transition_preds = transition_logdist.data.max(1)[1]
         return transition_logdist, transition_preds
 
     def get_transitions_per_example(self, style="preds"):
@@ -346,6 +337,23 @@ class LMS(nn.Module):
         return [stack[-1]
                 for stack in self.stacks], transition_acc, transition_loss
 
+    def run_levels(self, bufs, inp_transitions):
+        """Compose the given parses one tree depth at a time. See
+        `spinn_core_model.SPINN.run_levels`."""
+        batch_size = inp_transitions.shape[0]
+        bufs = stack_buffers(bufs)
+
+        levels, roots, n_nodes = level_schedule(
+            inp_transitions, self.n_tokens, bufs.size(1))
+        outputs = compose_levels(self.reduce, bufs, levels, roots, n_nodes)
+
+        self.n_reduces = (inp_transitions == T_REDUCE).sum(1).astype(np.int32)
+        self.n_steps = (inp_transitions != T_SKIP).sum(1).astype(np.int32)
+
+        self.loss_phase_hook()
+
+        return list(torch.chunk(outputs, batch_size, 0)), 0.0, None
+
 
 class BaseModel(nn.Module):
 
@@ -499,14 +507,17 @@ class BaseModel(nn.Module):
         embeds = self.lift(embeds)
 
         # Make Buffers
-        ee = torch.chunk(embeds, b * l, 0)[::-1]
-        bb = []
-        for ii in range(b):
-            ex = list(ee[ii * l:(ii + 1) * l])
-            bb.append(ex)
-        buffers = bb[::-1]
-
-        example.bufs = buffers
+        if self.lms.level_batching:
+            example.bufs = embeds.view(b, l, -1)
+        else:
+            ee = torch.chunk(embeds, b * l, 0)[::-1]
+            bb = []
+            for ii in range(b):
+                ex = list(ee[ii * l:(ii + 1) * l])
+                bb.append(ex)
+            buffers = bb[::-1]
+
+            example.bufs = buffers
 
         h, transition_acc, transition_loss = self.run_lms(
             example, use_internal_parser, validate_transitions)
@@ -1,6 +1,8 @@
 # Source: https://github.com/nyu-mll/unsupervised-treelstm/commit/bbe1946e123e396362ecd071d1673766013463f2
 # Original author of core encoder: Jihun Choi, Seoul National Univ.
 
+from functools import partial
+
 import numpy as np
 
 # PyTorch
@@ -10,8 +12,9 @@ from torch.nn import init
 from torch.autograd import Variable
 import torch.nn.functional as F
 
-from spinn.util.blocks import Embed, to_gpu, MLP, Linear, LayerNormalization
+from spinn.util.blocks import Embed, to_gpu, MLP, Linear, LayerNormalization, layer_norm_positions
 from spinn.util.misc import Args, Vocab
+from spinn.util.chart import Chart, backtrace, chart_memory
 
 
 def build_model(data_manager, initial_embeddings, vocab_size,
@@ -35,7 +38,8 @@ def build_model(data_manager, initial_embeddings, vocab_size,
                      composition_ln=FLAGS.composition_ln,
                      context_args=context_args,
                      trainable_temperature=FLAGS.pyramid_trainable_temperature,
-                     parent_selection=FLAGS.parent_selection
+                     parent_selection=FLAGS.parent_selection,
+                     chart_checkpoint=FLAGS.chart_checkpoint
                      )
 
 
@@ -58,6 +62,7 @@ class Maillard(nn.Module):
                  context_args=None,
                  trainable_temperature=None,
                  parent_selection=None,
+                 chart_checkpoint=False,
                  **kwargs
                  ):
         super(Maillard, self).__init__()
@@ -87,7 +92,8 @@ class Maillard(nn.Module):
             False,
             composition_ln=composition_ln,
             trainable_temperature=trainable_temperature,
-            parent_selection=parent_selection)
+            parent_selection=parent_selection,
+            checkpoint_rows=chart_checkpoint)
 
         mlp_input_dim = self.get_features_dim()
 
@@ -99,7 +105,8 @@ class Maillard(nn.Module):
         self.reshape_context = context_args.reshape_context
 
         # For sample printing and logging
-        self.mask_memory = None
+        self.split_memory = None
+        self.chart_memory = None
         self.inverted_vocabulary = None
         self.temperature_to_display = 0.0
 
@@ -139,10 +146,11 @@ class Maillard(nn.Module):
             Variable(torch.from_numpy(example_lengths))).long()
 
         # TODO: chunk once, pass chunked embs to tree_lstm
-        hh, _, masks, temperature = self.binary_tree_lstm(
+        hh, _, splits, temperature = self.binary_tree_lstm(
             emb, example_lengths_var, temperature_multiplier=pyramid_temperature_multiplier)
 
-        self.mask_memory = masks
+        self.split_memory = splits
+        self.chart_memory = self.binary_tree_lstm.chart_memory
 
         if self.training:
             self.temperature_to_display = temperature
@@ -186,6 +194,9 @@ class Maillard(nn.Module):
             self.inverted_vocabulary = dict(
                 [(vocabulary[key], key) for key in vocabulary])
 
+        # All the parses of the batch are followed back at once.
+        transitions = backtrace(self.split_memory.cpu().numpy(), x.shape[1])
+
         token_sequences = []
         batch_size = x.shape[0]
         for s in (range(int(self.use_sentence_pair) + 1)
@@ -198,7 +209,8 @@ class Maillard(nn.Module):
                     token_sequence = [self.inverted_vocabulary[token]
                                       for token in x[b, :]]
 
-                token_sequences.append(self.get_sample_merge_sequence(b, s, batch_size, token_sequence))
+                token_sequences.append(self.get_sample_merge_sequence(
+                    transitions[b + (s * batch_size)], token_sequence))
         return token_sequences
 
     """
@@ -211,36 +223,19 @@ class Maillard(nn.Module):
         return merge_sequence
     """
 
-    def get_sample_merge_sequence(self, b, s, batch_size, sent):
-        mask = self.mask_memory
-        index = b + (s * batch_size)
-        def compose(l, r):
-            return "( " + l + " " + r + " )"
-
-        chart = [sent]
-        choices = [sent]
-        for row in range(1, len(sent)): 
-            chart.append([])
-            choices.append([])
-            for col in range(len(sent) - row):
-                chart[row].append(None)
-                choices[row].append(None)
-        
-        for row in range(1, len(sent)): # = len(l_hiddens)
-            for col in range(len(sent) - row):
-                versions = []
-                for i in range(row):
-                    versions.append(compose(chart[row-i-1][col], chart[i][row+col-i]))
-                max_ind = torch.max(self.mask_memory[row][col], dim=1)[1][index]
-                max_ind = int(max_ind.data.cpu().numpy())
-                chart[row][col] = versions[max_ind] #.gather(1, ids.view(-1,1))
-                choices[row][col] = versions
-                l = len(versions)
-        
-        max_ind = torch.max(self.mask_memory[-1][-1], dim=1)[1][index]
-        max_ind = int(max_ind.data.cpu().numpy())
-        return choices[-1][-1][max_ind]
-    
+    def get_sample_merge_sequence(self, transitions, sent):
+        stack = []
+        tokens = list(reversed(sent))
+        for transition in transitions:
+            if transition == 0:
+                stack.append(tokens.pop())
+            else:
+                r = stack.pop()
+                l = stack.pop()
+                stack.append("( " + l + " " + r + " )")
+        assert len(stack) == 1
+        return stack[0]
+
     # --- Sentence Style Switches ---
 
     def unwrap(self, sentences, lengths=None):
@@ -288,7 +283,8 @@ class Maillard(nn.Module):
 class BinaryTreeLSTM(nn.Module):
 
     def __init__(self, word_dim, hidden_dim, intra_attention,
-                 composition_ln=False, trainable_temperature=False, parent_selection=False):
+                 composition_ln=False, trainable_temperature=False, parent_selection=False,
+                 checkpoint_rows=False):
         super(BinaryTreeLSTM, self).__init__()
         self.word_dim = word_dim
         self.hidden_dim = hidden_dim
@@ -296,6 +292,8 @@ class BinaryTreeLSTM(nn.Module):
         self.treelstm_layer = BinaryTreeLSTMLayer(
             hidden_dim, composition_ln=composition_ln)
         self.parent_selection = parent_selection
+        self.checkpoint_rows = checkpoint_rows
+        self.chart_memory = None
 
         # TODO: Add something to blocks to make this use case more elegant.
         self.comp_query = Linear()(
@@ -322,13 +320,10 @@ class BinaryTreeLSTM(nn.Module):
             mask,
             temperature_multiplier=1.0):
         """
-        (In a parallelized manner) Compute all compositions we will need 
-        for the current step.
-        Input to || computation: (h,c) l and r.
-        Input to serial computation: list of (h,c) l and r.
-        don't pass full chart around. only values that'll be needed for computation
-
-        currently: passing full sentence at each laye. FIX!!
+        Compute the states of all the spans of the sentence, one chart row
+        at a time. The children of every split of every cell in a row are
+        composed in a single call to the TreeLSTM layer, and each cell then
+        selects among its splits.
 
         Example:
         [['A', 'B', 'C', 'D', 'E', 'F', 'G', '.'],
@@ -340,88 +335,65 @@ class BinaryTreeLSTM(nn.Module):
         ['ABCDEFG', 'BCDEFG.'],
         ['ABCDEFG.']]
 
+        Returns the states of the root, and the split that every cell
+        chose, as given by `Chart.splits`.
+
         TODO: do masking to prevent composing with padding.
         """
-        # make sure are embeddigns
         h, c = state # batch, length, dim
-        mask = mask # batch, length
-
-        length = h.size(1)
-        word_hiddens = h.chunk(length, dim=1)
-        word_cells = c.chunk(length, dim=1)
-        length_masks = mask.chunk(length, dim=1) # (batch,1), ...
+        batch_size, length, _ = h.size()
         temperature = temperature_multiplier
 
-        chart = [[]]
-        all_weights = [[]]
-
-        for i in range(length):
-            chart[0].append((word_hiddens[i], word_cells[i]))
-            all_weights[0].append(None)
-        for row in range(1, length):
-            chart.append([])
-            all_weights.append([])
-            for col in range(length - row):
-                chart[row].append(None)
-                all_weights[row].append(None)
+        chart = Chart(h, c, checkpoint_rows=self.checkpoint_rows)
+        self.chart_memory = chart_memory(
+            batch_size, length, h.size(2), self.checkpoint_rows)
 
         for row in range(1, length):
-            for col in range(length - row):
-                states = []
-                hiddens = []
-                cells = []
-                scores = []
-                for i in range(row):
-                    l = chart[row-i-1][col]
-                    r = chart[i][row+col-i]
-                    states.append(self.treelstm_layer(l=l, r=r))
-                    hiddens.append(states[-1][0])
-                    cells.append(states[-1][1])
-                    #comp_weights = dot_nd(
-                    #    query=self.comp_query.weight.squeeze(),
-                    #    candidates=hiddens[-1]) # batch, 1
-                    comp_weights = cosine(
-                        query=self.comp_query.weight.squeeze(),
-                        candidates=hiddens[-1])
-                    scores.append(comp_weights) # [(batch, 1), ...]
-
-                if self.parent_selection == "right_branching":
-                    weights =  to_gpu(Variable(torch.zeros(torch.cat(scores, dim=1).size())))
-                    for k in range(weights.size(0)): 
-                        weights[k, -1] = 1.0
-                elif self.parent_selection == "uniform_branching":
-                    l = torch.cat(scores, dim=1).size(1)
-                    weights = to_gpu(Variable(torch.ones(torch.cat( scores, dim=1).size()) / l ))
-                elif self.parent_selection == "random_branching":
-                    w_rand = torch.rand(torch.cat(scores, dim=1).size())
-                    weights = to_gpu(Variable(w_rand / w_rand.sum(1).unsqueeze(1)))
-                elif self.parent_selection == "st_gumbel":
-                    weights = st_gumbel_softmax(torch.cat(scores, dim=1), temperature)
-                    # TODO: get index/mask and don;t do a linear combination.
-                elif self.parent_selection == "softmax":
-                    weights = masked_softmax(torch.cat(scores, dim=1) / temperature, None)               
-                else:
-                    weights = gumbel_softmax(torch.cat(scores, dim=1), temperature) # cat: batch, num_versions, out: batch, num_states
+            weights, = chart.fill(row, self.treelstm_layer, partial(
+                self.select_row, row=row, temperature=temperature))
+            chart.select(weights)
 
-                h_new = torch.sum(torch.mul(weights.unsqueeze(2), torch.cat(hiddens, dim=1)), dim=1)
-                c_new = torch.sum(torch.mul(weights.unsqueeze(2), torch.cat(cells, dim=1)), dim=1) # batch, num_states, dim
+        splits = chart.splits()
+        h, c = chart.root()
+        return h, c, splits
 
-                chart[row][col] = (h_new.unsqueeze(1), c_new.unsqueeze(1))
-                all_weights[row][col] = weights
-
-        # TODO: FIX, place below into above code. replace all_weights.
-        mask = [[]]
-        for i in range(length):
-            mask[0].append(None)
-        for row in range(1, length):
-            mask.append([])
-            for col in range(length - row):
-                mask[row].append(None)
+    def select_row(self, hiddens, cells, row, temperature):
+        """
+        Combine the versions of each cell in a chart row, from the
+        candidates of all of its splits. Returns the states of the row and
+        the weights of the versions.
+        """
+        batch_size = hiddens.size(0)
+        n_cols = hiddens.size(1) // row
+        hiddens = hiddens.view(batch_size, n_cols, row, -1)
+        cells = cells.view(batch_size, n_cols, row, -1)
+
+        scores = chart_cosine(
+            query=self.comp_query.weight.squeeze(),
+            candidates=hiddens)
+        scores = scores.view(-1, row) # batch * n_cols, num_versions
+
+        if self.parent_selection == "right_branching":
+            weights = torch.zeros(scores.size())
+            weights[:, -1] = 1.0
+            weights = to_gpu(Variable(weights))
+        elif self.parent_selection == "uniform_branching":
+            weights = to_gpu(Variable(torch.ones(scores.size()) / row))
+        elif self.parent_selection == "random_branching":
+            w_rand = torch.rand(scores.size())
+            weights = to_gpu(Variable(w_rand / w_rand.sum(1).unsqueeze(1)))
+        elif self.parent_selection == "st_gumbel":
+            weights = st_gumbel_softmax(scores, temperature)
+            # TODO: get index/mask and don;t do a linear combination.
+        elif self.parent_selection == "softmax":
+            weights = masked_softmax(scores / temperature, None)
+        else:
+            weights = gumbel_softmax(scores, temperature)
 
-        for row in range(1, length):
-            for col in range(length - row):
-                mask[row][col] = create_max_mask(all_weights[row][col])
-        return chart[length-1][0][0], chart[length-1][0][1], mask
+        version_weights = weights.view(batch_size, n_cols, row, 1)
+        h_new = torch.sum(torch.mul(version_weights, hiddens), dim=2)
+        c_new = torch.sum(torch.mul(version_weights, cells), dim=2) # batch, n_cols, dim
+        return h_new, c_new, weights
 
 
     def forward(self, input, length, temperature_multiplier=None):
@@ -439,7 +411,7 @@ class BinaryTreeLSTM(nn.Module):
             nodes.append(state[0])
         """
 
-        h, c, masks = self.compute_compositions(state, length_mask, temperature_multiplier)
+        h, c, splits = self.compute_compositions(state, length_mask, temperature_multiplier)
         
         """
         if self.intra_attention:
@@ -461,7 +433,7 @@ class BinaryTreeLSTM(nn.Module):
             h = (att_weights_expand * nodes).sum(1)
         """
         assert h.size(1) == 1 and c.size(1) == 1
-        return h.squeeze(1), c.squeeze(1), masks, temperature_to_display
+        return h.squeeze(1), c.squeeze(1), splits, temperature_to_display
 
 
 def apply_nd(fn, input):
@@ -522,6 +494,27 @@ def cosine(query, candidates):
     return output
 
 
+def chart_cosine(query, candidates):
+    """
+    Apply `cosine` to each version of each cell of a chart row on its own,
+    so that the norm of the candidates is taken over the batch.
+
+    Args:
+        query (Variable): A vector to query, whose size is
+            (query_dim,)
+        candidates (Variable): The hidden states of a chart row, whose size
+            is (batch_size, num_cells, num_versions, query_dim)
+
+    Returns:
+        output: The cosines, whose size is
+            (batch_size, num_cells, num_versions)
+    """
+
+    dots = torch.matmul(candidates, query)
+    norms = candidates.pow(2).sum(3).sum(0).sqrt()
+    return dots / (norms * torch.norm(query))
+
+
 def convert_to_one_hot(indices, num_classes):
     """
     Args:
@@ -672,10 +665,10 @@ class BinaryTreeLSTMLayer(nn.Module):
         hr, cr = r
 
         if self.composition_ln:
-            hl = self.left_h_ln(hl)
-            hr = self.right_h_ln(hr)
-            cl = self.left_c_ln(cl)
-            cr = self.right_c_ln(cr)
+            hl = layer_norm_positions(self.left_h_ln, hl)
+            hr = layer_norm_positions(self.right_h_ln, hr)
+            cl = layer_norm_positions(self.left_c_ln, cl)
+            cr = layer_norm_positions(self.right_c_ln, cr)
 
         hlr_cat = torch.cat([hl, hr], dim=2)
         treelstm_vector = apply_nd(fn=self.comp_linear, input=hlr_cat)
@@ -100,12 +100,18 @@ def get_data_manager(data_type):
     return data_manager
 
 
-def load_data_and_embeddings(
+def preprocess_data(
         FLAGS,
         data_manager,
         logger,
         training_data_path,
         eval_data_path):
+    """Load the raw data, build the vocabulary, and preprocess every dataset.
+
+    Returns:
+        vocabulary, training_data (None in expanded_eval_only_mode) and a list
+        of (filename, eval_data) pairs.
+    """
 
     def choose_train(x): return True
     if FLAGS.train_genre is not None:
@@ -115,16 +121,23 @@ def load_data_and_embeddings(
     if FLAGS.eval_genre is not None:
         def choose_eval(x): return x.get('genre') == FLAGS.eval_genre
 
+    # Only the nli loader parses in parallel.
+    load_kwargs = {}
+    if FLAGS.data_type == "nli" and FLAGS.data_workers > 1:
+        load_kwargs["num_workers"] = FLAGS.data_workers
+
     if not FLAGS.expanded_eval_only_mode:
         raw_training_data = data_manager.load_data(
-            training_data_path, FLAGS.lowercase, eval_mode=False)
+            training_data_path, FLAGS.lowercase, eval_mode=False,
+            **load_kwargs)
     else:
         raw_training_data = None
 
     raw_eval_sets = []
     for path in eval_data_path.split(':'):
         raw_eval_data = data_manager.load_data(
-            path, FLAGS.lowercase, choose_eval, eval_mode=True)
+            path, FLAGS.lowercase, choose_eval, eval_mode=True,
+            **load_kwargs)
         raw_eval_sets.append((path, raw_eval_data))
 
     # Prepare the vocabulary.
@@ -139,15 +152,6 @@ def load_data_and_embeddings(
         vocabulary = data_manager.FIXED_VOCABULARY
         logger.Log("In fixed vocabulary mode. Training embeddings from scratch.")
 
-    # Load pretrained embeddings.
-    if FLAGS.embedding_data_path:
-        logger.Log("Loading vocabulary with " + str(len(vocabulary))
-                   + " words from " + FLAGS.embedding_data_path)
-        initial_embeddings = util.LoadEmbeddingsFromText(
-            vocabulary, FLAGS.word_embedding_dim, FLAGS.embedding_data_path)
-    else:
-        initial_embeddings = None
-
     # Trim dataset, convert token sequences to integer sequences, crop, and
     # pad.
     logger.Log("Preprocessing training data.")
@@ -162,17 +166,12 @@ def load_data_and_embeddings(
             sentence_pair_data=data_manager.SENTENCE_PAIR_DATA,
             simple=sequential_only(),
             allow_cropping=FLAGS.allow_cropping,
-            pad_from_left=pad_from_left()) if raw_training_data is not None else None
-        training_data_iter = util.MakeTrainingIterator(
-            training_data, FLAGS.batch_size, FLAGS.smart_batching, FLAGS.use_peano,
-            sentence_pair_data=data_manager.SENTENCE_PAIR_DATA) if raw_training_data is not None else None
-        training_data_length = len(training_data[0])
+            pad_from_left=pad_from_left())
     else:
-        training_data_iter = None
-        training_data_length = 0
+        training_data = None
 
     # Preprocess eval sets.
-    eval_iterators = []
+    eval_sets = []
     for filename, raw_eval_set in raw_eval_sets:
         logger.Log("Preprocessing eval data: " + filename)
         eval_data = util.PreprocessDataset(
@@ -182,16 +181,92 @@ def load_data_and_embeddings(
             sentence_pair_data=data_manager.SENTENCE_PAIR_DATA,
             simple=sequential_only(),
             allow_cropping=FLAGS.allow_eval_cropping, pad_from_left=pad_from_left())
+        eval_sets.append((filename, eval_data))
+
+    return vocabulary, training_data, eval_sets
+
+
+def load_data_and_embeddings(
+        FLAGS,
+        data_manager,
+        logger,
+        training_data_path,
+        eval_data_path):
+
+    cache_path = None
+    if FLAGS.data_cache_path:
+        data_paths = eval_data_path.split(':')
+        if not FLAGS.expanded_eval_only_mode:
+            data_paths = [training_data_path] + data_paths
+        cache_key = util.DatasetCacheKey(
+            data_paths,
+            FLAGS.embedding_data_path,
+            data_type=FLAGS.data_type,
+            expanded_eval_only_mode=FLAGS.expanded_eval_only_mode,
+            lowercase=FLAGS.lowercase,
+            train_genre=FLAGS.train_genre,
+            eval_genre=FLAGS.eval_genre,
+            seq_length=FLAGS.seq_length,
+            eval_seq_length=FLAGS.eval_seq_length,
+            allow_cropping=FLAGS.allow_cropping,
+            allow_eval_cropping=FLAGS.allow_eval_cropping,
+            simple=sequential_only(),
+            pad_from_left=pad_from_left())
+        cache_path = os.path.join(FLAGS.data_cache_path, cache_key)
+
+    if cache_path is not None and os.path.exists(cache_path):
+        logger.Log("Loading preprocessed data from " + cache_path)
+        vocabulary, training_data, eval_sets = util.LoadCachedDataset(
+            cache_path)
+    else:
+        vocabulary, training_data, eval_sets = preprocess_data(
+            FLAGS, data_manager, logger, training_data_path, eval_data_path)
+        if cache_path is not None:
+            logger.Log("Caching preprocessed data in " + cache_path)
+            if not os.path.exists(FLAGS.data_cache_path):
+                os.makedirs(FLAGS.data_cache_path)
+            util.SaveCachedDataset(
+                cache_path, vocabulary, training_data, eval_sets)
+
+    # Load pretrained embeddings.
+    if FLAGS.embedding_data_path:
+        logger.Log("Loading vocabulary with " + str(len(vocabulary))
+                   + " words from " + FLAGS.embedding_data_path)
+        initial_embeddings = util.LoadEmbeddings(
+            vocabulary, FLAGS.word_embedding_dim, FLAGS.embedding_data_path)
+    else:
+        initial_embeddings = None
+
+    if training_data is not None:
+        training_data_iter = util.MakeTrainingIterator(
+            training_data, FLAGS.batch_size, FLAGS.smart_batching, FLAGS.use_peano,
+            sentence_pair_data=data_manager.SENTENCE_PAIR_DATA,
+            num_splits=FLAGS.smart_batching_splits,
+            token_budget=FLAGS.batch_token_budget)
+        training_epoch_length = util.TrainingEpochLength(
+            training_data, FLAGS.batch_size,
+            num_splits=FLAGS.smart_batching_splits,
+            token_budget=FLAGS.batch_token_budget)
+        mean_batch_size = len(training_data[0]) / \
+            float(max(1, training_epoch_length))
+    else:
+        training_data_iter = None
+        training_epoch_length = 0
+        mean_batch_size = FLAGS.batch_size
+
+    eval_iterators = []
+    for filename, eval_data in eval_sets:
         eval_it = util.MakeEvalIterator(
             eval_data,
             FLAGS.batch_size,
             FLAGS.eval_data_limit,
             bucket_eval=FLAGS.bucket_eval,
             shuffle=FLAGS.shuffle_eval,
-            rseed=FLAGS.shuffle_eval_seed)
+            rseed=FLAGS.shuffle_eval_seed,
+            token_budget=FLAGS.batch_token_budget)
         eval_iterators.append((filename, eval_it))
 
-    return vocabulary, initial_embeddings, training_data_iter, eval_iterators, training_data_length
+    return vocabulary, initial_embeddings, training_data_iter, eval_iterators, training_epoch_length, mean_batch_size
 
 
 def get_flags():
@@ -280,7 +355,25 @@ def get_flags():
         "smart_batching",
         True,
         "Organize batches using sequence length.")
+    gflags.DEFINE_integer(
+        "smart_batching_splits",
+        10,
+        "Number of random splits of the training set that are each sorted by "
+        "length before being cut into batches. More splits give more random "
+        "batches, fewer give less padding.")
     gflags.DEFINE_boolean("use_peano", True, "A mind-blowing sorting key.")
+    gflags.DEFINE_integer(
+        "batch_token_budget",
+        0,
+        "If greater than 0, batch training (and bucketed eval) examples by "
+        "length and fill each batch up to this many padded transitions, "
+        "counted as batch rows times the longest num_transitions in the "
+        "batch, instead of using a fixed batch_size.")
+    gflags.DEFINE_integer(
+        "prefetch_batches",
+        0,
+        "If greater than 0, gather and truncate this many upcoming training "
+        "batches in a background thread while the model trains.")
     gflags.DEFINE_integer(
         "eval_data_limit",
         None,
@@ -294,8 +387,13 @@ def get_flags():
         "shuffle_eval_seed",
         123,
         "Seed shuffling of eval data.")
+    gflags.DEFINE_string(
+        "data_cache_path", None, "If set, cache the vocabulary and "
+        "preprocessed datasets in this directory, keyed by the data files and "
+        "preprocessing settings, and reuse them in later runs.")
     gflags.DEFINE_string("embedding_data_path", None,
-                         "If set, load GloVe-formatted embeddings from here.")
+                         "If set, load GloVe-formatted embeddings from here. Can also "
+                         "be a store written by scripts/convert_embeddings.py.")
     gflags.DEFINE_boolean("fine_tune_loaded_embeddings", False,
                           "If set, backpropagate into embeddings even when initializing from pretrained.")
 
@@ -308,6 +406,11 @@ def get_flags():
     gflags.DEFINE_integer("model_dim", 8, "")
     gflags.DEFINE_integer("word_embedding_dim", 8, "")
     gflags.DEFINE_boolean("lowercase", False, "When True, ignore case.")
+    gflags.DEFINE_integer(
+        "data_workers",
+        1,
+        "Parse nli data files in this many processes. Ignored for other "
+        "data types.")
     gflags.DEFINE_boolean("use_internal_parser", False, "Use predicted parse.")
     gflags.DEFINE_boolean(
         "validate_transitions",
@@ -319,6 +422,13 @@ def get_flags():
         "Used for dropout on transformed embeddings and in the encoder RNN.")
     gflags.DEFINE_boolean("use_difference_feature", True, "")
     gflags.DEFINE_boolean("use_product_feature", True, "")
+    gflags.DEFINE_boolean(
+        "dedup_premises",
+        False,
+        "In sentence pair batches, encode each distinct premise once and "
+        "share its encoding between the hypotheses that use it. Used by "
+        "CBOW and RNN, and by SPINN and ChoiPyramid without composition_ln "
+        "or tracking_ln. Turned off when sampling or writing eval reports.")
 
     # SPINN tracking LSTM settings.
     gflags.DEFINE_integer(
@@ -345,6 +455,25 @@ def get_flags():
         "When True, layer normalization is used in TreeLSTM composition.")
     gflags.DEFINE_boolean("predict_use_cell", True,
                           "Use cell output as feature for transition net.")
+    gflags.DEFINE_boolean(
+        "thin_stack",
+        False,
+        "When True, SPINN keeps its buffers and stacks as batched tensors "
+        "addressed by pointers instead of per-example lists.")
+    gflags.DEFINE_boolean(
+        "level_batching",
+        False,
+        "When parses are given and there is no tracker, compose all nodes "
+        "of the same tree depth in one call. Applies to SPINN and LMS. With "
+        "composition_ln, layer norm statistics are taken over each depth "
+        "instead of each step.")
+    gflags.DEFINE_integer(
+        "subtree_cache_size",
+        0,
+        "If > 0, SPINN keeps up to this many subtree encodings during "
+        "evaluation and reuses them for repeated subtrees. Only used with "
+        "the projection or pass encoders and without "
+        "use_tracking_in_composition or composition_ln.")
 
     # SPINN composition function settings.
     gflags.DEFINE_enum(
@@ -391,8 +520,14 @@ def get_flags():
                        ["ema",
                         "pass",
                         "greedy",
-                        "value"],
-                       "Different configurations to approximate reward function.")
+                        "value",
+                        "loo"],
+                       "Different configurations to approximate reward function. "
+                       "\"loo\" uses the mean reward of the other rollouts of each example.")
+    gflags.DEFINE_integer(
+        "rl_num_samples",
+        1,
+        "Number of parses sampled for each training example, run together in one batch.")
     gflags.DEFINE_integer("rl_value_size", 128, "Size of MLP used in rl baseline \"value\"")
     gflags.DEFINE_integer("rl_value_lstm", 100, "Size of LSTM used in rl basline \"value\"")
     gflags.DEFINE_enum("rl_reward", "standard", ["standard", "xent"],
@@ -505,6 +640,17 @@ def get_flags():
         "eval_report_use_preds", True, "If False, use the given transitions in the report, "
         "otherwise use predicted transitions. Note that when predicting transitions but not using them, the "
         "reported predictions will look very odd / not valid.")  # TODO: Remove.
+    gflags.DEFINE_boolean(
+        "lean_eval",
+        False,
+        "Evaluate SPINN without autograd and without keeping its per-step "
+        "memories. Transition accuracy and loss are not computed unless "
+        "lean_eval_transition_stats is set.")
+    gflags.DEFINE_boolean(
+        "lean_eval_transition_stats",
+        False,
+        "With lean_eval, still keep the predicted and given transitions. "
+        "Turned on when writing eval reports or sampling parses.")
 
     # Chart-Parsing Variables
     gflags.DEFINE_boolean(
@@ -534,6 +680,12 @@ def get_flags():
         "enforce_right",
         False,
         "Use right branching trees, don't run through Chart-Parser.")
+    gflags.DEFINE_boolean(
+        "chart_checkpoint",
+        False,
+        "For Maillard and CatalanPyramid, keep only the chart states for "
+        "backprop, and compute the candidates of each chart row again during "
+        "the backward pass.")
 
     gflags.DEFINE_boolean(
         "save_all_ckpts", 
@@ -544,7 +696,13 @@ def get_flags():
     gflags.DEFINE_boolean(
         "mp", 
         False, 
-        "Use multiprocessing with chart-parser")
+        "Fill each chart row of the chart-parser on a pool of worker threads.")
+    gflags.DEFINE_integer(
+        "mp_workers",
+        0,
+        "Number of worker threads for --mp. Each worker's ops also use "
+        "torch's intra-op threads, so keep this small. 0 uses "
+        "torch.get_num_threads().")
 
 def flag_defaults(FLAGS, load_log_flags=False):
     if load_log_flags:
@@ -589,6 +747,21 @@ def flag_defaults(FLAGS, load_log_flags=False):
     if FLAGS.model_type in ["CBOW", "RNN", "ChoiPyramid", "LMS", "Maillard", "CatalanPyramid"]:
         FLAGS.num_samples = 0
 
+    if FLAGS.num_samples > 0 or FLAGS.write_eval_report:
+        # Sampled and reported parses are looked up by example.
+        FLAGS.dedup_premises = False
+
+    if (FLAGS.model_type in ["SPINN", "ChoiPyramid"] and FLAGS.composition_ln) or (
+            FLAGS.model_type == "SPINN" and FLAGS.tracking_ln):
+        # Layer normalization takes its statistics over the whole batch, so
+        # dropping duplicate premises would change the encodings.
+        FLAGS.dedup_premises = False
+
+    if FLAGS.write_eval_report or (
+            FLAGS.model_type in ["SPINN", "RLSPINN"] and FLAGS.use_internal_parser):
+        # Reports and samples read the transitions back from SPINN.
+        FLAGS.lean_eval_transition_stats = True
+
     if FLAGS.model_type == "LMS":
         FLAGS.reduce = "lms"
 
@@ -674,6 +847,19 @@ def init_model(
     composition_args.tracker_size = FLAGS.tracking_lstm_hidden_dim
     composition_args.use_internal_parser = FLAGS.use_internal_parser
     composition_args.transition_weight = FLAGS.transition_weight
+    composition_args.thin_stack = FLAGS.thin_stack
+    composition_args.level_batching = FLAGS.level_batching
+    # Layer normalization takes its statistics over the whole reduce batch,
+    # so that an encoding also depends on the subtrees reduced with it.
+    batch_ln = FLAGS.composition_ln or (
+        FLAGS.use_tracking_in_composition and FLAGS.tracking_ln)
+    if FLAGS.encode in ["projection", "pass"] and \
+            not FLAGS.use_tracking_in_composition and not batch_ln:
+        composition_args.subtree_cache_size = FLAGS.subtree_cache_size
+    else:
+        composition_args.subtree_cache_size = 0
+    composition_args.lean_eval = FLAGS.lean_eval
+    composition_args.lean_eval_transition_stats = FLAGS.lean_eval_transition_stats
     composition_args.wrap_items = lambda x: torch.cat(x, 0)
     composition_args.extract_h = lambda x: x
 
@@ -9,13 +9,13 @@ import gflags
 import numpy as np
 
 from spinn.util import afs_safe_logger
-from spinn.util.data import SimpleProgressBar
+from spinn.util.data import PrefetchIterator, SimpleProgressBar
 from spinn.util.blocks import to_gpu
 from spinn.util.misc import Accumulator, EvalReporter
 from spinn.util.logging import stats, train_accumulate, create_log_formatter
 from spinn.util.logging import train_rl_accumulate
 from spinn.util.logging import eval_stats, eval_accumulate, prettyprint_trees
-from spinn.util.loss import auxiliary_loss
+from spinn.util.loss import auxiliary_loss, batch_size_loss_scale
 from spinn.util.sparks import sparks, dec_str
 import spinn.util.evalb as evalb
 import spinn.util.logging_pb2 as pb
@@ -181,7 +181,8 @@ def train_loop(
         training_data_iter,
         eval_iterators,
         logger,
-	vocabulary):
+	vocabulary,
+        mean_batch_size=None):
     # Accumulate useful statistics.
     A = Accumulator(maxlen=FLAGS.deque_length)
 
@@ -193,6 +194,13 @@ def train_loop(
         msg="Training", bar_length=60, enabled=FLAGS.show_progress_bar)
     progress_bar.step(i=0, total=FLAGS.statistics_interval_steps)
 
+    # Optionally gather and truncate upcoming batches in the background.
+    if FLAGS.prefetch_batches > 0:
+        training_batches = PrefetchIterator(
+            training_data_iter, get_batch, depth=FLAGS.prefetch_batches)
+    else:
+        training_batches = map(get_batch, training_data_iter)
+
     log_entry = pb.SpinnEntry()
     for _ in range(trainer.step, FLAGS.training_steps):
         if (trainer.step - trainer.best_dev_step) > FLAGS.early_stopping_steps_to_wait:
@@ -208,9 +216,11 @@ def train_loop(
 
         start = time.time()
 
-        batch = get_batch(next(training_data_iter))
+        batch = next(training_batches)
         X_batch, transitions_batch, y_batch, num_transitions_batch, train_ids = batch
 
+        data_time = time.time() - start
+
         total_tokens = sum(
             [(nt + 1) / 2 for nt in num_transitions_batch.reshape(-1)])
 
@@ -245,8 +255,10 @@ def train_loop(
                        validate_transitions=FLAGS.validate_transitions
                        )
         
-        # Calculate class accuracy.
+        # Calculate class accuracy. With several rollouts per example, each
+        # rollout is classified separately.
         target = torch.from_numpy(y_batch).long()
+        target = target.repeat(output.size(0) // target.size(0))
 
         # get the index of the max log-probability
         pred = output.data.max(1, keepdim=False)[1].cpu()
@@ -268,6 +280,12 @@ def train_loop(
         aux_loss = auxiliary_loss(model)
         total_loss += aux_loss
 
+        if FLAGS.batch_token_budget > 0:
+            # Budget batches of long examples hold fewer rows, so that the
+            # batch means would weigh each long example more.
+            total_loss = total_loss * batch_size_loss_scale(
+                len(y_batch), mean_batch_size)
+
         # Backward pass.
         total_loss.backward()
 
@@ -285,6 +303,7 @@ def train_loop(
         A.add('class_acc', class_acc)
         A.add('total_tokens', total_tokens)
         A.add('total_time', total_time)
+        A.add('data_time', data_time)
 
         train_rl_accumulate(model, A, batch)
 
@@ -323,7 +342,7 @@ def train_loop(
 
             # This could be done prior to running the batch for a tiny speed
             # boost.
-            t_idxs = list(range(FLAGS.num_samples))
+            t_idxs = list(range(len(y_batch)))
             random.shuffle(t_idxs)
             t_idxs = sorted(t_idxs[:FLAGS.num_samples])
             for t_idx in t_idxs:
@@ -378,7 +397,7 @@ def run(only_forward=False):
                json.dumps(FLAGS.FlagValuesDict(), indent=4, sort_keys=True))
 
     # Get Data and Embeddings
-    vocabulary, initial_embeddings, training_data_iter, eval_iterators, training_data_length = \
+    vocabulary, initial_embeddings, training_data_iter, eval_iterators, training_epoch_length, mean_batch_size = \
         load_data_and_embeddings(FLAGS, data_manager, logger,
                                  FLAGS.training_data_path, FLAGS.eval_data_path)
 
@@ -394,7 +413,7 @@ def run(only_forward=False):
         num_classes,
         data_manager,
         header)
-    time_to_wait_to_lower_lr = min(10000, int(training_data_length / FLAGS.batch_size))
+    time_to_wait_to_lower_lr = min(10000, training_epoch_length)
     trainer = ModelTrainer(model, logger, time_to_wait_to_lower_lr, vocabulary, FLAGS) 
     
     header.start_step = trainer.step
@@ -426,7 +445,8 @@ def run(only_forward=False):
             training_data_iter,
             eval_iterators,
             logger,
-            vocabulary)
+            vocabulary,
+            mean_batch_size)
 
 
 if __name__ == '__main__':
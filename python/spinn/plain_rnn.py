@@ -8,6 +8,7 @@ from torch.autograd import Variable
 import torch.nn.functional as F
 
 from spinn.util.blocks import Embed, to_gpu, MLP
+from spinn.util.blocks import expand_rows, unique_rows
 from spinn.util.misc import Args, Vocab
 
 
@@ -32,6 +33,7 @@ def build_model(data_manager, initial_embeddings, vocab_size,
         num_mlp_layers=FLAGS.num_mlp_layers,
         mlp_ln=FLAGS.mlp_ln,
         context_args=context_args,
+        dedup_premises=FLAGS.dedup_premises,
     )
 
 
@@ -52,6 +54,7 @@ class RNNModel(nn.Module):
                  num_mlp_layers=None,
                  mlp_ln=None,
                  context_args=None,
+                 dedup_premises=False,
                  **kwargs
                  ):
         super(RNNModel, self).__init__()
@@ -60,6 +63,10 @@ class RNNModel(nn.Module):
         self.use_difference_feature = use_difference_feature
         self.use_product_feature = use_product_feature
 
+        # Encode each distinct premise in a batch once.
+        self.dedup_premises = dedup_premises
+        self.premise_inverse = None
+
         self.model_dim = model_dim
 
         classifier_dropout_rate = 1. - classifier_keep_rate
@@ -189,6 +196,13 @@ class RNNModel(nn.Module):
     def unwrap_sentence_pair(self, sentences, transitions):
         x_prem = sentences[:, :, 0]
         x_hyp = sentences[:, :, 1]
+
+        # Optionally keep one copy of each premise.
+        self.premise_inverse = None
+        if self.dedup_premises:
+            index, self.premise_inverse = unique_rows(x_prem)
+            x_prem = x_prem[index]
+
         x = np.concatenate([x_prem, x_hyp], axis=0)
 
         return to_gpu(
@@ -197,8 +211,13 @@ class RNNModel(nn.Module):
                 volatile=not self.training))
 
     def wrap_sentence_pair(self, hh):
-        batch_size = hh.size(0) // 2
-        h = ([hh[:batch_size], hh[batch_size:]])
+        if self.premise_inverse is None:
+            num_premises = hh.size(0) // 2
+        else:
+            num_premises = hh.size(0) - len(self.premise_inverse)
+        h = ([hh[:num_premises], hh[num_premises:]])
+        if self.premise_inverse is not None:
+            h[0] = expand_rows(h[0], self.premise_inverse)
         return h
 
     # --- Sentence Pair Specific ---
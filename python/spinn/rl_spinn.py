@@ -1,5 +1,3 @@
-import copy
-
 import numpy as np
 
 # PyTorch
@@ -9,7 +7,7 @@ from torch.autograd import Variable
 import torch.nn.functional as F
 
 from spinn.util.blocks import MLP
-from spinn.util.blocks import the_gpu, to_gpu
+from spinn.util.blocks import no_grad, to_gpu
 
 from spinn.spinn_core_model import BaseModel as _BaseModel
 from spinn.spinn_core_model import SPINN
@@ -26,6 +24,9 @@ def build_model(data_manager, initial_embeddings, vocab_size,
     assert FLAGS.use_tracking_in_composition or not FLAGS.tracking_lstm_hidden_dim or (FLAGS.tracking_lstm_hidden_dim and not FLAGS.lateral_tracking and not FLAGS.predict_use_cell), \
         "You appear to want to train an RNN using only RL gradients. This is well defined, but it is nonetheless a terrible idea."
 
+    assert FLAGS.rl_baseline != "loo" or FLAGS.rl_num_samples > 1, \
+        "The leave-one-out baseline needs several rollouts of each example (--rl_num_samples > 1)."
+
     return model_cls(
         model_dim=FLAGS.model_dim,
         word_embedding_dim=FLAGS.word_embedding_dim,
@@ -58,11 +59,25 @@ def build_model(data_manager, initial_embeddings, vocab_size,
         rl_transition_acc_as_reward=FLAGS.rl_transition_acc_as_reward,
         rl_value_size=FLAGS.rl_value_size,
         rl_value_lstm=FLAGS.rl_value_lstm,
+        rl_num_samples=FLAGS.rl_num_samples,
         context_args=context_args,
         composition_args=composition_args,
     )
 
 
+def share_parameters(module, source):
+    """Make `module` use the parameters and buffers of `source`, a module
+    with the same architecture. Submodules of `source` that `module` does
+    not have are ignored."""
+    source_modules = dict(source.named_modules())
+    for name, submodule in module.named_modules():
+        source_submodule = source_modules[name]
+        for key in submodule._parameters:
+            submodule._parameters[key] = source_submodule._parameters[key]
+        for key in submodule._buffers:
+            submodule._buffers[key] = source_submodule._buffers[key]
+
+
 class RLSPINN(SPINN):
     temperature = 1.0
     catalan = True
@@ -75,11 +90,9 @@ class RLSPINN(SPINN):
 
         if self.catalan:
             # Use the catalan distribution as a prior.
-            p_shift_catalan = [
-                self.shift_probabilities.prob(
-                    n_red, n_step, n_tok) for n_red, n_step, n_tok in zip(
-                    self.n_reduces, self.n_steps, self.n_tokens)]
-            p_shift_catalan = torch.FloatTensor(p_shift_catalan).view(-1, 1)
+            p_shift_catalan = self.shift_probabilities.probs(
+                self.n_reduces, self.n_steps, self.n_tokens)
+            p_shift_catalan = torch.from_numpy(p_shift_catalan).view(-1, 1)
             p_catalan = torch.cat([p_shift_catalan, 1. - p_shift_catalan], 1)
             p_catalan = to_gpu(Variable(p_catalan))
 
@@ -94,13 +107,11 @@ class RLSPINN(SPINN):
         shift_probs = transition_dist.data[:, 0]
 
         if self.training:
-            np_shift_probs = shift_probs.cpu().numpy()
-            transition_preds = (np.random.rand(
-                *np_shift_probs.shape) > np_shift_probs).astype('int32')
+            transition_preds = (shift_probs.new(
+                shift_probs.size()).uniform_() > shift_probs).long()
         else:
             # Greedy prediction
-            transition_preds = torch.round(
-                1 - shift_probs).cpu().numpy().astype('int32')
+            transition_preds = (shift_probs < 0.5).long()
         return transition_logdist, transition_preds
 
 
@@ -121,10 +132,12 @@ class BaseModel(_BaseModel):
                  rl_transition_acc_as_reward=None,
                  rl_value_size=None,
                  rl_value_lstm=None,
+                 rl_num_samples=1,
                  **kwargs):
         super(BaseModel, self).__init__(**kwargs)
 
         self.kwargs = kwargs
+        self._greedy_model = None
 
         self.rl_mu = rl_mu
         self.rl_baseline = rl_baseline
@@ -134,6 +147,7 @@ class BaseModel(_BaseModel):
         self.rl_valid = rl_valid
         self.rl_value_size = rl_value_size
         self.rl_value_lstm = rl_value_lstm
+        self.rl_num_samples = rl_num_samples
         self.spinn.catalan = rl_catalan
         self.spinn.catalan_backprop = rl_catalan_backprop
         self.rl_transition_acc_as_reward = rl_transition_acc_as_reward
@@ -184,24 +198,29 @@ class BaseModel(_BaseModel):
                 #import pdb; pdb.set_trace()
 
     def run_greedy(self, sentences, transitions):
-        inference_model_cls = BaseModel
+        with no_grad():
+            outputs = self.greedy_model()(sentences, transitions,
+                                          use_internal_parser=True,
+                                          validate_transitions=True)
+        return outputs
 
-        # HACK: This is a pretty simple way to create the inference time version of SPINN.
-        # The reason a copy is necessary is because there is some retained state in the
-        # memories and loss variables that break deep copy.
-        inference_model = inference_model_cls(**self.kwargs)
-        inference_model.load_state_dict(copy.deepcopy(self.state_dict()))
-        inference_model.eval()
+    def greedy_model(self):
+        """The inference time version of this model, used for the greedy
+        baseline. It is built once and uses the parameters of this model, so
+        it always runs with the current weights."""
+        if self._greedy_model is None:
+            greedy_model = BaseModel(**self.kwargs)
+            share_parameters(greedy_model, self)
+            greedy_model.eval()
 
-        if the_gpu.gpu >= 0:
-            inference_model.cuda()
-        else:
-            inference_model.cpu()
+            # Only the outputs are used.
+            greedy_model.spinn.lean_eval = True
+            greedy_model.spinn.lean_eval_transition_stats = False
+            greedy_model.spinn.subtree_cache = None
 
-        outputs = inference_model(sentences, transitions,
-                                  use_internal_parser=True,
-                                  validate_transitions=True)
-        return outputs
+            # Not a submodule, so that it stays out of the state dict.
+            object.__setattr__(self, '_greedy_model', greedy_model)
+        return self._greedy_model
 
     def build_reward(self, probs, target, rl_reward="standard"):
         if rl_reward == "standard":  # Zero One Loss.
@@ -252,84 +271,78 @@ class BaseModel(_BaseModel):
                 raise NotImplementedError
 
             baseline = baseline.data.cpu()
+        elif self.rl_baseline == "loo":
+            # Mean reward of the other rollouts of the same example.
+            num_samples = self.rl_num_samples
+            rollouts = rewards.view(num_samples, -1)
+            baseline = (rollouts.sum(0, keepdim=True) - rollouts) / \
+                (num_samples - 1)
+            baseline = baseline.view(-1)
         else:
             raise NotImplementedError
 
         return baseline
 
     def reinforce(self, advantage):
-        """
-        t_preds  = 200...111 (flattened predictions from sub_batches 1...N)
-        t_mask   = 011...111 (binary mask, selecting non-skips only)
-        t_logprobs = (B*N)xC (tensor of sub_batch_size * sub_num_batches x transition classes)
-        a_index  = 011...(N-1)(N-1)(N-1) (masked sub_batch_indices for each transition)
-        t_index  = 013...(B*N-3)(B*N-2)(B*N-1) (masked indices across all sub_batches)
-        """
-
-        # TODO: Many of these ops are on the cpu. Might be worth shifting to
-        # GPU.
-        t_preds = np.concatenate([m['t_preds']
-                                  for m in self.spinn.memories if 't_preds' in m])
-        t_mask = np.concatenate([m['t_mask']
-                                 for m in self.spinn.memories if 't_mask' in m])
-        t_valid_mask = np.concatenate(
-            [m['t_valid_mask'] for m in self.spinn.memories if 't_mask' in m])
-        t_logprobs = torch.cat(
-            [m['t_logprobs'] for m in self.spinn.memories if 't_logprobs' in m], 0)
+        """Build the policy loss from the transitions taken by SPINN.
 
+        The log-probabilities of the taken actions are gathered from a
+        ``(num_steps, batch_size, 2)`` stack in one step, and the advantage is
+        broadcast over the steps. When SPINN's batch holds several copies of
+        each example, one after another (both sentences of a pair, or several
+        rollouts), `advantage` is tiled to match.
+        """
+        memories = [m for m in self.spinn.memories if 't_preds' in m]
+        t_preds = np.stack([m['t_preds'] for m in memories])
+        t_mask = np.stack([m['t_mask'] for m in memories])
         if self.rl_valid:
-            t_mask = np.logical_and(t_mask, t_valid_mask)
-
-        batch_size = advantage.size(0)
-
-        seq_length = t_preds.shape[0] // batch_size 
-        a_index = np.arange(batch_size)
-        a_index = a_index.reshape(1, -1).repeat(seq_length, axis=0).flatten()
+            t_mask = np.logical_and(
+                t_mask, np.stack([m['t_valid_mask'] for m in memories]))
+        t_logprobs = torch.stack([m['t_logprobs'] for m in memories], 0)
+
+        self.stats = dict(
+            mean=advantage.mean(),
+            mean_magnitude=advantage.abs().mean(),
+            var=advantage.var(),
+            var_magnitude=advantage.abs().var()
+        )
+
+        n_actions = int(t_mask.sum())
+        if n_actions == 0:
+            print("No valid parses. Policy loss of -1 passed.")
+            return to_gpu(Variable(torch.ones(1) * -1))
 
-        # Patch to handle no valid generated parses
-        try:
-            a_index = torch.from_numpy(a_index[t_mask]).long()
-            # RuntimeError: the given numpy array has zero-sized dimensions. Zero-sized dimensions are not supported in PyTorch
-            # --> t_mask is all False. --> t_mask and t_valid_mask is empty set. --> proabbly t_val-d_mask all False
+        # SKIPs are masked out, so any action can stand in for them.
+        actions = to_gpu(Variable(torch.from_numpy(
+            np.where(t_mask, t_preds, 0)).long().unsqueeze(2),
+            volatile=not self.training))
+        log_p_action = torch.gather(t_logprobs, 2, actions).squeeze(2)
 
-            t_index = to_gpu(Variable(torch.from_numpy(
-                np.arange(t_mask.shape[0])[t_mask])).long())
+        # Expand advantage.
+        advantage = advantage.repeat(t_preds.shape[1] // advantage.size(0))
+        weights = advantage.view(1, -1) * \
+            torch.from_numpy(t_mask.astype(np.float32))
+        weights = to_gpu(Variable(weights, volatile=log_p_action.volatile))
 
-            self.stats = dict(
-                mean=advantage.mean(),
-                mean_magnitude=advantage.abs().mean(),
-                var=advantage.var(),
-                var_magnitude=advantage.abs().var()
-            )
+        policy_loss = -1. * torch.sum(log_p_action * weights)
+        policy_loss /= n_actions
+        policy_loss *= self.rl_weight
 
-            if self.use_sentence_pair:
-                # Handles the case of SNLI where each reward is used for two
-                # sentences.
-                advantage = torch.cat([advantage, advantage], 0)
-
-            # Expand advantage.
-            advantage = torch.index_select(advantage, 0, a_index)
-
-            # Filter logits.
-            t_logprobs = torch.index_select(t_logprobs, 0, t_index)
-
-            actions = to_gpu(Variable(torch.from_numpy(
-                t_preds[t_mask]).long().view(-1, 1), volatile=not self.training))
-            log_p_action = torch.gather(t_logprobs, 1, actions)
-
-            # NOTE: Not sure I understand why entropy is inside this
-            # multiplication. Investigate?
-            policy_losses = log_p_action.view(-1) * \
-                to_gpu(Variable(advantage, volatile=log_p_action.volatile))
-            policy_loss = -1. * torch.sum(policy_losses)
-            policy_loss /= log_p_action.size(0)
-            policy_loss *= self.rl_weight
-        except:
-            print("No valid parses. Policy loss of -1 passed.")
-            policy_loss = to_gpu(Variable(torch.ones(1) * -1))
-            
         return policy_loss
 
+    def forward(self, sentences, transitions, y_batch=None, **kwargs):
+        if self.training and self.rl_num_samples > 1:
+            # Sample several parses of each example in a single batch. The
+            # copies are laid out one rollout after another, so the output
+            # has `rl_num_samples` rows per example.
+            sentences = np.concatenate([sentences] * self.rl_num_samples, 0)
+            transitions = np.concatenate(
+                [transitions] * self.rl_num_samples, 0)
+            if y_batch is not None:
+                y_batch = np.concatenate([y_batch] * self.rl_num_samples, 0)
+        return super(BaseModel, self).forward(
+            sentences, transitions, y_batch, **kwargs)
+
     def output_hook(self, output, sentences, transitions, y_batch=None):
         if not self.training:
             return
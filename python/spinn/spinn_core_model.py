@@ -10,10 +10,12 @@ import torch.nn.functional as F
 from torch.nn.init import kaiming_normal
 
 from spinn.util.blocks import Embed, Linear, MLP
-from spinn.util.blocks import bundle, lstm, to_gpu, unbundle
+from spinn.util.blocks import bundle, lstm, no_grad, to_gpu, unbundle
+from spinn.util.blocks import expand_rows, scatter_rows, unique_rows
 from spinn.util.blocks import LayerNormalization
-from spinn.util.misc import Example, Vocab
+from spinn.util.misc import Example, LRUCache, Vocab
 from spinn.util.catalan import ShiftProbabilities
+from spinn.util.thin_stack import ThinStack, thin_index
 
 from spinn.data import T_SHIFT, T_REDUCE, T_SKIP
 
@@ -46,6 +48,7 @@ def build_model(data_manager, initial_embeddings, vocab_size,
         mlp_ln=FLAGS.mlp_ln,
         context_args=context_args,
         composition_args=composition_args,
+        dedup_premises=FLAGS.dedup_premises,
     )
 
 
@@ -117,6 +120,29 @@ class Tracker(nn.Module):
         else:
             return torch.cat([top_buf, top_stack_1, top_stack_2], 1), None
 
+    def forward_rows(self, rows, batch_size, top_buf, top_stack_1,
+                     top_stack_2):
+        """Like `forward`, but the inputs are only given for the examples at
+        `rows`, and only their states are advanced. Missing states are
+        zeros, as on the first step."""
+        if rows is None or not self.lateral_tracking:
+            return self(top_buf, top_stack_1, top_stack_2)
+
+        c, h = self.c, self.h
+        if c is not None:
+            self.c = c.index_select(0, rows)
+        if h is not None:
+            self.h = h.index_select(0, rows)
+
+        rows_h, rows_c = self(top_buf, top_stack_1, top_stack_2)
+
+        self.c = scatter_rows(rows_c, rows, batch_size) if c is None \
+            else c.index_copy(0, rows, rows_c)
+        self.h = scatter_rows(rows_h, rows, batch_size) if h is None \
+            else h.index_copy(0, rows, rows_h)
+
+        return rows_h, rows_c
+
     @property
     def states(self):
         return unbundle((self.c, self.h))
@@ -141,6 +167,10 @@ class SPINN(nn.Module):
         self.wrap_items = args.wrap_items
         self.extract_h = args.extract_h
 
+        # Keep buffers and stacks as batched tensors addressed by integer
+        # pointers, rather than as per-example lists.
+        self.thin_stack = args.thin_stack
+
         # Reduce function for semantic composition.
         self.reduce = args.composition
         if args.tracker_size is not None or args.use_internal_parser:
@@ -160,6 +190,28 @@ class SPINN(nn.Module):
                 self.transition_net = Linear()(
                     tinp_size, 2)
 
+        # With given parses and no tracker, every tree is known up front and
+        # nodes of the same depth can be composed together.
+        self.level_batching = args.level_batching and not hasattr(
+            self, 'tracker')
+
+        # In eval mode, reuse the encodings of subtrees seen before. Only
+        # valid when an encoding depends on nothing but the subtree's tokens,
+        # which layer normalization breaks: its statistics are taken over
+        # the whole reduce batch.
+        if args.subtree_cache_size > 0 and \
+                not args.use_tracking_in_composition and \
+                not getattr(self.reduce, 'composition_ln', False):
+            self.subtree_cache = LRUCache(args.subtree_cache_size)
+        else:
+            self.subtree_cache = None
+        self.key_bufs = None
+
+        # In eval mode, optionally keep no per-step memories, except for the
+        # transition statistics if those are asked for.
+        self.lean_eval = args.lean_eval
+        self.lean_eval_transition_stats = args.lean_eval_transition_stats
+
         self.choices = np.array([T_SHIFT, T_REDUCE], dtype=np.int32)
 
         self.shift_probabilities = ShiftProbabilities()
@@ -167,6 +219,24 @@ class SPINN(nn.Module):
     def reset_state(self):
         self.memories = []
 
+    @property
+    def lean(self):
+        return self.lean_eval and not self.training
+
+    def record_memory(self):
+        if not self.lean:
+            self.memories.append(self.memory)
+        elif self.lean_eval_transition_stats:
+            # Only the transitions, which do not scale with the model size.
+            self.memories.append({k: v for k, v in self.memory.items()
+                                  if k.startswith('t_')})
+
+    def train(self, mode=True):
+        # Cached encodings go stale whenever the parameters may change.
+        if self.subtree_cache is not None:
+            self.subtree_cache.clear()
+        return super(SPINN, self).train(mode)
+
     def forward(
             self,
             example,
@@ -181,6 +251,27 @@ class SPINN(nn.Module):
             assert all(buf_n <= (seq_length + 1) // 2 for buf_n in self.n_tokens), \
                 "All sentences (including cropped) must be the appropriate length."
 
+        if hasattr(self, 'tracker'):
+            self.tracker.reset_state()
+        if not hasattr(example, 'transitions'):
+            # TODO: Support no transitions. In the meantime, must at least pass
+            # dummy transitions.
+            raise ValueError('Transitions must be included.')
+
+        if self.level_batching:
+            return self.run_levels(example.bufs, example.transitions)
+
+        # Lean evaluation without statistics only predicts transitions
+        # when they are used.
+        run_internal_parser = use_internal_parser or not self.lean or \
+            self.lean_eval_transition_stats
+
+        if self.thin_stack:
+            return self.run_thin_stack(example.bufs, example.transitions,
+                                       run_internal_parser=run_internal_parser,
+                                       use_internal_parser=use_internal_parser,
+                                       validate_transitions=validate_transitions)
+
         self.bufs = example.bufs
 
         # Notes on adding zeros to bufs/stacks.
@@ -198,19 +289,25 @@ class SPINN(nn.Module):
 
         # Initialize Stacks.
         self.stacks = [[zeros, zeros] for buf in self.bufs]
+        if hasattr(self, 'transition_net'):
+            self.init_lens()
+
+        # Keys of the subtrees on the buffers and stacks: a token ID for a
+        # leaf, a (left, right) pair for a reduced item, and None for zeros.
+        if self.subtree_cache is not None and not self.training:
+            tokens = example.tokens.data.cpu().numpy()
+            self.key_bufs = [[None] + row[::-1].tolist()[-b_n:]
+                             for row, b_n in zip(tokens, self.n_tokens)]
+            self.key_stacks = [[None, None] for buf in self.bufs]
+        else:
+            self.key_bufs = None
 
         # Initialize other.
         self.n_reduces = np.zeros(len(self.bufs), dtype=np.int32)
         self.n_steps = np.zeros(len(self.bufs), dtype=np.int32)
 
-        if hasattr(self, 'tracker'):
-            self.tracker.reset_state()
-        if not hasattr(example, 'transitions'):
-            # TODO: Support no transitions. In the meantime, must at least pass
-            # dummy transitions.
-            raise ValueError('Transitions must be included.')
         return self.run(example.transitions,
-                        run_internal_parser=True,
+                        run_internal_parser=run_internal_parser,
                         use_internal_parser=use_internal_parser,
                         validate_transitions=validate_transitions)
 
@@ -220,14 +317,6 @@ class SPINN(nn.Module):
         buf_adjust = 1 if zero_padded else 0
         stack_adjust = 2 if zero_padded else 0
 
-        _transitions = np.array(transitions)
-        _preds = preds.copy()
-        _invalid = np.zeros(preds.shape, dtype=np.bool)
-
-        cant_skip = _transitions != T_SKIP
-        must_skip = _transitions == T_SKIP
-
-        # Fixup predicted skips.
         if len(self.choices) > 2:
             raise NotImplementedError(
                 "Can only validate actions for 2 choices right now.")
@@ -235,26 +324,43 @@ class SPINN(nn.Module):
         buf_lens = [len(buf) - buf_adjust for buf in bufs]
         stack_lens = [len(stack) - stack_adjust for stack in stacks]
 
-        # Cannot reduce on too small a stack
-        must_shift = np.array([length < 2 for length in stack_lens])
-        check_mask = np.logical_and(cant_skip, must_shift)
-        _invalid += np.logical_and(_preds != T_SHIFT, check_mask)
-        _preds[must_shift] = T_SHIFT
-
-        # Cannot shift on too small buf
-        must_reduce = np.array([length < 1 for length in buf_lens])
-        check_mask = np.logical_and(cant_skip, must_reduce)
-        _invalid += np.logical_and(_preds != T_REDUCE, check_mask)
-        _preds[must_reduce] = T_REDUCE
-
-        # If the given action is skip, then must skip.
-        _preds[must_skip] = T_SKIP
-
-        return _preds, _invalid
+        _preds, _invalid = validate_actions(
+            torch.LongTensor(np.asarray(transitions, dtype=np.int64)),
+            torch.from_numpy(np.asarray(preds, dtype=np.int64)),
+            torch.LongTensor(stack_lens), torch.LongTensor(buf_lens))
+        return _preds.numpy(), _invalid.numpy().astype(bool)
+
+    def init_lens(self):
+        """Track the stack and buffer lengths of the list-based stacks as
+        tensors, so validation does not need to visit the lists."""
+        self.stack_lens = to_gpu(torch.LongTensor(
+            [len(stack) - 2 for stack in self.stacks]))
+        self.buf_lens = to_gpu(torch.LongTensor(
+            [len(buf) - 1 for buf in self.bufs]))
+
+    def advance_lens(self, transition_arr):
+        """Apply one step of actions to `stack_lens` and `buf_lens`. SHIFT on
+        an empty buffer still pops the zero padding, and REDUCE pops at most
+        what is on the stack, as in `t_shift` and `t_reduce`."""
+        actions = to_gpu(torch.from_numpy(
+            np.asarray(transition_arr, dtype=np.int64)))
+        shift = (actions == T_SHIFT).long()
+        reduce = (actions == T_REDUCE).long()
+        self.buf_lens = self.buf_lens - shift * (self.buf_lens > -1).long()
+        self.stack_lens = self.stack_lens + shift + \
+            reduce * (1 - torch.clamp(self.stack_lens + 2, max=2))
+
+    def stack_and_buf_lens(self):
+        """Stack and buffer lengths, not counting the zero padding."""
+        if self.thin_stack:
+            return (to_gpu(torch.from_numpy(self.stack_ptrs - 2)),
+                    to_gpu(torch.from_numpy(np.maximum(
+                        self.n_tokens_thin + 1 - self.buf_ptrs, 0) - 1)))
+        return self.stack_lens, self.buf_lens
 
     def predict_actions(self, transition_output):
         transition_logdist = F.log_softmax(transition_output, dim=1)
-        transition_preds = transition_logdist.data.cpu().numpy().argmax(axis=1)
+        transition_preds = transition_logdist.data.max(1)[1]
         return transition_logdist, transition_preds
 
     def get_transitions_per_example(self, style="preds"):
@@ -320,24 +426,194 @@ class SPINN(nn.Module):
                 new_stack_item = next(shift_candidates)
                 stack.append(new_stack_item)
 
-    def reduce_phase(self, lefts, rights, trackings, stacks):
+    def reduce_phase(self, lefts, rights, trackings, stacks, keys=None):
         if len(stacks) > 0:
-            reduced = iter(self.reduce(
-                lefts, rights, trackings))
+            if keys is None:
+                reduced = self.reduce(lefts, rights, trackings)
+            else:
+                reduced = self.cached_reduce(lefts, rights, trackings, keys)
+            reduced = iter(reduced)
             for stack in stacks:
                 new_stack_item = next(reduced)
                 stack.append(new_stack_item)
 
+    def cached_reduce(self, lefts, rights, trackings, keys):
+        """Like `reduce`, but only composes the subtrees that are not cached."""
+        reduced = [self.subtree_cache.get(key) if key is not None else None
+                   for key in keys]
+        missing = [i for i, item in enumerate(reduced) if item is None]
+        if len(missing) > 0:
+            computed = self.reduce([lefts[i] for i in missing],
+                                   [rights[i] for i in missing],
+                                   [trackings[i] for i in missing])
+            for i, item in zip(missing, computed):
+                reduced[i] = item
+                if keys[i] is not None:
+                    self.subtree_cache.put(keys[i], item.detach())
+        return reduced
+
+    def shift_key(self, batch_idx):
+        key_buf = self.key_bufs[batch_idx]
+        self.key_stacks[batch_idx].append(
+            key_buf.pop() if len(key_buf) > 0 else None)
+
+    def reduce_key(self, batch_idx):
+        key_stack = self.key_stacks[batch_idx]
+        right = key_stack.pop() if len(key_stack) > 0 else None
+        left = key_stack.pop() if len(key_stack) > 0 else None
+        key = (left, right) if left is not None and right is not None else None
+        key_stack.append(key)
+        return key
+
     def reduce_phase_hook(self, lefts, rights, trackings, reduce_stacks):
         pass
 
     def loss_phase_hook(self):
         pass
 
-    def run(self, inp_transitions, run_internal_parser=False,
-            use_internal_parser=False, validate_transitions=True):
+    def parse_phase(self, transitions, invalid_count, run_internal_parser=False,
+                    use_internal_parser=False, validate_transitions=True,
+                    active=None):
+        """Run the tracker over the tops stored in `self.memory` and, if there
+        is a transition net, predict and validate the next actions.
+
+        If `active` is given, the tops are only those of the examples at these
+        indices, which are the ones that do not SKIP.
+
+        Returns the actions to apply at this step."""
+        transition_arr = list(transitions)
+
+        # A mask based on SKIP transitions.
+        cant_skip = np.array(transitions) != T_SKIP
+
+        # Run if:
+        # A. We have a tracking component and,
+        # B. There is at least one transition that will not be skipped.
+        if hasattr(self, 'tracker') and sum(cant_skip) > 0:
+
+            # Get hidden output from the tracker. Used to predict
+            # transitions.
+            rows = thin_index(active) if active is not None else None
+            tracker_h, tracker_c = self.tracker.forward_rows(
+                rows, len(transitions),
+                self.extract_h(self.memory['top_buf']),
+                self.extract_h(self.memory['top_stack_1']),
+                self.extract_h(self.memory['top_stack_2']))
+
+            if hasattr(self, 'transition_net') and run_internal_parser:
+                transition_inp = [tracker_h]
+                if self.tracker.lateral_tracking and self.predict_use_cell:
+                    transition_inp += [tracker_c]
+                transition_inp = torch.cat(transition_inp, 1)
+
+                transition_output = self.transition_net(transition_inp)
+                if rows is not None:
+                    # SKIPs are forced below, whatever is predicted.
+                    transition_output = scatter_rows(
+                        transition_output, rows, len(transitions))
+
+                # Predict Actions
+                # ===============
+
+                # TODO: Mask before predicting. This should simplify things and reduce computation.
+                # The downside is that in the Action Phase, need to be smarter about which stacks/bufs
+                # are selected.
+                transition_logdist, transition_preds = self.predict_actions(
+                    transition_output)
+
+                # Distribution of transitions use to calculate transition
+                # loss.
+                self.memory["t_logprobs"] = transition_logdist
+
+                # Given transitions.
+                self.memory["t_given"] = transitions
+
+                # Constrain to valid actions
+                # ==========================
+
+                given = to_gpu(torch.from_numpy(
+                    np.asarray(transitions, dtype=np.int64)))
+                stack_lens, buf_lens = self.stack_and_buf_lens()
+                validated_preds, invalid_mask = validate_actions(
+                    given, transition_preds, stack_lens, buf_lens)
+                if validate_transitions:
+                    transition_preds = validated_preds
+                else:
+                    # If the given action is skip, then must skip.
+                    transition_preds = transition_preds.masked_fill(
+                        given == T_SKIP, T_SKIP)
+
+                # The actions drive the per-example stack updates, so this
+                # is the one copy to the host for the step.
+                transition_preds, invalid_mask = torch.stack(
+                    [transition_preds, invalid_mask.long()], 0).cpu().numpy()
+                invalid_mask = invalid_mask.astype(bool)
+
+                # Keep track of which predictions have been valid.
+                self.memory["t_valid_mask"] = np.logical_not(invalid_mask)
+                invalid_count += invalid_mask
+
+                # Actual transition predictions. Used to measure transition
+                # accuracy.
+                self.memory["t_preds"] = transition_preds
+
+                # Binary mask of examples that have a transition.
+                self.memory["t_mask"] = cant_skip
+
+                # If this FLAG is set, then use the predicted actions
+                # rather than the given.
+                if use_internal_parser:
+                    transition_arr = transition_preds.tolist()
+
+        return transition_arr
+
+    def loss_phase(self, batch_size, invalid_count):
         transition_loss = None
         transition_acc = 0.0
+
+        if hasattr(self, 'tracker') and hasattr(self, 'transition_net'):
+            # Lean evaluation may keep no transitions at all.
+            if any('t_preds' in m for m in self.memories):
+                t_preds = np.concatenate([m['t_preds']
+                                          for m in self.memories if 't_preds' in m])
+                t_given = np.concatenate([m['t_given']
+                                          for m in self.memories if 't_given' in m])
+                t_mask = np.concatenate([m['t_mask']
+                                         for m in self.memories if 't_mask' in m])
+                t_logprobs = torch.cat([m['t_logprobs']
+                                        for m in self.memories if 't_logprobs' in m], 0)
+
+                # We compute accuracy and loss after all transitions have complete,
+                # since examples can have different lengths when not using skips.
+
+                # Transition Accuracy.
+                n = t_mask.shape[0]
+                n_skips = n - t_mask.sum()
+                n_total = n - n_skips
+                n_correct = (t_preds == t_given).sum() - n_skips
+                transition_acc = n_correct / float(n_total)
+
+                # Transition Loss.
+                index = to_gpu(
+                    Variable(
+                        torch.from_numpy(
+                            np.arange(
+                                t_mask.shape[0])[t_mask])).long())
+                select_t_given = to_gpu(Variable(torch.from_numpy(
+                    t_given[t_mask]), volatile=not self.training).long())
+                select_t_logprobs = torch.index_select(t_logprobs, 0, index)
+                transition_loss = nn.NLLLoss()(select_t_logprobs, select_t_given) * \
+                    self.transition_weight
+
+            self.n_invalid = (invalid_count > 0).sum()
+            self.invalid = self.n_invalid / float(batch_size)
+
+        self.loss_phase_hook()
+
+        return transition_acc, transition_loss
+
+    def run(self, inp_transitions, run_internal_parser=False,
+            use_internal_parser=False, validate_transitions=True):
         num_transitions = inp_transitions.shape[1]
         batch_size = inp_transitions.shape[0]
         invalid_count = np.zeros(batch_size)
@@ -345,13 +621,16 @@ class SPINN(nn.Module):
         # Transition Loop
         # ===============
 
-        for t_step in range(num_transitions):
+        for t_step in active_steps(inp_transitions):
             transitions = inp_transitions[:, t_step]
-            transition_arr = list(transitions)
 
-            # A mask based on SKIP transitions.
-            cant_skip = np.array(transitions) != T_SKIP
-            must_skip = np.array(transitions) == T_SKIP
+            # Only the examples that do not SKIP take part in this step.
+            active = active_rows(transitions)
+            if active is None:
+                bufs, stacks = self.bufs, self.stacks
+            else:
+                bufs = [self.bufs[i] for i in active]
+                stacks = [self.stacks[i] for i in active]
 
             # Memories
             # ========
@@ -372,99 +651,42 @@ class SPINN(nn.Module):
                     "feature, when predicting/validating transitions, you"
                     "probably will not get the behavior that you expect. Disable"
                     "this exception if you dare.")
-            self.memory['top_buf'] = self.wrap_items(
-                [buf[-1] if len(buf) > 0 else self.zeros for buf in self.bufs])
-            self.memory['top_stack_1'] = self.wrap_items(
-                [stack[-1] if len(stack) > 0 else self.zeros for stack in self.stacks])
-            self.memory['top_stack_2'] = self.wrap_items(
-                [stack[-2] if len(stack) > 1 else self.zeros for stack in self.stacks])
-
-            # Run if:
-            # A. We have a tracking component and,
-            # B. There is at least one transition that will not be skipped.
-            if hasattr(self, 'tracker') and sum(cant_skip) > 0:
-
-                # Get hidden output from the tracker. Used to predict
-                # transitions.
-                tracker_h, tracker_c = self.tracker(
-                    self.extract_h(self.memory['top_buf']),
-                    self.extract_h(self.memory['top_stack_1']),
-                    self.extract_h(self.memory['top_stack_2']))
-
-                if hasattr(self, 'transition_net'):
-                    transition_inp = [tracker_h]
-                    if self.tracker.lateral_tracking and self.predict_use_cell:
-                        transition_inp += [tracker_c]
-                    transition_inp = torch.cat(transition_inp, 1)
-
-                    transition_output = self.transition_net(transition_inp)
-
-                if hasattr(self, 'transition_net') and run_internal_parser:
-
-                    # Predict Actions
-                    # ===============
-
-                    # TODO: Mask before predicting. This should simplify things and reduce computation.
-                    # The downside is that in the Action Phase, need to be smarter about which stacks/bufs
-                    # are selected.
-                    transition_logdist, transition_preds = self.predict_actions(
-                        transition_output)
-
-                    # Distribution of transitions use to calculate transition
-                    # loss.
-                    self.memory["t_logprobs"] = transition_logdist
-
-                    # Given transitions.
-                    self.memory["t_given"] = transitions
-
-                    # Constrain to valid actions
-                    # ==========================
-
-                    validated_preds, invalid_mask = self.validate(
-                        transition_arr, transition_preds, self.stacks, self.bufs)
-                    if validate_transitions:
-                        transition_preds = validated_preds
-
-                    # Keep track of which predictions have been valid.
-                    self.memory["t_valid_mask"] = np.logical_not(invalid_mask)
-                    invalid_count += invalid_mask
-
-                    # If the given action is skip, then must skip.
-                    transition_preds[must_skip] = T_SKIP
-
-                    # Actual transition predictions. Used to measure transition
-                    # accuracy.
-                    self.memory["t_preds"] = transition_preds
-
-                    # Binary mask of examples that have a transition.
-                    self.memory["t_mask"] = cant_skip
-
-                    # If this FLAG is set, then use the predicted actions
-                    # rather than the given.
-                    if use_internal_parser:
-                        transition_arr = transition_preds.tolist()
+            if hasattr(self, 'tracker'):
+                self.memory['top_buf'] = self.wrap_items(
+                    [buf[-1] if len(buf) > 0 else self.zeros for buf in bufs])
+                self.memory['top_stack_1'] = self.wrap_items(
+                    [stack[-1] if len(stack) > 0 else self.zeros for stack in stacks])
+                self.memory['top_stack_2'] = self.wrap_items(
+                    [stack[-2] if len(stack) > 1 else self.zeros for stack in stacks])
+
+            transition_arr = self.parse_phase(
+                transitions, invalid_count,
+                run_internal_parser=run_internal_parser,
+                use_internal_parser=use_internal_parser,
+                validate_transitions=validate_transitions,
+                active=active)
 
             # Pre-Action Phase
             # ================
 
-            # TODO: See if PyTorch's 'Advanced Indexing for Tensors and
-            # Variables' features would simplify this.
-
             # For SHIFT
             s_stacks, s_tops, s_trackings, s_idxs = [], [], [], []
 
             # For REDUCE
             r_stacks, r_lefts, r_rights, r_trackings = [], [], [], []
+            r_keys = [] if self.key_bufs is not None else None
 
             batch = list(zip(transition_arr, self.bufs, self.stacks, self.tracker.states if hasattr(
                 self, 'tracker') and self.tracker.h is not None else itertools.repeat(None)))
 
-            for batch_idx, (transition, buf, stack,
-                            tracking) in enumerate(batch):
+            for batch_idx in range(batch_size) if active is None else active:
+                transition, buf, stack, tracking = batch[batch_idx]
                 if transition == T_SHIFT:  # shift
                     self.t_shift(buf, stack, tracking, s_tops, s_trackings)
                     s_idxs.append(batch_idx)
                     s_stacks.append(stack)
+                    if r_keys is not None:
+                        self.shift_key(batch_idx)
                 elif transition == T_REDUCE:  # reduce
                     self.t_reduce(
                         buf,
@@ -474,6 +696,8 @@ class SPINN(nn.Module):
                         r_rights,
                         r_trackings)
                     r_stacks.append(stack)
+                    if r_keys is not None:
+                        r_keys.append(self.reduce_key(batch_idx))
                 elif transition == T_SKIP:  # skip
                     self.t_skip()
 
@@ -481,7 +705,8 @@ class SPINN(nn.Module):
             # ============
 
             self.shift_phase(s_tops, s_trackings, s_stacks)
-            self.reduce_phase(r_lefts, r_rights, r_trackings, r_stacks)
+            self.reduce_phase(
+                r_lefts, r_rights, r_trackings, r_stacks, r_keys)
             self.reduce_phase_hook(r_lefts, r_rights, r_trackings, r_stacks)
 
             # Memory Phase
@@ -489,7 +714,7 @@ class SPINN(nn.Module):
 
             # APPEND ALL MEMORIES. MASK LATER.
 
-            self.memories.append(self.memory)
+            self.record_memory()
 
             # Update number of reduces seen so far.
             self.n_reduces += (np.array(transition_arr) == T_REDUCE)
@@ -497,44 +722,13 @@ class SPINN(nn.Module):
             # Update number of non-skip actions seen so far.
             self.n_steps += (np.array(transition_arr) != T_SKIP)
 
+            if hasattr(self, 'transition_net'):
+                self.advance_lens(transition_arr)
+
         # Loss Phase
         # ==========
-        if hasattr(self, 'tracker') and hasattr(self, 'transition_net'):
-            t_preds = np.concatenate([m['t_preds']
-                                      for m in self.memories if 't_preds' in m])
-            t_given = np.concatenate([m['t_given']
-                                      for m in self.memories if 't_given' in m])
-            t_mask = np.concatenate([m['t_mask']
-                                     for m in self.memories if 't_mask' in m])
-            t_logprobs = torch.cat([m['t_logprobs']
-                                    for m in self.memories if 't_logprobs' in m], 0)
-
-            # We compute accuracy and loss after all transitions have complete,
-            # since examples can have different lengths when not using skips.
-
-            # Transition Accuracy.
-            n = t_mask.shape[0]
-            n_skips = n - t_mask.sum()
-            n_total = n - n_skips
-            n_correct = (t_preds == t_given).sum() - n_skips
-            transition_acc = n_correct / float(n_total)
-
-            # Transition Loss.
-            index = to_gpu(
-                Variable(
-                    torch.from_numpy(
-                        np.arange(
-                            t_mask.shape[0])[t_mask])).long())
-            select_t_given = to_gpu(Variable(torch.from_numpy(
-                t_given[t_mask]), volatile=not self.training).long())
-            select_t_logprobs = torch.index_select(t_logprobs, 0, index)
-            transition_loss = nn.NLLLoss()(select_t_logprobs, select_t_given) * \
-                self.transition_weight
-
-            self.n_invalid = (invalid_count > 0).sum()
-            self.invalid = self.n_invalid / float(batch_size)
-
-        self.loss_phase_hook()
+        transition_acc, transition_loss = self.loss_phase(
+            batch_size, invalid_count)
 
         if self.debug:
             assert all(len(stack) == 3 for stack in self.stacks), \
@@ -546,6 +740,361 @@ class SPINN(nn.Module):
         return [stack[-1]
                 for stack in self.stacks], transition_acc, transition_loss
 
+    def run_thin_stack(self, bufs, inp_transitions, run_internal_parser=False,
+                       use_internal_parser=False, validate_transitions=True):
+        """Same as `run`, but with batched buffers and a thin stack.
+
+        The buffers and stacks of the whole batch are rows of a single
+        `ThinStack`. Each example keeps integer pointers into it, so SHIFT,
+        REDUCE and SKIP are one read and one write for the whole batch instead
+        of list operations per example.
+
+        Layout of the stack rows of an example, for ``S = num_transitions + 4``::
+
+            [zero, zero, stack[0], stack[1], ..., stack[p - 1], unused ...]
+
+        where ``p`` is the length of the equivalent list-based stack (which
+        starts as two zeros). The two leading guard slots are never written,
+        so reading ``stack[p - 1]`` and ``stack[p - 2]`` at slots ``p + 1`` and
+        ``p`` gives zeros exactly when the list-based stack would.
+        """
+        num_transitions = inp_transitions.shape[1]
+        batch_size = inp_transitions.shape[0]
+        invalid_count = np.zeros(batch_size)
+
+        bufs = stack_buffers(bufs)
+        seq_length, model_dim = bufs.size(1), bufs.size(2)
+
+        # Buffers: one extra zero row, read whenever a buffer is empty.
+        buf_width = seq_length + 1
+        buf_offsets = np.arange(batch_size, dtype=np.int64) * buf_width
+
+        # Stacks: two guard zeros, two initial zeros, and one slot per step.
+        stack_width = num_transitions + 4
+        stack_offsets = batch_size * buf_width + \
+            np.arange(batch_size, dtype=np.int64) * stack_width
+
+        memory = ThinStack(batch_size * (buf_width + stack_width), bufs)
+        memory.write(leaf_rows(batch_size, seq_length),
+                     bufs.contiguous().view(-1, model_dim))
+
+        self.n_tokens_thin = buffer_lengths(self.n_tokens, seq_length)
+
+        # Pointers: tokens consumed from the buffer and current stack length.
+        self.buf_ptrs = np.zeros(batch_size, dtype=np.int64)
+        self.stack_ptrs = np.full(batch_size, 2, dtype=np.int64)
+
+        # Initialize other.
+        self.n_reduces = np.zeros(batch_size, dtype=np.int32)
+        self.n_steps = np.zeros(batch_size, dtype=np.int32)
+
+        # Transition Loop
+        # ===============
+
+        for t_step in active_steps(inp_transitions):
+            transitions = inp_transitions[:, t_step]
+            active = active_rows(transitions)
+
+            # Memories
+            # ========
+            # Keep track of key values to determine accuracy and loss.
+            self.memory = {}
+
+            buf_rows = buf_offsets + np.where(
+                self.buf_ptrs < self.n_tokens_thin, self.buf_ptrs, seq_length)
+            stack_rows = stack_offsets + self.stack_ptrs
+            top_buf, top_stack_1, top_stack_2 = torch.chunk(memory.read(
+                np.concatenate([buf_rows, stack_rows + 1, stack_rows])), 3, 0)
+
+            if hasattr(self, 'tracker'):
+                tops = [top_buf, top_stack_1, top_stack_2]
+                if active is not None:
+                    a_index = thin_index(active)
+                    tops = [torch.index_select(top, 0, a_index)
+                            for top in tops]
+                self.memory['top_buf'] = self.wrap_items([tops[0]])
+                self.memory['top_stack_1'] = self.wrap_items([tops[1]])
+                self.memory['top_stack_2'] = self.wrap_items([tops[2]])
+
+            transition_arr = self.parse_phase(
+                transitions, invalid_count,
+                run_internal_parser=run_internal_parser,
+                use_internal_parser=use_internal_parser,
+                validate_transitions=validate_transitions,
+                active=active)
+            transition_arr = np.array(transition_arr)
+
+            # Action Phase
+            # ============
+
+            s_idxs = np.where(transition_arr == T_SHIFT)[0]
+            r_idxs = np.where(transition_arr == T_REDUCE)[0]
+            w_rows, w_items = [], []
+
+            # SHIFT: Copy the top of the buffer onto the stack.
+            if len(s_idxs) > 0:
+                w_items.append(torch.index_select(
+                    top_buf, 0, thin_index(s_idxs)))
+                w_rows.append(stack_offsets[s_idxs] + self.stack_ptrs[s_idxs] + 2)
+                self.buf_ptrs[s_idxs] += 1
+                self.stack_ptrs[s_idxs] += 1
+
+            # REDUCE: Compose the top two items of the stack, which are
+            # already available as the tracker inputs.
+            if len(r_idxs) > 0:
+                n_reduce = len(r_idxs)
+                r_index = thin_index(r_idxs)
+                r_lefts = torch.chunk(torch.index_select(
+                    top_stack_2, 0, r_index), n_reduce, 0)
+                r_rights = torch.chunk(torch.index_select(
+                    top_stack_1, 0, r_index), n_reduce, 0)
+                if hasattr(self, 'tracker') and self.tracker.h is not None:
+                    r_trackings = torch.chunk(torch.index_select(
+                        torch.cat((self.tracker.c, self.tracker.h), 1),
+                        0, r_index), n_reduce, 0)
+                else:
+                    r_trackings = [None] * n_reduce
+                w_items.extend(self.reduce(r_lefts, r_rights, r_trackings))
+                self.stack_ptrs[r_idxs] = np.maximum(
+                    self.stack_ptrs[r_idxs] - 2, 0)
+                w_rows.append(stack_offsets[r_idxs] + self.stack_ptrs[r_idxs] + 2)
+                self.stack_ptrs[r_idxs] += 1
+
+            if len(w_rows) > 0:
+                memory.write(np.concatenate(w_rows), torch.cat(w_items, 0))
+
+            # Memory Phase
+            # ============
+
+            # APPEND ALL MEMORIES. MASK LATER.
+
+            self.record_memory()
+
+            # Update number of reduces seen so far.
+            self.n_reduces += (transition_arr == T_REDUCE)
+
+            # Update number of non-skip actions seen so far.
+            self.n_steps += (transition_arr != T_SKIP)
+
+        # Loss Phase
+        # ==========
+        transition_acc, transition_loss = self.loss_phase(
+            batch_size, invalid_count)
+
+        if self.debug:
+            assert all(self.stack_ptrs == 3), \
+                "Stacks should be fully reduced and have 3 elements: " \
+                "two zeros and the sentence encoding."
+            assert all(self.buf_ptrs == self.n_tokens_thin), \
+                "Stacks should be fully shifted and have 1 zero."
+
+        outputs = memory.read(stack_offsets + self.stack_ptrs + 1)
+        memory.close()
+        return list(torch.chunk(outputs, batch_size, 0)
+                    ), transition_acc, transition_loss
+
+    def run_levels(self, bufs, inp_transitions):
+        """Compose given parses one tree depth at a time.
+
+        Only used without a tracker, so the composition does not depend on
+        the order of the transitions, just on the shape of each tree. The
+        number of sequential reduce calls drops from the number of
+        transitions to the height of the tallest tree in the batch.
+        """
+        batch_size = inp_transitions.shape[0]
+        bufs = stack_buffers(bufs)
+
+        levels, roots, n_nodes = level_schedule(
+            inp_transitions, self.n_tokens, bufs.size(1))
+
+        def reduce(lefts, rights):
+            return self.reduce(lefts, rights, [None] * len(lefts))
+        outputs = compose_levels(reduce, bufs, levels, roots, n_nodes)
+
+        self.n_reduces = (inp_transitions == T_REDUCE).sum(1).astype(np.int32)
+        self.n_steps = (inp_transitions != T_SKIP).sum(1).astype(np.int32)
+
+        transition_acc, transition_loss = self.loss_phase(batch_size, None)
+
+        return list(torch.chunk(outputs, batch_size, 0)
+                    ), transition_acc, transition_loss
+
+
+def active_steps(inp_transitions):
+    """The steps at which at least one example does not SKIP. Transitions
+    are left padded, so this drops the leading steps that only SKIP."""
+    return np.where((inp_transitions != T_SKIP).any(axis=0))[0].tolist()
+
+
+def active_rows(transitions):
+    """Indices of the examples that do not SKIP at a step, or None if all of
+    them take part."""
+    active = np.where(np.asarray(transitions) != T_SKIP)[0]
+    return None if len(active) == len(transitions) else active
+
+
+def leaf_rows(batch_size, seq_length):
+    """Rows of the buffer items in a table with ``seq_length + 1`` rows per
+    example, the last of which is left as zeros."""
+    buf_width = seq_length + 1
+    return (np.arange(batch_size, dtype=np.int64).reshape(-1, 1) * buf_width +
+            np.arange(seq_length, dtype=np.int64).reshape(1, -1)).ravel()
+
+
+def validate_actions(transitions, preds, stack_lens, buf_lens):
+    """Overrule the predicted actions that cannot be applied, as a few tensor
+    ops on the device of `preds`. With SHIFT and REDUCE as the only choices,
+    this is an argmax over the allowed actions.
+
+    Args:
+        transitions: ``(B,)`` given transitions. SKIP is always kept.
+        preds: ``(B,)`` predicted transitions.
+        stack_lens: ``(B,)`` stack lengths. REDUCE needs at least two items.
+        buf_lens: ``(B,)`` buffer lengths. SHIFT needs at least one item.
+
+    Returns:
+        The validated transitions, and a mask of the predictions that were
+        overruled on examples that are not skipped.
+    """
+    cant_skip = transitions != T_SKIP
+    must_shift = stack_lens < 2
+    must_reduce = buf_lens < 1
+
+    invalid = ((must_shift & (preds != T_SHIFT)) |
+               (must_reduce & (preds != T_REDUCE))) & cant_skip
+    validated = preds.masked_fill(must_shift, T_SHIFT).masked_fill(
+        must_reduce, T_REDUCE).masked_fill(transitions == T_SKIP, T_SKIP)
+
+    return validated, invalid
+
+
+def stack_buffers(bufs):
+    """Turn per-example buffer lists, which hold the last token first, into a
+    single ``(B, L, D)`` tensor. Tensors are passed through."""
+    if isinstance(bufs, list):
+        bufs = torch.cat([torch.cat(b[::-1], 0).unsqueeze(0)
+                          for b in bufs], 0)
+    return bufs
+
+
+def buffer_lengths(n_tokens, seq_length):
+    """Number of tokens each example reads from its buffer.
+
+    The list-based buffers keep `b[-b_n:]`, which is the whole buffer when an
+    example has no tokens."""
+    n_tokens = np.array(n_tokens, dtype=np.int64)
+    return np.where(n_tokens == 0, seq_length, n_tokens)
+
+
+def level_schedule(transitions, n_tokens, seq_length):
+    """Group the REDUCEs of a batch of given parses by tree depth.
+
+    Runs the transitions over integer stacks of node ids, so the shape of
+    every tree is known before any composition happens. Node ids are rows of
+    a table whose first ``B * (L + 1)`` rows are the buffers (one zero row per
+    example, at column ``L``), followed by the composed nodes ordered by
+    depth. Cropped or otherwise invalid sequences are handled the same way as
+    in `SPINN.run`: popping from an empty buffer or stack gives zeros.
+
+    Returns:
+        levels: List of ``(lefts, rights)`` id arrays, one per depth. The
+            nodes of each level take the next ``len(lefts)`` rows of the table.
+        roots: Id of the top of each stack after the last transition.
+        n_nodes: Total number of rows in the table.
+    """
+    batch_size, num_transitions = transitions.shape
+    buf_width = seq_length + 1
+    n_leaves = batch_size * buf_width
+    offsets = np.arange(batch_size, dtype=np.int64) * buf_width
+    zeros = offsets + seq_length
+    n_tokens = buffer_lengths(n_tokens, seq_length)
+
+    # Same layout as the thin stack: two guard zeros and two initial zeros.
+    stacks = np.repeat(zeros.reshape(-1, 1), num_transitions + 4, axis=1)
+    stack_ptrs = np.full(batch_size, 2, dtype=np.int64)
+    buf_ptrs = np.zeros(batch_size, dtype=np.int64)
+
+    # REDUCE at step t of example b is temporarily node n_leaves + b * T + t.
+    depth = np.zeros(n_leaves + batch_size * num_transitions, dtype=np.int64)
+    nodes, lefts, rights = [], [], []
+
+    for t_step in range(num_transitions):
+        transitions_t = transitions[:, t_step]
+        s_idxs = np.where(transitions_t == T_SHIFT)[0]
+        r_idxs = np.where(transitions_t == T_REDUCE)[0]
+
+        s_ptrs = buf_ptrs[s_idxs]
+        stacks[s_idxs, stack_ptrs[s_idxs] + 2] = np.where(
+            s_ptrs < n_tokens[s_idxs], offsets[s_idxs] + s_ptrs, zeros[s_idxs])
+        buf_ptrs[s_idxs] += 1
+        stack_ptrs[s_idxs] += 1
+
+        r_nodes = n_leaves + r_idxs * num_transitions + t_step
+        r_lefts = stacks[r_idxs, stack_ptrs[r_idxs]]
+        r_rights = stacks[r_idxs, stack_ptrs[r_idxs] + 1]
+        depth[r_nodes] = np.maximum(depth[r_lefts], depth[r_rights]) + 1
+        stack_ptrs[r_idxs] = np.maximum(stack_ptrs[r_idxs] - 2, 0)
+        stacks[r_idxs, stack_ptrs[r_idxs] + 2] = r_nodes
+        stack_ptrs[r_idxs] += 1
+
+        nodes.append(r_nodes)
+        lefts.append(r_lefts)
+        rights.append(r_rights)
+
+    roots = stacks[np.arange(batch_size), stack_ptrs + 1]
+    if len(nodes) == 0:
+        return [], roots, n_leaves
+    nodes = np.concatenate(nodes)
+    lefts = np.concatenate(lefts)
+    rights = np.concatenate(rights)
+
+    # Renumber the composed nodes so that each depth is a contiguous block.
+    order = np.argsort(depth[nodes], kind='mergesort')
+    remap = np.arange(depth.shape[0])
+    remap[nodes[order]] = n_leaves + np.arange(nodes.shape[0])
+
+    levels = []
+    boundaries = np.flatnonzero(np.diff(depth[nodes[order]])) + 1
+    for level in np.split(order, boundaries):
+        if level.shape[0] > 0:
+            levels.append((remap[lefts[level]], remap[rights[level]]))
+
+    return levels, remap[roots], n_leaves + nodes.shape[0]
+
+
+def compose_levels(reduce, bufs, levels, roots, n_nodes):
+    """Run the composition function once per tree depth.
+
+    Args:
+        reduce: Called as ``reduce(lefts, rights)`` with lists of ``(1, D)``
+            items, and returns an iterable of the composed items.
+        bufs: ``(B, L, D)`` tensor of buffer items.
+        levels, roots, n_nodes: The output of `level_schedule`.
+
+    Returns:
+        A ``(B, D)`` tensor with the root of every example.
+    """
+    batch_size, seq_length, model_dim = bufs.size()
+    n_leaves = batch_size * (seq_length + 1)
+
+    table = ThinStack(n_nodes, bufs)
+    table.write(leaf_rows(batch_size, seq_length),
+                bufs.contiguous().view(-1, model_dim))
+
+    start = n_leaves
+    for lefts, rights in levels:
+        n_level = lefts.shape[0]
+        items = torch.chunk(table.read(
+            np.concatenate([lefts, rights])), 2 * n_level, 0)
+        reduced = torch.cat(
+            list(reduce(items[:n_level], items[n_level:])), 0)
+        table.write(np.arange(start, start + n_level), reduced)
+        start += n_level
+
+    outputs = table.read(roots)
+    table.close()
+    return outputs
+
 
 class BaseModel(nn.Module):
 
@@ -576,6 +1125,7 @@ class BaseModel(nn.Module):
                  classifier_keep_rate=None,
                  context_args=None,
                  composition_args=None,
+                 dedup_premises=False,
                  **kwargs
                  ):
         super(BaseModel, self).__init__()
@@ -587,6 +1137,10 @@ class BaseModel(nn.Module):
         self.use_difference_feature = use_difference_feature
         self.use_product_feature = use_product_feature
 
+        # Encode each distinct premise in a batch once.
+        self.dedup_premises = dedup_premises
+        self.premise_inverse = None
+
         self.hidden_dim = composition_args.size
         self.wrap_items = composition_args.wrap_items
         self.extract_h = composition_args.extract_h
@@ -677,48 +1231,53 @@ class BaseModel(nn.Module):
             use_internal_parser=False,
             validate_transitions=True,
             **kwargs):
-        example = self.unwrap(sentences, transitions)
-
-        b, l = example.tokens.size()[:2]
-
-        embeds = self.embed(example.tokens)
-        embeds = self.reshape_input(embeds, b, l)
-        embeds = self.encode(embeds)
-        embeds = self.reshape_context(embeds, b, l)
-        self.forward_hook(embeds, b, l)
-        embeds = F.dropout(
-            embeds,
-            self.embedding_dropout_rate,
-            training=self.training)
-
-        # Make Buffers
-        # _embeds = torch.chunk(to_cpu(embeds), b, 0)
-        # _embeds = [torch.chunk(x, l, 0) for x in _embeds]
-        # buffers = [list(reversed(x)) for x in _embeds]
-        ee = torch.chunk(embeds, b * l, 0)[::-1]
-        bb = []
-        for ii in range(b):
-            ex = list(ee[ii * l:(ii + 1) * l])
-            bb.append(ex)
-        buffers = bb[::-1]
+        # Nothing from a lean evaluation pass is differentiated.
+        with no_grad(self.spinn.lean):
+            example = self.unwrap(sentences, transitions)
+
+            b, l = example.tokens.size()[:2]
+
+            embeds = self.embed(example.tokens)
+            embeds = self.reshape_input(embeds, b, l)
+            embeds = self.encode(embeds)
+            embeds = self.reshape_context(embeds, b, l)
+            self.forward_hook(embeds, b, l)
+            embeds = F.dropout(
+                embeds,
+                self.embedding_dropout_rate,
+                training=self.training)
+
+            # Make Buffers
+            if self.spinn.thin_stack or self.spinn.level_batching:
+                example.bufs = embeds.view(b, l, -1)
+            else:
+                # _embeds = torch.chunk(to_cpu(embeds), b, 0)
+                # _embeds = [torch.chunk(x, l, 0) for x in _embeds]
+                # buffers = [list(reversed(x)) for x in _embeds]
+                ee = torch.chunk(embeds, b * l, 0)[::-1]
+                bb = []
+                for ii in range(b):
+                    ex = list(ee[ii * l:(ii + 1) * l])
+                    bb.append(ex)
+                buffers = bb[::-1]
 
-        example.bufs = buffers
+                example.bufs = buffers
 
-        h, transition_acc, transition_loss = self.run_spinn(
-            example, use_internal_parser, validate_transitions)
-        self.spinn_outp = h
+            h, transition_acc, transition_loss = self.run_spinn(
+                example, use_internal_parser, validate_transitions)
+            self.spinn_outp = h
 
-        self.transition_acc = transition_acc
-        self.transition_loss = transition_loss
+            self.transition_acc = transition_acc
+            self.transition_loss = transition_loss
 
-        # Build features
-        features = self.build_features(h)
+            # Build features
+            features = self.build_features(h)
 
-        output = self.mlp(features)
+            output = self.mlp(features)
 
-        self.output_hook(output, sentences, transitions, y_batch)
+            self.output_hook(output, sentences, transitions, y_batch)
 
-        return output
+            return output
 
     # --- Sentence Style Switches ---
 
@@ -757,14 +1316,22 @@ class BaseModel(nn.Module):
     # --- Sentence Pair Model Specific ---
 
     def unwrap_sentence_pair(self, sentences, transitions):
-        # Build Tokens
         x_prem = sentences[:, :, 0]
         x_hyp = sentences[:, :, 1]
+        t_prem = transitions[:, :, 0]
+        t_hyp = transitions[:, :, 1]
+
+        # Optionally keep one copy of each premise.
+        self.premise_inverse = None
+        if self.dedup_premises:
+            index, self.premise_inverse = unique_rows(
+                np.concatenate([x_prem, t_prem], axis=1))
+            x_prem, t_prem = x_prem[index], t_prem[index]
+
+        # Build Tokens
         x = np.concatenate([x_prem, x_hyp], axis=0)
 
         # Build Transitions
-        t_prem = transitions[:, :, 0]
-        t_hyp = transitions[:, :, 1]
         t = np.concatenate([t_prem, t_hyp], axis=0)
 
         example = Example()
@@ -777,9 +1344,14 @@ class BaseModel(nn.Module):
         return example
 
     def wrap_sentence_pair(self, items):
-        batch_size = len(items) // 2
-        h_premise = self.extract_h(self.wrap_items(items[:batch_size]))
-        h_hypothesis = self.extract_h(self.wrap_items(items[batch_size:]))
+        if self.premise_inverse is None:
+            num_premises = len(items) // 2
+        else:
+            num_premises = len(items) - len(self.premise_inverse)
+        h_premise = self.extract_h(self.wrap_items(items[:num_premises]))
+        h_hypothesis = self.extract_h(self.wrap_items(items[num_premises:]))
+        if self.premise_inverse is not None:
+            h_premise = expand_rows(h_premise, self.premise_inverse)
         return [h_premise, h_hypothesis]
 
     def get_samples(self, x, vocabulary, only_one=False):
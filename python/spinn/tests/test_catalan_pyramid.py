@@ -0,0 +1,124 @@
+import unittest
+import copy
+import numpy as np
+
+from spinn.catalan_pyramid import CatalanPyramid
+
+# PyTorch
+import torch
+from torch.autograd import Variable
+
+from spinn.util.test import MockModel, default_args, get_batch
+
+
+def pyramid_args(multiproc=False):
+    args = default_args(
+        composition_ln=True,
+        parent_selection="st_gumbel",
+        trainable_temperature=False,
+        low_dim=4,
+        topk=2,
+        cp_num=None,
+        multiproc=multiproc,
+        enforce_right=False,
+        predict_use_cell=False)
+    args['composition_args'].tracker_size = None
+    args['composition_args'].lateral_tracking = False
+    args['composition_args'].use_tracking_in_composition = False
+    args['composition_args'].extract_h = lambda x: x.chunk(2, 1)[0]
+    return args
+
+
+class CatalanPyramidTestCase(unittest.TestCase):
+
+    def test_single_catalan_pyramid(self):
+        model = MockModel(CatalanPyramid, pyramid_args())
+        X, transitions = get_batch()
+        outputs = model(X, transitions, example_lengths=np.array([4, 4]))
+        assert outputs.size() == (2, 3)
+
+    def test_worker_pool(self):
+        model = MockModel(CatalanPyramid, pyramid_args())
+        for w in model.parameters():
+            w.data.uniform_(-0.1, 0.1)
+        mp_model = MockModel(CatalanPyramid, pyramid_args(multiproc=True))
+        mp_model.load_state_dict(model.state_dict())
+        mp_model.chart_parser.num_workers = 3
+
+        X, transitions = get_batch()
+        lengths = np.array([4, 4])
+
+        torch.manual_seed(0)
+        outputs = model(X, transitions, example_lengths=lengths)
+        torch.manual_seed(0)
+        mp_outputs = mp_model(X, transitions, example_lengths=lengths)
+
+        assert mp_model.chart_parser.pool is not None
+        assert all((outputs.data == mp_outputs.data).view(-1).tolist())
+        for parse, mp_parse in zip(model.parse_memory, mp_model.parse_memory):
+            assert (parse == mp_parse).all()
+
+        # The pool is left out of copies, and is rebuilt on first use.
+        parser = mp_model.chart_parser
+        mp_model.chart_parser = copy.deepcopy(parser)
+        assert mp_model.chart_parser.pool is None
+        torch.manual_seed(0)
+        copied_outputs = mp_model(X, transitions, example_lengths=lengths)
+        assert mp_model.chart_parser.pool is not None
+        assert all((outputs.data == copied_outputs.data).view(-1).tolist())
+
+        parser.shutdown_pool()
+        assert parser.pool is None
+
+    def test_chart_checkpoint(self):
+        model = MockModel(CatalanPyramid, pyramid_args())
+        for w in model.parameters():
+            w.data.uniform_(-0.1, 0.1)
+        ck_args = pyramid_args()
+        ck_args['chart_checkpoint'] = True
+        ck_model = MockModel(CatalanPyramid, ck_args)
+        ck_model.load_state_dict(model.state_dict())
+
+        X, transitions = get_batch()
+        lengths = np.array([4, 4])
+
+        grads = []
+        for m in [model, ck_model]:
+            torch.manual_seed(0)
+            outputs = m(X, transitions, example_lengths=lengths)
+            outputs.sum().backward()
+            grads.append([outputs.data] + [w.grad.data.clone()
+                                           for w in m.parameters()
+                                           if w.grad is not None])
+
+        assert len(grads[0]) == len(grads[1])
+        for g, ck_g in zip(*grads):
+            np.testing.assert_allclose(g.numpy(), ck_g.numpy(), atol=1e-6)
+        assert ck_model.chart_memory < model.chart_memory
+
+    def test_chart_copies(self):
+        model = MockModel(CatalanPyramid, pyramid_args())
+        for w in model.parameters():
+            w.data.uniform_(-0.1, 0.1)
+        parser = model.chart_parser
+        parser.parent_selection = "softmax"
+
+        copies = 3
+        h = Variable(torch.randn(2, 5, 4))
+        c = Variable(torch.randn(2, 5, 4))
+        alpha = Variable(torch.ones(copies * 2))
+
+        tiled = parser.compute_compositions(
+            (torch.cat([h] * copies, 0), torch.cat([c] * copies, 0)),
+            None, alpha, False)
+        shared = parser.compute_compositions(
+            (h, c), None, alpha, False, copies=copies)
+
+        for x, y in zip(tiled[:3], shared[:3]):
+            np.testing.assert_allclose(x.data.numpy(), y.data.numpy(),
+                                       atol=1e-6)
+        assert (tiled[3] == shared[3]).all()
+
+
+if __name__ == '__main__':
+    unittest.main()
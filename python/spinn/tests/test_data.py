@@ -2,6 +2,9 @@ import unittest
 
 
 import os
+import shutil
+import numpy as np
+import tempfile
 from spinn import util
 from spinn.data.nli import load_nli_data
 from spinn.data.sst import load_sst_data
@@ -165,6 +168,25 @@ class DataTestCase(unittest.TestCase):
             vocabulary, word_embedding_dim, embedding_data_path)
         assert initial_embeddings.shape == (10, 5)
 
+    def test_embedding_store(self):
+        data_manager = load_nli_data
+        raw_data = data_manager.load_data(nli_data_path)
+        data_sets = [(nli_data_path, raw_data)]
+
+        store_path = tempfile.mkdtemp()
+        util.ConvertEmbeddingsToBinary(embedding_data_path, store_path)
+        vocabulary = util.BuildVocabulary(
+            raw_data, data_sets, store_path, logger=MockLogger(),
+            sentence_pair_data=data_manager.SENTENCE_PAIR_DATA)
+        initial_embeddings = util.LoadEmbeddings(
+            vocabulary, word_embedding_dim, store_path)
+        shutil.rmtree(store_path)
+
+        assert len(vocabulary) == 10
+        expected = util.LoadEmbeddingsFromText(
+            vocabulary, word_embedding_dim, embedding_data_path)
+        assert (initial_embeddings == expected).all()
+
     def test_convert_binary_bracketing(self):
         given = "( 0 ( ( 1 2 ) 3 ) ) )"
         expected_tokens = [str(x) for x in range(4)]
@@ -173,6 +195,94 @@ class DataTestCase(unittest.TestCase):
         assert all(t == e for t, e in zip(tokens, expected_tokens))
         assert all(t == e for t, e in zip(transitions, expected_transitions))
 
+    def test_prefetch_iterator(self):
+        def items():
+            for i in range(5):
+                yield i
+            raise ValueError("Done.")
+
+        it = util.PrefetchIterator(items(), lambda x: x * 2, depth=2)
+        assert [next(it) for _ in range(5)] == [0, 2, 4, 6, 8]
+        with self.assertRaises(ValueError):
+            next(it)
+
+        assert list(util.PrefetchIterator(iter(range(3)))) == [0, 1, 2]
+
+    def test_morton_key(self):
+        for x, y in [(0, 0), (1, 2), (7, 3), (45, 200), (255, 255)]:
+            assert util.MortonKey(x, y) == util.Peano(x, y)
+
+    def test_smart_batching(self):
+        dataset_size, batch_size, num_splits = 100, 4, 5
+        num_transitions = np.random.randint(1, 50, size=(dataset_size, 2))
+        sources = (np.arange(dataset_size), num_transitions,
+                   num_transitions, num_transitions)
+        it = util.MakeTrainingIterator(sources, batch_size,
+                                       sentence_pair_data=True,
+                                       num_splits=num_splits)
+
+        # One epoch visits every example exactly once.
+        num_batches = dataset_size // batch_size
+        seen = np.concatenate([next(it)[0] for _ in range(num_batches)])
+        assert sorted(seen.tolist()) == list(range(dataset_size))
+
+    def test_tokens_to_ids(self):
+        vocabulary = {util.UNK_TOKEN: 0, "a": 1, "B": 2}
+        dataset = [{"tokens": ["a", "A", "b", "c", "a"]},
+                   {"tokens": ["c", "B"]}]
+        util.TokensToIDs(vocabulary, dataset)
+        assert dataset[0]["tokens"] == [1, 1, 2, 0, 1]
+        assert dataset[1]["tokens"] == [0, 2]
+
+        lookup = util.TokenIDLookup(vocabulary, 0)
+        assert [lookup[token] for token in ["A", "A", "b", "c"]] == [1, 1, 2, 0]
+        assert lookup.counts == [2, 1, 1]
+
+    def test_eval_iterator(self):
+        dataset_size, batch_size = 10, 4
+        sources = (np.arange(dataset_size), np.zeros(dataset_size))
+        it = util.MakeEvalIterator(sources, batch_size, limit=-1, shuffle=True)
+
+        # The last batch is short, and each pass gives the same batches.
+        assert len(it) == 3
+        batches = [batch[0].tolist() for batch in it]
+        assert [len(batch) for batch in batches] == [4, 4, 2]
+        assert sorted(sum(batches, [])) == list(range(dataset_size))
+        assert [batch[0].tolist() for batch in it] == batches
+
+        it = util.MakeEvalIterator(sources, batch_size, limit=5)
+        assert [batch[0].tolist() for batch in it] == [[0, 1, 2, 3], [4]]
+
+    def test_token_budget_batching(self):
+        dataset_size, token_budget = 100, 200
+        num_transitions = np.random.randint(1, 50, size=(dataset_size, 2))
+        sources = (np.arange(dataset_size), num_transitions,
+                   num_transitions, num_transitions)
+
+        # Each pair adds two rows to the batch.
+        batches = util.MakeBucketEvalIterator(sources, 32, token_budget)
+        seen = np.concatenate([batch[0] for batch in batches])
+        assert sorted(seen.tolist()) == list(range(dataset_size))
+        for batch in batches:
+            assert len(batch[0]) * 2 * batch[3].max() <= token_budget
+        assert len(set(len(batch[0]) for batch in batches)) > 1
+
+        it = util.MakeTrainingIterator(sources, 32, token_budget=token_budget)
+        for _ in range(10):
+            batch = next(it)
+            assert len(batch[0]) * 2 * batch[3].max() <= token_budget
+
+        # An epoch is counted in batches, not in batch_size examples.
+        it = util.MakeTrainingIterator(sources, 32, token_budget=token_budget)
+        num_batches, seen = 0, 0
+        while seen < dataset_size:
+            seen += len(next(it)[0])
+            num_batches += 1
+        epoch_length = util.TrainingEpochLength(
+            sources, 32, token_budget=token_budget)
+        assert epoch_length > dataset_size // 32
+        assert abs(epoch_length - num_batches) <= 10
+
 
 class SNLITestCase(unittest.TestCase):
 
@@ -214,6 +324,22 @@ class SNLITestCase(unittest.TestCase):
             7: 1,
             9: 1}
 
+    def test_load_parallel(self):
+        data_manager = load_nli_data
+        raw_data = data_manager.load_data(nli_data_path)
+
+        # Split the file into many small byte ranges.
+        chunk_bytes = data_manager.CHUNK_BYTES
+        data_manager.CHUNK_BYTES = 1000
+        try:
+            parallel_data = data_manager.load_data(
+                nli_data_path, num_workers=2)
+            streamed_data = list(data_manager.iter_data(nli_data_path))
+        finally:
+            data_manager.CHUNK_BYTES = chunk_bytes
+        assert parallel_data == raw_data
+        assert streamed_data == raw_data
+
     def test_preprocess(self):
         seq_length = 25
         simple = False
@@ -462,6 +588,43 @@ class ArithmeticTestCase(unittest.TestCase):
             # The transitions should be padded on the left.
             assert t_is_left_padded(ts)
 
+    def test_cache(self):
+        seq_length = 10
+
+        data_manager = load_sign_data
+        raw_data = data_manager.load_data(sign_data_path)
+        vocabulary = data_manager.FIXED_VOCABULARY
+
+        data = util.PreprocessDataset(
+            raw_data,
+            vocabulary,
+            seq_length,
+            data_manager,
+            eval_mode=False,
+            logger=MockLogger(),
+            sentence_pair_data=data_manager.SENTENCE_PAIR_DATA)
+
+        key = util.DatasetCacheKey([sign_data_path], seq_length=seq_length)
+        assert key == util.DatasetCacheKey(
+            [sign_data_path], seq_length=seq_length)
+        assert key != util.DatasetCacheKey(
+            [sign_data_path], seq_length=seq_length + 1)
+
+        cache_dir = tempfile.mkdtemp()
+        cache_path = os.path.join(cache_dir, key)
+        util.SaveCachedDataset(cache_path, vocabulary, data,
+                               [(sign_data_path, data)])
+        cached_vocabulary, cached_data, cached_eval_sets = \
+            util.LoadCachedDataset(cache_path)
+        shutil.rmtree(cache_dir)
+
+        assert cached_vocabulary == vocabulary
+        assert cached_eval_sets[0][0] == sign_data_path
+        for cached in (cached_data, cached_eval_sets[0][1]):
+            for array, cached_array in zip(data, cached):
+                assert array.dtype == cached_array.dtype
+                assert (array == cached_array).all()
+
     def test_preprocess_simple(self):
         seq_length = 10
         simple = False
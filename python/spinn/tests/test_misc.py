@@ -1,9 +1,17 @@
 import unittest
+import itertools
+import numpy as np
 
 
 # PyTorch
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
 
 from spinn.util.misc import Accumulator
+from spinn.util.catalan import Catalan, ShiftProbabilities
+from spinn.util.chart import split_cells, backtrace
+from spinn.util.loss import batch_size_loss_scale
 
 
 class MiscTestCase(unittest.TestCase):
@@ -17,6 +25,56 @@ class MiscTestCase(unittest.TestCase):
         assert len(A.get('key')) == 2
         assert len(A.get('key')) == 0
 
+    def test_catalan(self):
+        cat = Catalan()
+        assert [cat.catalan(n) for n in range(8)] == [
+            1, 1, 2, 5, 14, 42, 132, 429]
+        assert cat.catalan(40) == 2622127042276492108820
+
+    def test_shift_probabilities(self):
+        shift_probabilities = ShiftProbabilities()
+        states = np.array(list(itertools.product(
+            range(12), range(12), range(2, 7))))
+        n_reduces, i, n_tokens = states.T
+
+        probs = shift_probabilities.probs(n_reduces, i, n_tokens)
+        expected = [shift_probabilities.prob(*state) for state in states]
+        assert np.allclose(probs, expected)
+
+    def test_split_cells(self):
+        # Cells of a 4 token chart: 0-3, 4-6, 7-8 and 9.
+        lefts, rights = split_cells(4, 2)
+
+        assert lefts.tolist() == [[4, 0], [5, 1]]
+        assert rights.tolist() == [[2, 5], [3, 6]]
+
+    def test_backtrace(self):
+        # Left branching, then right branching.
+        splits = np.array([[0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+                           [0, 0, 0, 0, 0, 0, 0, 1, 1, 2]])
+        transitions = backtrace(splits, 4)
+
+        assert transitions.tolist() == [[0, 0, 1, 0, 1, 0, 1],
+                                        [0, 0, 0, 0, 1, 1, 1]]
+
+    def test_batch_size_loss_scale(self):
+        # Two token budget batches of the same example, with 2 and 6 rows.
+        mean_batch_size = 4.0
+        grads = []
+        for batch_size in [2, 6]:
+            logits = Variable(torch.FloatTensor(
+                [[0.5, -1.0, 2.0]] * batch_size), requires_grad=True)
+            target = Variable(torch.LongTensor([1] * batch_size))
+            loss = nn.CrossEntropyLoss()(logits, target)
+            loss = loss * batch_size_loss_scale(batch_size, mean_batch_size)
+            loss.backward()
+            grads.append(logits.grad.data)
+
+        # Every example gets the same gradient in both batches.
+        np.testing.assert_allclose(
+            grads[0].numpy(), grads[1][:2].numpy(), rtol=1e-6)
+        np.testing.assert_allclose(
+            grads[1][0].numpy(), grads[1][5].numpy(), rtol=1e-6)
 
 if __name__ == '__main__':
     unittest.main()
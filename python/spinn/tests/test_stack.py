@@ -15,8 +15,9 @@ from spinn.util.trainer import ModelTrainer
 import torch
 import torch.nn as nn
 
-from spinn.util.test import MockModel, default_args, get_batch, compare_models
+from spinn.util.test import MockModel, default_args, get_batch, get_batch_pair, compare_models
 from spinn.util import afs_safe_logger
+from spinn.util.blocks import ReduceTreeLSTM, bundle
 
 FLAGS = gflags.FLAGS
 
@@ -81,6 +82,68 @@ class SPINNTestCase(unittest.TestCase):
             default_args(
                 use_sentence_pair=True))
 
+    def test_greedy_model(self):
+        model = MockModel(spinn.rl_spinn.BaseModel, default_args())
+        keys = list(model.state_dict().keys())
+
+        greedy_model = model.greedy_model()
+        assert model.greedy_model() is greedy_model
+        assert not greedy_model.training
+        assert list(model.state_dict().keys()) == keys
+
+        for w, _w in zip(model.parameters(), greedy_model.parameters()):
+            assert w is _w
+
+    def test_reinforce(self):
+        model = MockModel(spinn.rl_spinn.BaseModel, default_args(
+            rl_weight=1.0, rl_valid=False))
+
+        logprobs = torch.log(torch.FloatTensor([
+            [[0.5, 0.5], [0.9, 0.1]],
+            [[0.2, 0.8], [0.6, 0.4]],
+        ]))
+        model.spinn.memories = [
+            {'t_preds': np.array([2, 0]), 't_mask': np.array([False, True]),
+             't_valid_mask': np.array([True, True]), 't_logprobs': logprobs[0]},
+            {'t_preds': np.array([1, 1]), 't_mask': np.array([True, True]),
+             't_valid_mask': np.array([True, True]), 't_logprobs': logprobs[1]},
+        ]
+        advantage = torch.FloatTensor([1.0, -2.0])
+
+        policy_loss = model.reinforce(advantage)
+        expected = -(-2.0 * np.log(0.9) + np.log(0.8) - 2.0 * np.log(0.4)) / 3
+        assert abs(policy_loss.data.item() - expected) < 1e-5
+
+        # Without any action to reinforce.
+        for m in model.spinn.memories:
+            m['t_mask'] = np.array([False, False])
+        assert model.reinforce(advantage).data.item() == -1
+
+    def test_multiple_rollouts(self):
+        args = default_args(
+            rl_baseline="loo", rl_num_samples=2, rl_weight=1.0,
+            rl_reward="standard", rl_valid=True, rl_whiten=False,
+            rl_transition_acc_as_reward=False)
+        args['composition_args'].transition_weight = 1.0
+        model = MockModel(spinn.rl_spinn.BaseModel, args)
+
+        # Each rollout is compared with the other rollout of its example.
+        rewards = torch.FloatTensor([1.0, 0.0, 1.0, 1.0, 1.0, 0.0])
+        baseline = model.build_baseline(rewards, None, None)
+        assert baseline.tolist() == [1.0, 1.0, 0.0, 1.0, 0.0, 1.0]
+
+        X, transitions = get_batch()
+        y = np.array([0, 1])
+
+        outputs = model(X, transitions, y, use_internal_parser=True)
+        assert outputs.size(0) == 2 * X.shape[0]
+        assert model.policy_loss is not None
+
+        # A single pass is made at inference time.
+        model.eval()
+        outputs = model(X, transitions, y, use_internal_parser=True)
+        assert outputs.size(0) == X.shape[0]
+
     def test_basic_stack(self):
         model = MockModel(BaseModel, default_args())
 
@@ -112,6 +175,201 @@ class SPINNTestCase(unittest.TestCase):
         assert outputs[0][0].data[0] == (3 - (1 - (2 - 1)))
         assert outputs[1][0].data[0] == ((3 - 2) - (4 - 5))
 
+    def test_thin_stack(self):
+        model = MockModel(BaseModel, default_args())
+        thin_args = default_args()
+        thin_args['composition_args'].thin_stack = True
+        thin_model = MockModel(BaseModel, thin_args)
+        thin_model.load_state_dict(model.state_dict())
+
+        X, transitions = get_batch()
+
+        model(X, transitions)
+        thin_model(X, transitions)
+        outputs = model.spinn_outp[0]
+        thin_outputs = thin_model.spinn_outp[0]
+
+        assert outputs.size() == thin_outputs.size()
+        assert all((outputs.data == thin_outputs.data).view(-1).tolist())
+
+    def test_level_batching(self):
+        args = default_args()
+        args['composition_args'].tracker_size = None
+        model = MockModel(BaseModel, args)
+        level_args = default_args()
+        level_args['composition_args'].tracker_size = None
+        level_args['composition_args'].level_batching = True
+        level_model = MockModel(BaseModel, level_args)
+        level_model.load_state_dict(model.state_dict())
+
+        X, transitions = get_batch()
+
+        model(X, transitions)
+        level_model(X, transitions)
+        outputs = model.spinn_outp[0]
+        level_outputs = level_model.spinn_outp[0]
+
+        assert outputs.size() == level_outputs.size()
+        assert all((outputs.data == level_outputs.data).view(-1).tolist())
+
+    def test_skip_padding(self):
+        model = MockModel(BaseModel, default_args())
+        for w in model.parameters():
+            w.data.uniform_(-0.1, 0.1)
+
+        # The second example is padded with SKIPs.
+        X = np.array([
+            [3, 1, 2, 1],
+            [3, 2, 0, 0]
+        ], dtype=np.int32)
+        transitions = np.array([
+            [0, 0, 0, 0, 1, 1, 1],
+            [2, 2, 2, 2, 0, 0, 1]
+        ], dtype=np.int32)
+
+        model(X, transitions)
+        outputs = model.spinn_outp[0]
+        tracker_h = model.spinn.tracker.h
+
+        # Padding steps leave the example untouched.
+        model(X[1:, :2], transitions[1:, 4:])
+        alone_outputs = model.spinn_outp[0]
+        alone_tracker_h = model.spinn.tracker.h
+
+        assert (outputs[1] - alone_outputs[0]).data.abs().max() < 1e-6
+        assert (tracker_h[1] - alone_tracker_h[0]).data.abs().max() < 1e-6
+
+    def test_subtree_cache(self):
+        args = default_args()
+        args['composition_args'].use_tracking_in_composition = False
+        model = MockModel(BaseModel, args)
+        cache_args = default_args()
+        cache_args['composition_args'].use_tracking_in_composition = False
+        cache_args['composition_args'].subtree_cache_size = 100
+        cache_model = MockModel(BaseModel, cache_args)
+        cache_model.load_state_dict(model.state_dict())
+        model.eval()
+        cache_model.eval()
+
+        X, transitions = get_batch()
+
+        model(X, transitions)
+        outputs = model.spinn_outp[0]
+        cache = cache_model.spinn.subtree_cache
+        for misses in [6, 6]:
+            cache_model(X, transitions)
+            cache_outputs = cache_model.spinn_outp[0]
+            assert all((outputs.data == cache_outputs.data).view(-1).tolist())
+            assert cache.misses == misses
+
+        # The second pass only reads from the cache.
+        assert cache.hits == 6
+
+        # Switching modes empties the cache.
+        cache_model.train()
+        assert len(cache) == 0
+
+    def test_subtree_cache_composition_ln(self):
+        def ln_args(subtree_cache_size):
+            args = default_args()
+            composition_args = args['composition_args']
+            composition_args.use_tracking_in_composition = False
+            composition_args.subtree_cache_size = subtree_cache_size
+            composition_args.wrap_items = lambda x: bundle(x)
+            composition_args.extract_h = lambda x: x.h
+            composition_args.extract_c = lambda x: x.c
+            composition_args.size = args['model_dim'] // 2
+            composition_args.composition = ReduceTreeLSTM(
+                args['model_dim'] // 2, composition_ln=True)
+            return args
+
+        model = MockModel(BaseModel, ln_args(0))
+        for w in model.parameters():
+            w.data.uniform_(-0.5, 0.5)
+        cache_model = MockModel(BaseModel, ln_args(100))
+        cache_model.load_state_dict(model.state_dict())
+        model.eval()
+        cache_model.eval()
+
+        X, transitions = get_batch()
+
+        model(X, transitions)
+        outputs = model.spinn_outp[0]
+
+        # The first example's subtrees are composed alone, and would be
+        # read back while the second one's are composed without them.
+        cache_model(X[:1], transitions[:1])
+        cache_model(X, transitions)
+        cache_outputs = cache_model.spinn_outp[0]
+
+        assert cache_model.spinn.subtree_cache is None
+        assert all((outputs.data == cache_outputs.data).view(-1).tolist())
+
+    def test_dedup_premises(self):
+        model = MockModel(BaseModel, default_args(use_sentence_pair=True))
+        dedup_model = MockModel(BaseModel, default_args(
+            use_sentence_pair=True, dedup_premises=True))
+        dedup_model.load_state_dict(model.state_dict())
+
+        # Both examples share a premise.
+        X, transitions = get_batch_pair()
+
+        outputs = model(X, transitions)
+        dedup_outputs = dedup_model(X, transitions)
+        assert dedup_model.premise_inverse.tolist() == [0, 0]
+        assert all((outputs.data == dedup_outputs.data).view(-1).tolist())
+
+        outputs.sum().backward()
+        dedup_outputs.sum().backward()
+        for w, _w in zip(model.parameters(), dedup_model.parameters()):
+            if w.grad is not None:
+                assert (w.grad.data - _w.grad.data).abs().max() < 1e-5
+
+    def test_tracked_lens(self):
+        args = default_args()
+        args['composition_args'].transition_weight = 1.0
+        model = MockModel(BaseModel, args)
+
+        X, transitions = get_batch()
+
+        # Unvalidated predictions may shift and reduce past the padding.
+        model(X, transitions, use_internal_parser=True,
+              validate_transitions=False)
+        stacks, bufs = model.spinn.stacks, model.spinn.bufs
+
+        assert model.spinn.stack_lens.tolist() == [
+            len(stack) - 2 for stack in stacks]
+        assert model.spinn.buf_lens.tolist() == [len(buf) - 1 for buf in bufs]
+
+    def test_lean_eval(self):
+        args = default_args()
+        args['composition_args'].transition_weight = 1.0
+        model = MockModel(BaseModel, args)
+        lean_args = default_args()
+        lean_args['composition_args'].transition_weight = 1.0
+        lean_args['composition_args'].lean_eval = True
+        lean_model = MockModel(BaseModel, lean_args)
+        lean_model.load_state_dict(model.state_dict())
+        model.eval()
+        lean_model.eval()
+
+        X, transitions = get_batch()
+
+        outputs = model(X, transitions, use_internal_parser=True)
+        for stats in [False, True]:
+            lean_model.spinn.lean_eval_transition_stats = stats
+            lean_outputs = lean_model(X, transitions, use_internal_parser=True)
+            assert all((outputs.data == lean_outputs.data).view(-1).tolist())
+            assert not lean_outputs.requires_grad
+
+            memories = lean_model.spinn.memories
+            if stats:
+                assert all('top_buf' not in m for m in memories)
+                assert lean_model.transition_acc == model.transition_acc
+            else:
+                assert len(memories) == 0
+                assert lean_model.transition_loss is None
+
     def test_validate_transitions_cantskip(self):
         model = MockModel(BaseModel, default_args())
 
@@ -8,6 +8,7 @@ import torch.nn.functional as F
 from torch.nn.init import kaiming_normal
 from torch.nn.parameter import Parameter
 
+from contextlib import contextmanager
 from functools import reduce
 
 
@@ -31,6 +32,45 @@ def to_gpu(var):
     return var
 
 
+@contextmanager
+def no_grad(enabled=True):
+    """Run the block without recording autograd history. PyTorch versions
+    without `torch.no_grad` rely on volatile inputs instead."""
+    if enabled and hasattr(torch, 'no_grad'):
+        with torch.no_grad():
+            yield
+    else:
+        yield
+
+
+def unique_rows(x):
+    """Find the distinct rows of a 2D array, in order of first occurrence.
+
+    Returns ``index`` and ``inverse`` such that ``x[index]`` holds the distinct
+    rows and ``x[index][inverse]`` equals ``x``.
+    """
+    _, index, inverse = np.unique(
+        x, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(index)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return index[order], rank[inverse.reshape(-1)]
+
+
+def expand_rows(h, inverse):
+    """Gather the rows of `h` given by `inverse`. The gradient of a row that
+    is gathered more than once is the sum over its copies."""
+    return h.index_select(0, to_gpu(Variable(torch.from_numpy(inverse).long())))
+
+
+def scatter_rows(h, index, num_rows):
+    """Place the rows of `h` at `index` in a tensor of `num_rows` rows,
+    leaving zeros elsewhere."""
+    zeros = Variable(h.data.new(num_rows, h.size(1)).zero_(),
+                     volatile=h.volatile)
+    return zeros.index_copy(0, index, h)
+
+
 class LSTMState:
     """Class for intelligent LSTM state object.
 
@@ -175,6 +215,19 @@ class LayerNormalization(nn.Module):
         return ln_out
 
 
+def layer_norm_positions(ln, x, copies=1):
+    """
+    Apply the LayerNormalization `ln` to each x[:, j] on its own. The
+    statistics of a composition then do not depend on the other
+    compositions that are computed in the same call. The statistics are
+    those of `copies` of the batch.
+    """
+    n = copies * x.size(0) * x.size(2)
+    mu = copies * x.sum(2, keepdim=True).sum(0, keepdim=True) / n
+    var = copies * (x - mu).pow(2).sum(2, keepdim=True).sum(0, keepdim=True) / (n - 1)
+    return (x - mu) / (var.sqrt() + ln.eps) * ln.a2 + ln.b2
+
+
 class ReduceTreeGRU(nn.Module):
     """
     Computes the following TreeGRU (x is optional):
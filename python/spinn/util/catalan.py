@@ -1,12 +1,15 @@
 from decimal import Decimal
 
+import numpy as np
+
 
 class Catalan(object):
     def __init__(self):
         """
         Returns catalan numbers: 1 1 2 5 14 42 132...
 
-        Memoized. Should run in amortized O(1) time.
+        Memoized. Should run in amortized O(1) time. The numbers are exact
+        integers.
 
         """
         self.sofar = 0
@@ -15,7 +18,7 @@ class Catalan(object):
     def catalan_it(self, start=0, end=0, c=1):
         for n in range(start + 1, end + 2):
             yield c
-            c = c * 2 * (2 * n - 1) / (n + 1)
+            c = c * 2 * (2 * n - 1) // (n + 1)
             if n > self.sofar:
                 self.sofar = self.sofar + 1
                 self.cache.append(c)
@@ -104,10 +107,69 @@ class CatalanPyramid(object):
             return relevant_row[iii]
 
 
+    def table(self, max_tokens):
+        """
+        Returns the result of `access` for every state of sentences with up
+        to `max_tokens` tokens, as an array indexed by
+        [n_tokens, i, n_reduces].
+
+        """
+        self.fill_rows(max_tokens - 2)
+        rows = np.zeros((len(self.decimal_rows), len(self.decimal_rows[-1])))
+        for row_index, decimal_row in enumerate(self.decimal_rows):
+            rows[row_index, :len(decimal_row)] = decimal_row
+
+        n_tokens, i, n_reduces = np.meshgrid(
+            np.arange(max_tokens + 1),
+            np.arange(2 * max_tokens + 1),
+            np.arange(max_tokens + 1),
+            indexing='ij')
+        n_shifts = i - n_reduces
+        n_stack = n_shifts - n_reduces
+
+        # Same lookup as in `access`, where the row is read from the end.
+        relevant_row_index = n_tokens - 2 - n_reduces - 1
+        iii = relevant_row_index - (i - (n_reduces * 2 + 2))
+        valid = (relevant_row_index >= 0) & (iii >= 0) & (iii <= relevant_row_index)
+        relevant = rows[np.where(valid, relevant_row_index, 0),
+                        np.where(valid, iii, 0)]
+
+        # The rules of `access`, in order.
+        conditions = [
+            (n_reduces > 0) & (n_reduces > n_shifts - 1),
+            n_stack <= 1,
+            n_reduces == n_tokens - 1,
+            n_shifts == n_tokens,
+            i >= n_tokens + n_reduces,
+        ]
+        choices = [0.0, 1.0, 1.0, 0.0, 0.0]
+        return np.select(conditions, choices, default=relevant)
+
+
 class ShiftProbabilities(object):
     def __init__(self):
         self.cache = dict()
         self.catalan_pyramid = CatalanPyramid()
+        self.max_tokens = 0
+        self.probs_table = np.zeros((1, 1, 1), dtype=np.float32)
 
     def prob(self, n_reduces, i, n_tokens):
         return self.catalan_pyramid.access(n_reduces, i, n_tokens)
+
+    def probs(self, n_reduces, i, n_tokens):
+        """
+        Vectorized `prob` for a batch of states, read from a table that
+        is grown to fit the longest sentence seen so far.
+
+        """
+        n_reduces = np.asarray(n_reduces)
+        i = np.asarray(i)
+        n_tokens = np.asarray(n_tokens)
+
+        max_tokens = max(n_tokens.max(), (i.max() + 1) // 2, n_reduces.max())
+        if max_tokens > self.max_tokens:
+            self.max_tokens = max_tokens
+            self.probs_table = self.catalan_pyramid.table(
+                max_tokens).astype(np.float32)
+
+        return self.probs_table[n_tokens, i, n_reduces]
@@ -0,0 +1,311 @@
+"""
+Bookkeeping for the charts of the pyramid models, which compose every span
+of a sentence from each of the ways to split it in two.
+
+Cell (row, col) holds the span of the row + 1 tokens starting at col, and
+split i of that cell combines the cells (row - i - 1, col) and
+(i, row + col - i). Cells are numbered row by row, so that each row is a
+contiguous block.
+"""
+
+import numpy as np
+
+# PyTorch
+import torch
+from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
+
+from spinn.util.blocks import to_gpu
+from spinn.util.thin_stack import ThinStack
+
+# Floats that backprop keeps for each candidate composition, in units of
+# the state size: both children, the concatenated input, the gates and the
+# new state.
+CANDIDATE_FLOATS = 13
+
+FLOAT_BYTES = 4
+
+
+def row_offsets(length):
+    """Number of the first cell of each row, and the total number of cells
+    at the end."""
+    return np.concatenate([[0], np.cumsum(np.arange(length, 0, -1))])
+
+
+def split_cells(length, row):
+    """Returns the cell numbers of the left and right children of every
+    split of every cell in `row`, as two ``(length - row, row)`` arrays."""
+    offsets = row_offsets(length)
+    cols = np.arange(length - row).reshape(-1, 1)
+    splits = np.arange(row).reshape(1, -1)
+    lefts = offsets[row - splits - 1] + cols
+    rights = offsets[splits] + row + cols - splits
+    return lefts, rights
+
+
+def shared_splits(length, row, n_shared):
+    """Mask of the splits of `row`, in the order of `split_cells`, whose
+    children are both among the first `n_shared` cells."""
+    lefts, rights = split_cells(length, row)
+    return ((lefts < n_shared) & (rights < n_shared)).ravel()
+
+
+def shared_rows(length, copies):
+    """Number of rows of a chart whose cells are the same in every copy of
+    the batch: the words, and the row above them, where every cell has a
+    single split. Nothing is shared with a single copy."""
+    return min(2, length) if copies > 1 else 0
+
+
+def chart_memory(batch_size, length, dim, checkpoint_rows=False, copies=1):
+    """
+    Estimated peak memory in bytes of a chart of ``(h, c)`` states of size
+    `dim`, during a training step. The table of states and its gradient are
+    always kept. The candidates of every row are kept for backprop, or with
+    `checkpoint_rows` only those of the row that is being computed. With
+    several `copies` of the batch, the cells and candidates that `Chart`
+    shares between the copies are only counted once.
+    """
+    offsets = row_offsets(length)
+    n_cells = offsets[-1]
+    n_shared = offsets[shared_rows(length, copies)]
+    n_states = batch_size * n_shared + batch_size * copies * (n_cells - n_shared)
+    table = 2 * n_states * 2 * dim
+
+    candidates = [0]
+    for row in range(1, length):
+        shared = shared_splits(length, row, n_shared).sum()
+        n_splits = (length - row) * row
+        candidates.append(batch_size * (shared + copies * (n_splits - shared)))
+    if checkpoint_rows:
+        n_candidates = max(candidates)
+    else:
+        n_candidates = sum(candidates)
+    kept = n_candidates * CANDIDATE_FLOATS * dim
+
+    return (table + kept) * FLOAT_BYTES
+
+
+def backtrace(splits, length):
+    """
+    Shift (0) and reduce (1) transitions of the parses that are selected by
+    `splits`, a ``(batch, n_cells)`` array with the index of the chosen
+    split of every cell. Returns a ``(batch, 2 * length - 1)`` array.
+
+    The chart is walked from the root down, one row at a time. Every cell of
+    a parse covers a contiguous block of the transitions, which ends with
+    its reduce, and its children cover the blocks before that.
+    """
+    offsets = row_offsets(length)
+    batch_size = splits.shape[0]
+    transitions = np.zeros((batch_size, 2 * length - 1))
+
+    # First transition of each cell of the parses, or -1.
+    starts = np.full((batch_size, offsets[-1]), -1, dtype=np.int64)
+    starts[:, -1] = 0
+    for row in range(length - 1, 0, -1):
+        b, col = np.nonzero(starts[:, offsets[row]:offsets[row + 1]] >= 0)
+        start = starts[b, offsets[row] + col]
+        split = splits[b, offsets[row] + col]
+        transitions[b, start + 2 * row] = 1
+        starts[b, offsets[row - split - 1] + col] = start
+        starts[b, offsets[split] + row + col - split] = \
+            start + 2 * (row - split) - 1
+    return transitions
+
+
+class Chart(object):
+    """
+    The ``(h, c)`` states of a chart, built one row at a time.
+
+    The states of all the cells are preallocated in a `ThinStack` table,
+    with one ``2 * dim`` row per example and cell. `fill` reads the
+    children of all the splits of a chart row, composes them and writes the
+    row that is selected from the candidates.
+
+    A chart can run over several `copies` of the batch, which then make
+    their own choices, for example with their own noise. The copies are
+    stacked copy by copy. The cells that do not depend on any choice, and
+    the candidates whose children are both such cells, are kept and
+    composed once per example, and broadcast to the copies.
+
+    `select` keeps the index of the split that each cell of a row chose,
+    and `splits` returns them, to `backtrace` the parses.
+
+    With `checkpoint_rows`, backprop keeps the states of the chart only,
+    and the candidates of a row are computed again when its gradient is
+    needed.
+
+    """
+
+    # Table rows of the children of each row, by (length, row, number of
+    # examples, copies).
+    index_cache = dict()
+
+    def __init__(self, h, c, copies=1, checkpoint_rows=False):
+        self.n_examples, self.length, self.dim = h.size()
+        self.copies = copies
+        self.batch_size = copies * self.n_examples
+        self.n_cells = row_offsets(self.length)[-1]
+        self.shared_rows = shared_rows(self.length, copies)
+        self.checkpoint_rows = checkpoint_rows
+        self.selected = []
+
+        self.slots = self.cell_slots()
+        n_rows = self.slots.max() + 1
+
+        states = torch.cat([h, c], 2)
+        self.table = ThinStack(n_rows, states)
+        self.table.write(self.slots[:self.n_examples, :self.length].ravel(),
+                         states.contiguous().view(-1, 2 * self.dim))
+
+    def cell_slots(self):
+        """Rows of the table that hold each cell of each example, as a
+        ``(batch, n_cells)`` array. The shared cells come first, example by
+        example, and then the others, copy by copy."""
+        n_shared = row_offsets(self.length)[self.shared_rows]
+        n_own = self.n_cells - n_shared
+        batch = np.arange(self.batch_size).reshape(-1, 1)
+
+        slots = np.empty((self.batch_size, self.n_cells), dtype=np.int64)
+        slots[:, :n_shared] = ((batch % self.n_examples) * n_shared +
+                               np.arange(n_shared))
+        slots[:, n_shared:] = (self.n_examples * n_shared + batch * n_own +
+                               np.arange(n_own))
+        return slots
+
+    def row_size(self, row):
+        """Number of examples for which `row` is computed."""
+        if row < self.shared_rows:
+            return self.n_examples
+        return self.batch_size
+
+    def expand(self, x):
+        """Repeat `x` over the copies, if it was only computed once per
+        example."""
+        if x.size(0) == self.batch_size:
+            return x
+        return x.repeat(self.copies, *([1] * (x.dim() - 1)))
+
+    def children(self, row):
+        """
+        Table rows of the children of the splits of `row`, in groups of
+        splits that are composed together. Each group is given as the
+        number of examples it is composed for, the number of copies that
+        share it, and the rows of the left and then the right children,
+        example by example. Also
+        returns the order that puts the splits of the groups back in the
+        order of `split_cells`, or None.
+
+        """
+        key = (self.length, row, self.n_examples, self.copies)
+        if key not in self.index_cache:
+            lefts, rights = split_cells(self.length, row)
+            lefts, rights = lefts.ravel(), rights.ravel()
+            n_shared = row_offsets(self.length)[self.shared_rows]
+            shared = shared_splits(self.length, row, n_shared)
+
+            groups = []
+            if shared.any():
+                examples = self.n_examples
+                groups.append((examples, self.copies, np.concatenate(
+                    [self.slots[:examples, lefts[shared]],
+                     self.slots[:examples, rights[shared]]], 1).ravel()))
+            if not shared.all():
+                groups.append((self.batch_size, 1, np.concatenate(
+                    [self.slots[:, lefts[~shared]],
+                     self.slots[:, rights[~shared]]], 1).ravel()))
+
+            order = None
+            if len(groups) > 1:
+                positions = np.arange(len(lefts))
+                order = np.argsort(np.concatenate(
+                    [positions[shared], positions[~shared]]))
+            self.index_cache[key] = groups, order
+        return self.index_cache[key]
+
+    def candidates(self, row, compose):
+        """
+        Compose the children of every split of every cell in `row`.
+        `compose` is called with the ``(h, c)`` states of the left and right
+        children of a group of splits, each of the size ``(batch, splits,
+        dim)``, and returns a tuple of tensors that start with the batch and
+        split dimensions. A group that is shared by several copies is
+        composed once per example, and `compose` is also given the number of
+        `copies`, for statistics over the batch. Returns the outputs of `compose`
+        for all the splits of the row, with the splits of a cell next to
+        each other.
+
+        """
+        groups, order = self.children(row)
+        outputs = []
+        for examples, copies, rows in groups:
+            left, right = self.table.read(rows).view(
+                examples, -1, 2 * self.dim).chunk(2, 1)
+            l, r = left.chunk(2, 2), right.chunk(2, 2)
+            if copies > 1:
+                parts = compose(l, r, copies=copies)
+            else:
+                parts = compose(l, r)
+            if self.row_size(row) == self.batch_size:
+                parts = [self.expand(x) for x in parts]
+            outputs.append(tuple(parts))
+
+        if order is None:
+            return outputs[0]
+        order = to_gpu(Variable(torch.from_numpy(order)))
+        return tuple(torch.cat(parts, 1).index_select(1, order)
+                     for parts in zip(*outputs))
+
+    def fill(self, row, compose, select):
+        """
+        Compute `row` and write it into the chart. The candidates of the row
+        are computed with `compose`, as in `candidates`, and `select` is
+        called with them. It returns a tuple that starts with the ``(batch,
+        length - row, dim)`` h and c states of the row. Returns the rest of
+        the tuple.
+
+        """
+        def run(token):
+            self.table.token = token
+            outputs = select(*self.candidates(row, compose))
+            return tuple(outputs) + (self.table.token,)
+
+        token = self.table.token
+        if self.checkpoint_rows and token.requires_grad:
+            # The random state is restored for the recomputation, so that
+            # the same versions are sampled again.
+            outputs = checkpoint(run, token, use_reentrant=True)
+        else:
+            outputs = run(token)
+        self.table.token = outputs[-1]
+
+        h, c = outputs[:2]
+        offset = row_offsets(self.length)[row]
+        cells = np.arange(offset, offset + self.length - row)
+        self.table.write(self.slots[:h.size(0), cells].ravel(),
+                         torch.cat([h, c], 2).view(-1, 2 * self.dim))
+        return outputs[2:-1]
+
+    def select(self, weights):
+        """Keep the chosen split of every cell of the last row, from the
+        ``(batch * n_cols, row)`` weights of its versions."""
+        n_cols = self.length - len(self.selected) - 1
+        choices = weights.data.max(1)[1].view(-1, n_cols)
+        self.selected.append(self.expand(choices))
+
+    def splits(self):
+        """The chosen split of every cell as a ``(batch, n_cells)`` integer
+        tensor, with zeros for the words."""
+        words = self.selected[0].new(self.batch_size, self.length).zero_() \
+            if self.selected else torch.zeros(self.batch_size, 1).long()
+        return torch.cat([words] + self.selected, 1)
+
+    def root(self):
+        """The ``(h, c)`` states of the cell spanning the whole sentence, each
+        with the size ``(batch, 1, dim)``. This is the last use of the
+        chart."""
+        states = self.table.read(self.slots[:, -1])
+        h, c = states.view(self.batch_size, 1, 2 * self.dim).chunk(2, 2)
+        self.table.close()
+        return h, c
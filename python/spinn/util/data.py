@@ -4,6 +4,12 @@ import random
 import itertools
 import time
 import sys
+import os
+import json
+import hashlib
+import shutil
+import threading
+import queue
 
 import numpy as np
 
@@ -72,6 +78,38 @@ def TrimDataset(dataset, seq_length, eval_mode=False,
             return trimmed_dataset
 
 
+class TokenIDLookup(dict):
+    """A copy of a vocabulary that can be indexed with any token. Tokens not in
+    the vocabulary fall back to their lowercase form, then their uppercase
+    form, then the unknown token. Each such token type is resolved once, and
+    `counts` tallies every downcased, upcased and unknown occurrence.
+    """
+
+    DOWNCASED, UPCASED, UNKNOWN = 0, 1, 2
+
+    def __init__(self, vocabulary, unk_id):
+        super(TokenIDLookup, self).__init__(vocabulary)
+        self.unk_id = unk_id
+        self.fallbacks = {}
+        self.counts = [0, 0, 0]
+
+    def resolve(self, token):
+        if token.lower() in self:
+            return self[token.lower()], self.DOWNCASED
+        elif token.upper() in self:
+            return self[token.upper()], self.UPCASED
+        else:
+            return self.unk_id, self.UNKNOWN
+
+    def __missing__(self, token):
+        try:
+            token_id, outcome = self.fallbacks[token]
+        except KeyError:
+            token_id, outcome = self.fallbacks[token] = self.resolve(token)
+        self.counts[outcome] += 1
+        return token_id
+
+
 def TokensToIDs(vocabulary, dataset, sentence_pair_data=False):
     """Replace strings in original boolean dataset with token IDs."""
     if sentence_pair_data:
@@ -79,33 +117,19 @@ def TokensToIDs(vocabulary, dataset, sentence_pair_data=False):
     else:
         keys = ["tokens"]
 
-    tokens = 0
-    unks = 0
-    lowers = 0
-    raises = 0
+    if UNK_TOKEN in vocabulary:
+        lookup = TokenIDLookup(vocabulary, vocabulary[UNK_TOKEN])
+    else:
+        lookup = vocabulary
 
+    tokens = 0
     for key in keys:
-        if UNK_TOKEN in vocabulary:
-            unk_id = vocabulary[UNK_TOKEN]
-            for example in dataset:
-                for i, token in enumerate(example[key]):
-                    if token in vocabulary:
-                        example[key][i] = vocabulary[token]
-                    elif token.lower() in vocabulary:
-                        example[key][i] = vocabulary[token.lower()]
-                        lowers += 1
-                    elif token.upper() in vocabulary:
-                        example[key][i] = vocabulary[token.upper()]
-                        raises += 1
-                    else:
-                        example[key][i] = unk_id
-                        unks += 1
-                    tokens += 1
+        for example in dataset:
+            tokens += len(example[key])
+            example[key] = list(map(lookup.__getitem__, example[key]))
+        if lookup is not vocabulary:
+            lowers, raises, unks = lookup.counts
             print("Unk rate {:2.6f}%, downcase rate {:2.6f}%, upcase rate {:2.6f}%".format((unks * 100.0 / tokens), (lowers * 100.0 / tokens), (raises * 100.0 / tokens)))
-        else:
-            for example in dataset:
-                example[key] = [vocabulary[token]
-                                for token in example[key]]
     return dataset
 
 
@@ -142,53 +166,112 @@ def CropAndPadExample(
             example[key] + ([symbol] * padding_amount)
 
 
+def CropAndPadSequences(
+        sequences,
+        padding_amounts,
+        target_length,
+        symbol=0,
+        allow_cropping=False,
+        pad_from_left=True):
+    """
+    Crop/pad a list of sequences like `CropAndPadExample`, writing them all
+    into one preallocated `int32` array of shape (len(sequences), target_length).
+    """
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    padding_amounts = np.asarray(padding_amounts, dtype=np.int64)
+    output = np.full((len(sequences), target_length), symbol, dtype=np.int32)
+    if len(sequences) == 0:
+        return output
+
+    crop = np.maximum(-padding_amounts, 0)
+    if not allow_cropping and crop.any():
+        raise NotImplementedError(
+            "Cropping not allowed. "
+            "Please set seq_length and eval_seq_length to some sufficiently large value or (for non-SPINN models) use --allow_cropping and --allow_eval_cropping..")
+    padding_amounts = np.maximum(padding_amounts, 0)
+    kept = lengths - crop
+
+    # Where the kept part of each sequence starts, in the sequence and in the
+    # output row.
+    if pad_from_left:
+        src_start = crop
+        dst_start = padding_amounts
+    else:
+        src_start = np.zeros_like(crop)
+        dst_start = np.maximum(target_length - (padding_amounts + kept), 0)
+
+    # Copy every kept token to its flat position in the output.
+    flat = np.fromiter(itertools.chain.from_iterable(sequences),
+                       dtype=np.int32, count=lengths.sum())
+    seq_starts = np.cumsum(lengths) - lengths
+    row_starts = np.arange(len(sequences)) * target_length
+    index = np.arange(flat.shape[0]) + np.repeat(
+        row_starts + dst_start - src_start - seq_starts, lengths)
+    if crop.any():
+        lo = np.repeat(row_starts + dst_start, lengths)
+        mask = (index >= lo) & (index < lo + np.repeat(kept, lengths))
+        index, flat = index[mask], flat[mask]
+    output.reshape(-1)[index] = flat
+    return output
+
+
 def CropAndPadForSPINN(dataset, length, logger=None,
                        sentence_pair_data=False, allow_cropping=False):
-    # NOTE: This can probably be done faster in NumPy if it winds up making a
-    # difference.
+    """
+    Crop/pad the tokens and transitions of every example.
+
+    Returns:
+        tokens, transitions: Arrays of shape (N, length), or (N, length, 2)
+            for sentence pairs.
+        num_transitions: The number of transitions before cropping, with
+            shape (N,) or (N, 2).
+    """
     # Always make sure that the transitions are aligned at the left edge, so
     # the final stack top is the root of the tree. If cropping is used, it should
     # just introduce empty nodes into the tree.
     if sentence_pair_data:
         keys = [
             ("premise_transitions",
-             "num_premise_transitions",
              "premise_tokens"),
             ("hypothesis_transitions",
-             "num_hypothesis_transitions",
              "hypothesis_tokens")]
     else:
-        keys = [("transitions", "num_transitions", "tokens")]
-
-    for example in dataset:
-        for (transitions_key, num_transitions_key, tokens_key) in keys:
-            # Crop and Pad Transitions
-            example[num_transitions_key] = len(example[transitions_key])
-            transitions_padding_amount = length - example[num_transitions_key]
-            shifts_before_crop_and_pad = example[transitions_key].count(0)
-            if transitions_key in example:
-                CropAndPadExample(
-                    example,
-                    transitions_padding_amount,
-                    length,
-                    transitions_key,
-                    symbol=T_SKIP,
-                    logger=logger,
-                    allow_cropping=allow_cropping)
-            shifts_after_crop_and_pad = example[transitions_key].count(0)
-
-            # Crop and Pad Tokens
-            tokens_padding_amount = shifts_after_crop_and_pad - \
-                shifts_before_crop_and_pad
-            CropAndPadExample(
-                example,
-                tokens_padding_amount,
-                length,
-                tokens_key,
-                symbol=SENTENCE_PADDING_SYMBOL,
-                logger=logger,
-                allow_cropping=allow_cropping)
-    return dataset
+        keys = [("transitions", "tokens")]
+
+    tokens, transitions, num_transitions = [], [], []
+    for (transitions_key, tokens_key) in keys:
+        # Crop and Pad Transitions
+        sequences = [example[transitions_key] for example in dataset]
+        transitions_lengths = np.array(
+            [len(seq) for seq in sequences], dtype=np.int32)
+        shifts_before_crop_and_pad = np.array(
+            [seq.count(T_SHIFT) for seq in sequences], dtype=np.int64)
+        padded_transitions = CropAndPadSequences(
+            sequences,
+            length - transitions_lengths,
+            length,
+            symbol=T_SKIP,
+            allow_cropping=allow_cropping)
+        shifts_after_crop_and_pad = (padded_transitions == T_SHIFT).sum(1)
+
+        # Crop and Pad Tokens
+        tokens_padding_amounts = shifts_after_crop_and_pad - \
+            shifts_before_crop_and_pad
+        padded_tokens = CropAndPadSequences(
+            [example[tokens_key] for example in dataset],
+            tokens_padding_amounts,
+            length,
+            symbol=SENTENCE_PADDING_SYMBOL,
+            allow_cropping=allow_cropping)
+
+        tokens.append(padded_tokens)
+        transitions.append(padded_transitions)
+        num_transitions.append(transitions_lengths)
+
+    if sentence_pair_data:
+        return (np.stack(tokens, axis=2), np.stack(transitions, axis=2),
+                np.stack(num_transitions, axis=1))
+    return tokens[0], transitions[0], num_transitions[0]
 
 
 def CropAndPadSimple(
@@ -198,28 +281,38 @@ def CropAndPadSimple(
         sentence_pair_data=False,
         allow_cropping=True,
         pad_from_left=True):
-    # NOTE: This can probably be done faster in NumPy if it winds up making a
-    # difference.
+    """
+    Crop/pad the tokens of every example.
+
+    Returns:
+        tokens: Array of shape (N, length), or (N, length, 2) for sentence
+            pairs.
+        num_tokens: The number of non-padding tokens after cropping, with
+            shape (N,) or (N, 2).
+    """
     if sentence_pair_data:
         keys = ["premise_tokens",
                 "hypothesis_tokens"]
     else:
         keys = ["tokens"]
 
-    for example in dataset:
-        for tokens_key in keys:
-            num_tokens = len(example[tokens_key])
-            tokens_padding_amount = length - num_tokens
-            CropAndPadExample(
-                example,
-                tokens_padding_amount,
-                length,
-                tokens_key,
-                symbol=SENTENCE_PADDING_SYMBOL,
-                logger=logger,
-                allow_cropping=allow_cropping,
-                pad_from_left=pad_from_left)
-    return dataset
+    tokens = []
+    for tokens_key in keys:
+        sequences = [example[tokens_key] for example in dataset]
+        num_tokens = np.array([len(seq) for seq in sequences], dtype=np.int64)
+        tokens.append(CropAndPadSequences(
+            sequences,
+            length - num_tokens,
+            length,
+            symbol=SENTENCE_PADDING_SYMBOL,
+            allow_cropping=allow_cropping,
+            pad_from_left=pad_from_left))
+
+    num_tokens = [(padded != SENTENCE_PADDING_SYMBOL).sum(1).astype(np.int32)
+                  for padded in tokens]
+    if sentence_pair_data:
+        return np.stack(tokens, axis=2), np.stack(num_tokens, axis=1)
+    return tokens[0], num_tokens[0]
 
 
 def Merge(x, y):
@@ -231,62 +324,115 @@ def Peano(x, y):
     return int(interim, base=2)
 
 
+def MortonKey(x, y, bits=16):
+    """Vectorized `Peano`: interleave the bits of two integer arrays, with the
+    bits of `x` in the higher position of each pair."""
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    key = np.zeros(np.broadcast(x, y).shape, dtype=np.int64)
+    for b in range(bits):
+        key |= ((x >> b) & 1) << (2 * b + 1)
+        key |= ((y >> b) & 1) << (2 * b)
+    return key
+
+
+def PaddedTransitionCosts(num_transitions):
+    """Per-example cost of a batch's padded transitions: the number of rows an
+    example adds (two for sentence pairs) times its longest transition
+    sequence. A batch costs `len(batch) * max(costs[batch])`."""
+    num_transitions = np.asarray(num_transitions)
+    num_transitions = num_transitions.reshape(len(num_transitions), -1)
+    return num_transitions.shape[1] * num_transitions.max(axis=1)
+
+
+def TokenBudgetBatches(order, costs, token_budget):
+    """Cut `order`, sorted by ascending `costs`, into consecutive batches that
+    each hold as many examples as fit `len(batch) * max(costs[batch]) <=
+    token_budget`. An example that exceeds the budget on its own gets a batch
+    of its own."""
+    sorted_costs = costs[order]
+    batches = []
+    start = 0
+    while start < len(order):
+        max_rows = max(1, token_budget // max(1, sorted_costs[start]))
+        window = sorted_costs[start:start + max_rows]
+
+        # Costs are sorted, so the newest example sets the padded length and
+        # the batch cost grows with every example added.
+        fits = np.arange(1, len(window) + 1) * window <= token_budget
+        size = max(1, int(np.count_nonzero(fits)))
+        batches.append(order[start:start + size])
+        start += size
+    return batches
+
+
+def TrainingEpochLength(sources, batch_size, num_splits=10, token_budget=0):
+    """Number of batches in an epoch of MakeTrainingIterator. With a token
+    budget, the batches of one shuffle of the data are counted, as
+    MakeTrainingIterator would cut them. Other shuffles give nearly the same
+    count."""
+    dataset_size = len(sources[0])
+    if token_budget <= 0:
+        return dataset_size // batch_size
+
+    costs = PaddedTransitionCosts(sources[3])
+    order = np.random.RandomState(0).permutation(dataset_size)
+    order_limit = dataset_size // num_splits * num_splits
+    order_splits = order[:order_limit].reshape(num_splits, -1)
+    order_splits = np.take_along_axis(
+        order_splits, np.argsort(costs[order_splits], axis=1, kind='mergesort'), axis=1)
+    return sum(len(TokenBudgetBatches(split, costs, token_budget))
+               for split in order_splits)
+
+
 def MakeTrainingIterator(
         sources,
         batch_size,
         smart_batches=True,
         use_peano=True,
         sentence_pair_data=True,
-        pad_from_left=True):
-    # Make an iterator that exposes a dataset as random minibatches.
-
-    def get_key(num_transitions):
+        pad_from_left=True,
+        num_splits=10,
+        token_budget=0):
+    # Make an iterator that exposes a dataset as random minibatches. If
+    # token_budget is set, batches are sorted by length and filled up to that
+    # many padded transitions instead of holding batch_size examples.
+
+    def get_keys(num_transitions):
+        num_transitions = np.asarray(num_transitions)
         if use_peano and sentence_pair_data:
-            prem_len, hyp_len = num_transitions
-            key = Peano(prem_len, hyp_len)
-            return key
+            return MortonKey(num_transitions[:, 0], num_transitions[:, 1])
+        elif num_transitions.ndim > 1:
+            return num_transitions.max(axis=1)
         else:
-            if not isinstance(num_transitions, list):
-                num_transitions = [num_transitions]
-            return max(num_transitions)
+            return num_transitions
 
     def build_batches():
         dataset_size = len(sources[0])
-        order = list(range(dataset_size))
-        random.shuffle(order)
-        order = np.array(order)
-
-        num_splits = 10  # TODO: Should we be smarter about split size?
-        order_limit = len(order) // num_splits * num_splits
-        order = order[:order_limit]
-        order_splits = np.split(order, num_splits)
-        batches = []
-
-        for split in order_splits:
-            # Put indices into buckets based on example length.
-            keys = []
-            for i in split:
-                num_transitions = sources[3][i]
-                key = get_key(num_transitions)
-                keys.append((i, key))
-            keys = sorted(keys, key=lambda __key: __key[1])
-
-            # Group indices from buckets into batches, so that
-            # examples in each batch have similar length.
-            batch = []
-            for i, _ in keys:
-                batch.append(i)
-                if len(batch) == batch_size:
-                    batches.append(batch)
-                    batch = []
-        return batches
+        order = np.random.permutation(dataset_size)
+
+        order_limit = dataset_size // num_splits * num_splits
+        order_splits = order[:order_limit].reshape(num_splits, -1)
+
+        # Put indices into buckets based on example length. The sort is
+        # stable, so ties stay in random order.
+        split_keys = keys[order_splits]
+        order_splits = np.take_along_axis(
+            order_splits, np.argsort(split_keys, axis=1, kind='mergesort'), axis=1)
+
+        # Group indices from buckets into batches, so that
+        # examples in each batch have similar length.
+        if token_budget > 0:
+            return [batch for split in order_splits
+                    for batch in TokenBudgetBatches(split, keys, token_budget)]
+        split_limit = order_splits.shape[1] // batch_size * batch_size
+        return list(order_splits[:, :split_limit].reshape(-1, batch_size))
 
     def batch_iter():
         batches = build_batches()
         num_batches = len(batches)
         idx = -1
-        order = list(range(num_batches))
-        random.shuffle(order)
+        order = np.random.permutation(num_batches)
 
         while True:
             idx += 1
@@ -295,8 +441,7 @@ def MakeTrainingIterator(
                 batches = build_batches()
                 num_batches = len(batches)
                 idx = 0
-                order = list(range(num_batches))
-                random.shuffle(order)
+                order = np.random.permutation(num_batches)
             batch_indices = batches[order[idx]]
             yield tuple(source[batch_indices] for source in sources)
 
@@ -315,7 +460,11 @@ def MakeTrainingIterator(
             batch_indices = order[start:start + batch_size]
             yield tuple(source[batch_indices] for source in sources)
 
-    train_iter = batch_iter if smart_batches else data_iter
+    if token_budget > 0:
+        keys = PaddedTransitionCosts(sources[3])
+    elif smart_batches:
+        keys = get_keys(sources[3])
+    train_iter = batch_iter if smart_batches or token_budget > 0 else data_iter
 
     return train_iter()
 
@@ -326,54 +475,66 @@ def MakeEvalIterator(
         limit=None,
         shuffle=False,
         rseed=123,
-        bucket_eval=False):
+        bucket_eval=False,
+        token_budget=0):
     if bucket_eval:
-        return MakeBucketEvalIterator(sources, batch_size)[:limit]
+        return MakeBucketEvalIterator(
+            sources, batch_size, token_budget)[:limit]
     else:
         return MakeStandardEvalIterator(
             sources, batch_size, limit, shuffle, rseed)
 
 
+class EvalIterator(object):
+    """A restartable view of an eval set as minibatches. Batches are gathered
+    from `sources` on demand each time the iterator is walked, and the last
+    batch is short if the examples do not divide evenly, so every example is
+    evaluated.
+    """
+
+    def __init__(self, sources, batch_size, limit=None, shuffle=False,
+                 rseed=123):
+        dataset_size = len(sources[0])
+        if limit is not None and limit >= 0:
+            dataset_size = min(limit, dataset_size)
+        order = np.arange(dataset_size)
+        if shuffle:
+            random.Random(rseed).shuffle(order)
+        self.sources = sources
+        self.batch_size = batch_size
+        self.order = order
+
+    def __len__(self):
+        return (len(self.order) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(0, len(self.order), self.batch_size):
+            batch_indices = self.order[start:start + self.batch_size]
+            yield tuple(source[batch_indices] for source in self.sources)
+
+
 def MakeStandardEvalIterator(
         sources,
         batch_size,
         limit=None,
         shuffle=False,
         rseed=123):
-    # Make a list of minibatches from a dataset to use as an iterator.
-    # TODO(SB): Pad out the last few examples in the eval set if they don't
-    # form a batch.
-
-    print("Warning: May be discarding eval examples at batch ends.")
-
-    dataset_size = limit if limit >= 0 else len(sources[0])
-    order = list(range(dataset_size))
-    if shuffle:
-        random.seed(rseed)
-        random.shuffle(order)
-    data_iter = []
-    start = -batch_size
-    while True:
-        start += batch_size
-
-        if start >= dataset_size:
-            break
+    # Make a restartable iterator over the minibatches of a dataset.
+    return EvalIterator(sources, batch_size, limit, shuffle, rseed)
 
-        batch_indices = order[start:start + batch_size]
-        candidate_batch = tuple(source[batch_indices]
-                                for source in sources)
-
-        if len(candidate_batch[0]) == batch_size:
-            data_iter.append(candidate_batch)
-        else:
-            print("Skipping " + str(len(candidate_batch[0])) + " examples.")
-    return data_iter
 
-
-def MakeBucketEvalIterator(sources, batch_size):
+def MakeBucketEvalIterator(sources, batch_size, token_budget=0):
     # Order in eval should not matter. Use batches sorted by length for speed
     # improvement.
 
+    if token_budget > 0:
+        # Longest batches first, each filled up to the budget.
+        costs = PaddedTransitionCosts(sources[3])
+        order = np.argsort(costs, kind='mergesort')
+        return [tuple(source[batch_indices] for source in sources)
+                for batch_indices in
+                reversed(TokenBudgetBatches(order, costs, token_budget))]
+
     def single_sentence_key(num_transitions):
         return num_transitions
 
@@ -415,6 +576,41 @@ def MakeBucketEvalIterator(sources, batch_size):
     return batches
 
 
+class PrefetchIterator(object):
+    """Wraps an iterator so that `transform(item)` is computed ahead of time
+    in a background thread, keeping up to `depth` results in a bounded queue.
+
+    Exceptions raised in the thread are re-raised by `next`.
+    """
+
+    def __init__(self, iterator, transform=lambda x: x, depth=2):
+        self.queue = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(
+            target=self.fill, args=(iterator, transform))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fill(self, iterator, transform):
+        try:
+            for item in iterator:
+                self.queue.put((transform(item), None))
+        except Exception as e:
+            self.queue.put((None, e))
+            return
+        self.queue.put((None, StopIteration()))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item, error = self.queue.get()
+        if error is not None:
+            raise error
+        return item
+
+    next = __next__
+
+
 def PreprocessDataset(
         dataset,
         vocabulary,
@@ -438,54 +634,25 @@ def PreprocessDataset(
         dataset,
         sentence_pair_data=sentence_pair_data)
     if simple:
-        dataset = CropAndPadSimple(
+        X, num_transitions = CropAndPadSimple(
             dataset,
             seq_length,
             logger=logger,
             sentence_pair_data=sentence_pair_data,
             allow_cropping=allow_cropping,
             pad_from_left=pad_from_left)
+        if sentence_pair_data:
+            transitions = np.zeros((len(dataset), 2, 0))
+        else:
+            transitions = np.zeros((len(dataset), 0))
     else:
-        dataset = CropAndPadForSPINN(
+        X, transitions, num_transitions = CropAndPadForSPINN(
             dataset,
             seq_length,
             logger=logger,
             sentence_pair_data=sentence_pair_data,
             allow_cropping=allow_cropping)
 
-    if sentence_pair_data:
-        X = np.transpose(np.array([[example["premise_tokens"] for example in dataset],
-                                   [example["hypothesis_tokens"] for example in dataset]],
-                                  dtype=np.int32), (1, 2, 0))
-        if simple:
-            transitions = np.zeros((len(dataset), 2, 0))
-            num_transitions = np.transpose(np.array(
-                [[len(np.array(example["premise_tokens"]).nonzero()[0]) for example in dataset],
-                 [len(np.array(example["hypothesis_tokens"]).nonzero()[0]) for example in dataset]],
-                dtype=np.int32), (1, 0))
-        else:
-            transitions = np.transpose(np.array([[example["premise_transitions"] for example in dataset],
-                                                 [example["hypothesis_transitions"] for example in dataset]],
-                                                dtype=np.int32), (1, 2, 0))
-            num_transitions = np.transpose(np.array(
-                [[example["num_premise_transitions"] for example in dataset],
-                 [example["num_hypothesis_transitions"] for example in dataset]],
-                dtype=np.int32), (1, 0))
-    else:
-        X = np.array([example["tokens"] for example in dataset],
-                     dtype=np.int32)
-        if simple:
-            transitions = np.zeros((len(dataset), 0))
-            num_transitions = np.array(
-                [len(np.array(example["tokens"]).nonzero()[0]) for example in dataset],
-                dtype=np.int32)
-        else:
-            transitions = np.array([example["transitions"]
-                                    for example in dataset], dtype=np.int32)
-            num_transitions = np.array(
-                [example["num_transitions"] for example in dataset],
-                dtype=np.int32)
-
     y = np.array(
         [data_manager.LABEL_MAP[example["label"]] for example in dataset],
         dtype=np.int32)
@@ -496,6 +663,84 @@ def PreprocessDataset(
     return X, transitions, y, num_transitions, example_ids
 
 
+DATASET_FIELDS = ["X", "transitions", "y", "num_transitions", "example_ids"]
+
+
+def DatasetCacheKey(data_paths, embedding_path=None, **settings):
+    """Hash everything that `PreprocessDataset` and `BuildVocabulary` depend
+    on: the contents of the data files, the embedding file and the
+    preprocessing settings. The embedding file can be several GB, so it is
+    identified by path, size and modification time instead of contents."""
+    h = hashlib.sha1()
+    for path in data_paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    if embedding_path is not None:
+        stat = os.stat(embedding_path)
+        h.update(json.dumps([os.path.abspath(embedding_path), stat.st_size,
+                             int(stat.st_mtime)]).encode('utf-8'))
+    h.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def SaveCachedDataset(path, vocabulary, training_data, eval_sets):
+    """Write a vocabulary and the outputs of `PreprocessDataset` to the
+    directory `path`, one .npy file per array.
+
+    The directory is written under a temporary name and renamed at the end,
+    so concurrent jobs never see a partial cache.
+    """
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    splits = [("eval{}".format(i), data) for i, (_, data) in enumerate(eval_sets)]
+    if training_data is not None:
+        splits.append(("train", training_data))
+    for prefix, data in splits:
+        for field, array in zip(DATASET_FIELDS, data):
+            np.save(os.path.join(tmp_path, "{}_{}.npy".format(prefix, field)),
+                    array)
+
+    with open(os.path.join(tmp_path, "vocabulary.json"), 'w') as f:
+        json.dump(vocabulary, f)
+    with open(os.path.join(tmp_path, "meta.json"), 'w') as f:
+        json.dump({"eval_filenames": [filename for filename, _ in eval_sets],
+                   "has_training_data": training_data is not None}, f)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another job wrote the same cache first.
+        shutil.rmtree(tmp_path)
+
+
+def LoadCachedDataset(path):
+    """Read a cache written by `SaveCachedDataset`. Arrays are memory-mapped,
+    so jobs on the same machine share them through the page cache.
+
+    Returns:
+        vocabulary, training_data (None if not cached) and a list of
+        (filename, eval_data) pairs.
+    """
+    def load_split(prefix):
+        return tuple(np.load(os.path.join(path, "{}_{}.npy".format(prefix, field)),
+                             mmap_mode='r')
+                     for field in DATASET_FIELDS)
+
+    with open(os.path.join(path, "vocabulary.json")) as f:
+        vocabulary = json.load(f)
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+
+    training_data = load_split("train") if meta["has_training_data"] else None
+    eval_sets = [(filename, load_split("eval{}".format(i)))
+                 for i, filename in enumerate(meta["eval_filenames"])]
+    return vocabulary, training_data, eval_sets
+
+
 def BuildVocabulary(raw_training_data, raw_eval_sets, embedding_path,
                     logger=None, sentence_pair_data=False):
     # Find the set of words that occur in the data.
@@ -519,8 +764,12 @@ def BuildVocabulary(raw_training_data, raw_eval_sets, embedding_path,
     # Build a vocabulary of words in the data for which we have an
     # embedding.
     assert embedding_path is not None, "Open-vocabulary models require pretrained vectors. Running with empty vocabulary."
-    vocabulary = BuildVocabularyForTextEmbeddingFile(
-        embedding_path, types_in_data, CORE_VOCABULARY)
+    if IsEmbeddingStore(embedding_path):
+        vocabulary = BuildVocabularyForEmbeddingStore(
+            embedding_path, types_in_data, CORE_VOCABULARY)
+    else:
+        vocabulary = BuildVocabularyForTextEmbeddingFile(
+            embedding_path, types_in_data, CORE_VOCABULARY)
 
     return vocabulary
 
@@ -569,6 +818,105 @@ def LoadEmbeddingsFromText(vocabulary, embedding_dim, path):
     return emb
 
 
+EMBEDDING_STORE_WORDS = "words.json"
+EMBEDDING_STORE_VECTORS = "vectors.npy"
+
+
+def ConvertEmbeddingsToBinary(text_path, store_path):
+    """Convert a GloVe-formatted text vector file into an embedding store: a
+    directory with the words, in file order, and a float32 matrix with one
+    row per word that can be memory-mapped.
+
+    Rows with fewer values than the first vector (header or final rows) are
+    skipped, as in `LoadEmbeddingsFromText`.
+    """
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    vectors_path = os.path.join(store_path, EMBEDDING_STORE_VECTORS)
+    rows_path = vectors_path + ".tmp"
+
+    # Read the text file once, appending the rows to a raw float32 file
+    # until the number of words is known.
+    words = []
+    embedding_dim = None
+    with open(text_path, 'r', encoding='utf-8') as f, \
+            open(rows_path, 'wb') as rows:
+        for line in f:
+            spl = line.rstrip("\n").split(" ")
+            if embedding_dim is None and len(spl) > 2:
+                embedding_dim = len(spl) - 1
+            if embedding_dim is None or len(spl) < embedding_dim + 1:
+                continue
+            words.append(spl[0])
+            rows.write(np.array(spl[1:embedding_dim + 1],
+                                dtype=np.float32).tobytes())
+    if embedding_dim is None:
+        os.remove(rows_path)
+    assert embedding_dim is not None, "No word embeddings found in file."
+
+    # Put the .npy header in front of the rows.
+    with open(vectors_path, 'wb') as vectors, open(rows_path, 'rb') as rows:
+        np.lib.format.write_array_header_1_0(vectors, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+            'fortran_order': False,
+            'shape': (len(words), embedding_dim)})
+        shutil.copyfileobj(rows, vectors)
+    os.remove(rows_path)
+
+    with open(os.path.join(store_path, EMBEDDING_STORE_WORDS), 'w') as f:
+        json.dump(words, f)
+
+
+def IsEmbeddingStore(path):
+    return os.path.isfile(os.path.join(path, EMBEDDING_STORE_WORDS))
+
+
+def LoadEmbeddingStoreWords(path):
+    with open(os.path.join(path, EMBEDDING_STORE_WORDS)) as f:
+        return json.load(f)
+
+
+def BuildVocabularyForEmbeddingStore(path, types_in_data, core_vocabulary):
+    """Same as `BuildVocabularyForTextEmbeddingFile`, but reads the word list
+    of an embedding store written by `ConvertEmbeddingsToBinary`."""
+    vocabulary = {}
+    vocabulary.update(core_vocabulary)
+    next_index = len(vocabulary)
+    for word in LoadEmbeddingStoreWords(path):
+        if word in types_in_data and word not in vocabulary:
+            vocabulary[word] = next_index
+            next_index += 1
+    return vocabulary
+
+
+def LoadEmbeddingsFromStore(vocabulary, embedding_dim, path):
+    """Same as `LoadEmbeddingsFromText`, but gathers the rows of the
+    vocabulary from the memory-mapped matrix of an embedding store."""
+    emb = np.zeros(
+        (len(vocabulary), embedding_dim), dtype=np.float32)
+    vectors = np.load(os.path.join(path, EMBEDDING_STORE_VECTORS),
+                      mmap_mode='r')
+    assert vectors.shape[1] >= embedding_dim, \
+        "No word embeddings of correct size found in file."
+
+    # Later rows win for repeated words, as when reading the text file.
+    rows = {word: i for i, word in enumerate(LoadEmbeddingStoreWords(path))}
+    found = [(index, rows[word]) for word, index in vocabulary.items()
+             if word in rows]
+    assert len(found) > 0, "No word embeddings of correct size found in file."
+    found.sort(key=lambda pair: pair[1])
+    indices, store_rows = list(zip(*found))
+    emb[list(indices)] = vectors[list(store_rows), :embedding_dim]
+    return emb
+
+
+def LoadEmbeddings(vocabulary, embedding_dim, path):
+    """Load embeddings from either an embedding store or a text file."""
+    if IsEmbeddingStore(path):
+        return LoadEmbeddingsFromStore(vocabulary, embedding_dim, path)
+    return LoadEmbeddingsFromText(vocabulary, embedding_dim, path)
+
+
 class SimpleProgressBar(object):
     """ Simple Progress Bar and Timing Snippet
     """
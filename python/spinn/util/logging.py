@@ -24,6 +24,10 @@ class InspectModel(object):
         self.has_spinn_temperature = self.has_spinn and hasattr(
             model.spinn, "temperature")
         self.has_pyramid_temperature = hasattr(model, "temperature_to_display")
+        self.has_subtree_cache = self.has_spinn and getattr(
+            model.spinn, "subtree_cache", None) is not None
+        self.has_chart_memory = getattr(
+            model, "chart_memory", None) is not None
 
 
 def inspect(model):
@@ -49,6 +53,9 @@ def train_accumulate(model, A, batch):
     if im.has_invalid:
         A.add('invalid', model.spinn.invalid)
 
+    if im.has_chart_memory:
+        A.add('chart_memory', model.chart_memory)
+
 
 def train_rl_accumulate(model, A, batch):
 
@@ -77,13 +84,18 @@ def stats(model, trainer, A, log_entry):
         avg_trans_acc = (all_preds == all_truth).sum() / \
             float(all_truth.shape[0])
 
-    time_metric = time_per_token(A.get('total_tokens'), A.get('total_time'))
+    total_tokens = A.get('total_tokens')
+    time_metric = time_per_token(total_tokens, A.get('total_time'))
+    data_time = A.get('data_time')
 
     log_entry.step = trainer.step
     log_entry.class_accuracy = A.get_avg('class_acc')
     log_entry.cross_entropy_cost = A.get_avg('xent_cost')  # not actual mean
     log_entry.learning_rate = trainer.learning_rate
     log_entry.time_per_token_seconds = time_metric
+    if len(data_time) > 0:
+        log_entry.data_time_per_token_seconds = time_per_token(
+            total_tokens, data_time)
 
     total_cost = log_entry.cross_entropy_cost
     if im.has_transition_loss:
@@ -94,6 +106,10 @@ def stats(model, trainer, A, log_entry):
     if im.has_invalid:
         log_entry.invalid = A.get_avg('invalid')
 
+    chart_memory = A.get('chart_memory')
+    if len(chart_memory) > 0:
+        log_entry.chart_memory_mb = max(chart_memory) / float(2 ** 20)
+
     adv_mean = np.array(A.get('adv_mean'), dtype=np.float32)
     adv_mean_magnitude = np.array(
         A.get('adv_mean_magnitude'), dtype=np.float32)
@@ -173,6 +189,10 @@ def eval_stats(model, A, eval_data):
     if im.has_invalid:
         eval_data.invalid = A.get_avg('invalid')
 
+    if im.has_subtree_cache:
+        eval_data.subtree_cache_hits = model.spinn.subtree_cache.hits
+        eval_data.subtree_cache_misses = model.spinn.subtree_cache.misses
+
     time_metric = time_per_token(A.get('total_tokens'), A.get('total_time'))
     eval_data.time_per_token_seconds = time_metric
 
@@ -194,6 +214,10 @@ def train_format(log_entry, extra=False, rl=False):
 
     # Time Component.
     stats_str += " Time: {time:.5f}"
+    if log_entry.HasField('data_time_per_token_seconds'):
+        stats_str += " data {data_time:.5f}"
+    if log_entry.HasField('chart_memory_mb'):
+        stats_str += " Chart: {chart_memory:.1f}MB"
 
     # Extra Component.
     if extra and log_entry.HasField(
@@ -221,6 +245,8 @@ def train_format(log_entry, extra=False, rl=False):
 
 def eval_format(evaluation, extra=False):
     eval_str = "Step: {step} Eval acc: cl {class_acc:.5f} tr {transition_acc:.5f} {filename} Time: {time:.5f}"
+    if evaluation.HasField('subtree_cache_hits'):
+        eval_str += " Cache: hit {cache_hits} miss {cache_misses}"
 
     if extra and evaluation.HasField('invalid'):
         eval_str += "\nEval Extra:"
@@ -253,6 +279,8 @@ def log_formatter(log_entry, extra=False, rl=False):
         'policy_cost': log_entry.policy_cost,
         'value_cost': log_entry.value_cost,
         'time': log_entry.time_per_token_seconds,
+        'data_time': log_entry.data_time_per_token_seconds,
+        'chart_memory': log_entry.chart_memory_mb,
         'learning_rate': log_entry.learning_rate,
         'invalid': log_entry.invalid,
         'mean_adv_mean': log_entry.mean_adv_mean,
@@ -273,6 +301,8 @@ def log_formatter(log_entry, extra=False, rl=False):
                 'filename': evaluation.filename,
                 'time': evaluation.time_per_token_seconds,
                 'invalid': evaluation.invalid,
+                'cache_hits': evaluation.subtree_cache_hits,
+                'cache_misses': evaluation.subtree_cache_misses,
             }
             log_str += '\n' + \
                 eval_format(evaluation, extra).format(**eval_args)
@@ -16,3 +16,10 @@ def auxiliary_loss(model):
         total_loss += model.value_loss
 
     return total_loss
+
+
+def batch_size_loss_scale(batch_size, mean_batch_size):
+    """Scale for the per-example mean losses of a batch of `batch_size`
+    examples. When batch sizes vary, as with a token budget, this gives every
+    example the same weight it has in a batch of `mean_batch_size`."""
+    return batch_size / float(mean_batch_size)
@@ -1,5 +1,5 @@
 import numpy as np
-from collections import deque
+from collections import deque, OrderedDict
 import json
 
 
@@ -195,6 +195,41 @@ class Accumulator(object):
         return np.array(self.get(key, clear)).mean()
 
 
+class LRUCache(object):
+    """A mapping of bounded size that evicts the least recently used entry.
+    Counts the hits and misses of `get`."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the value for `key`, or None if it is not cached."""
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
 class EvalReporter(object):
     def __init__(self):
         super(EvalReporter, self).__init__()
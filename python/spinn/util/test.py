@@ -63,6 +63,12 @@ def default_args(**kwargs):
     composition_args.size = args['model_dim']
     composition_args.tracker_size = args['tracking_lstm_hidden_dim']
     composition_args.transition_weight = args['transition_weight']
+    composition_args.use_internal_parser = False
+    composition_args.thin_stack = False
+    composition_args.level_batching = False
+    composition_args.subtree_cache_size = 0
+    composition_args.lean_eval = False
+    composition_args.lean_eval_transition_stats = False
     composition_args.wrap_items = lambda x: torch.cat(x, 0)
     composition_args.extract_h = lambda x: x
     composition_args.composition = Reduce()
@@ -0,0 +1,91 @@
+"""
+A table of rows that is read and written in place, with gradients that are
+kept in a matching table. Used by the thin-stack SPINN and the pyramid
+charts.
+"""
+
+import numpy as np
+
+# PyTorch
+import torch
+from torch.autograd import Function, Variable
+from torch.autograd.function import once_differentiable
+
+from spinn.util.blocks import to_gpu
+
+
+def thin_index(idxs):
+    """Wrap an array of row indices for `index_select`/`index_copy_`."""
+    return to_gpu(Variable(torch.from_numpy(
+        np.asarray(idxs, dtype=np.int64))))
+
+
+class ThinStack(object):
+    """A table of ``(N, D)`` rows that is written and read in place.
+
+    Rows that are never written are zeros. Writing to a row only affects the
+    reads that come after it, as with a list.
+
+    Slicing into and copying into one large Variable makes every step pay for
+    the whole table during backprop. Here the table is a plain tensor instead,
+    and `ThinStackRead` and `ThinStackWrite` keep a matching table of
+    gradients: a read adds the gradient of its rows, and a write takes the
+    gradient of the rows it wrote and clears it. Every op takes and returns a
+    dummy ``token`` Variable so that backprop visits them in exactly the
+    reverse order, and each step costs only as much as the rows it touches.
+    """
+
+    def __init__(self, n_rows, like):
+        self.data = like.data.new(n_rows, like.size(-1)).zero_()
+        self.grad = None
+        self.token = Variable(self.data.new(1).zero_())
+
+    def read(self, rows):
+        values, self.token = ThinStackRead.apply(
+            self, thin_index(rows), self.token)
+        return values
+
+    def write(self, rows, values):
+        self.token = ThinStackWrite.apply(
+            self, thin_index(rows), values, self.token)
+
+    def close(self):
+        """Drop the last token, which would otherwise keep the graph alive
+        through a reference cycle."""
+        self.token = None
+
+    def grad_buffer(self):
+        if self.grad is None:
+            self.grad = self.data.new(*self.data.size()).zero_()
+        return self.grad
+
+
+class ThinStackRead(Function):
+
+    @staticmethod
+    def forward(ctx, stack, rows, token):
+        ctx.stack, ctx.rows = stack, rows
+        return stack.data.index_select(0, rows), token.new(1).zero_()
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_values, grad_token):
+        ctx.stack.grad_buffer().index_add_(0, ctx.rows, grad_values)
+        return None, None, ctx.stack.data.new(1).zero_()
+
+
+class ThinStackWrite(Function):
+
+    @staticmethod
+    def forward(ctx, stack, rows, values, token):
+        ctx.stack, ctx.rows = stack, rows
+        stack.data.index_copy_(0, rows, values)
+        return token.new(1).zero_()
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_token):
+        grad = ctx.stack.grad_buffer()
+        grad_values = grad.index_select(0, ctx.rows)
+        grad.index_fill_(0, ctx.rows, 0)
+        return None, None, grad_values, ctx.stack.data.new(1).zero_()
@@ -0,0 +1,21 @@
+""" Convert a GloVe-formatted text vector file into a binary embedding store,
+which can be passed as --embedding_data_path in place of the text file.
+
+$ python scripts/convert_embeddings.py --inpt ~/data/glove.840B.300d.txt --outp ~/data/glove.840B.300d
+"""
+
+import gflags
+import os
+import sys
+
+from spinn.util.data import ConvertEmbeddingsToBinary
+
+FLAGS = gflags.FLAGS
+
+
+if __name__ == '__main__':
+    gflags.DEFINE_string("inpt", None, "GloVe-formatted text vector file.")
+    gflags.DEFINE_string("outp", None, "Directory to write the store to.")
+    FLAGS(sys.argv)
+    ConvertEmbeddingsToBinary(os.path.expanduser(FLAGS.inpt),
+                              os.path.expanduser(FLAGS.outp))